@@ -30,9 +30,6 @@ db = client["NotebookDB"]
 user_sessions = db["user_sessions"]
 
 class CodeExecutor:
-    def __init__(self, timeout=10):
-        self.timeout = timeout
-
     def remove_comments(self, code):
         code = re.sub(r'\#.*', '', code)
         code = re.sub(r'""".*?"""', '', code, flags=re.DOTALL)
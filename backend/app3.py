@@ -10,9 +10,12 @@ import matplotlib.pyplot as plt
 import base64
 import time
 import traceback
-import re
 from pymongo import MongoClient
 from dotenv import load_dotenv
+from session_store import SessionStore
+from executor import redirect
+from cell_analysis import CellAnalysis
+from plots import figure_scope
 
 # Load environment variables from .env file
 load_dotenv()
@@ -36,28 +39,22 @@ CORS(app)
 
 
 # Stores user notebooks {userId: {notebookId: {"cells": [{"id": "cell_1", "code": "x = 10", "output": ""}], "globals": {}, "lastActive": timestamp}}}
-user_sessions = {}
 SESSION_TIMEOUT = 1800  # 30 minutes
+# Idle sessions are expired by the store's background thread, not on the request path
+user_sessions = SessionStore(timeout=SESSION_TIMEOUT)
 
 class CodeExecutor:
-    def __init__(self, timeout=10):
-        self.timeout = timeout
-
-    def remove_comments(self, code):
-        """Removes both single-line and multi-line comments from the code."""
-        code = re.sub(r'\#.*', '', code)  # Remove single-line comments
-        code = re.sub(r'""".*?"""', '', code, flags=re.DOTALL)  # Remove multi-line comments
-        code = re.sub(r"'''.*?'''", '', code, flags=re.DOTALL)  # Remove multi-line comments using single quotes
-        return code  
-     
     def capture_output(self, code, session_globals):
         output = io.StringIO()
         error = None
         images = []
 
-        # Remove all types of comments from the code before checking for input()
-        code_without_comments = self.remove_comments(code)
-        if "input(" in code_without_comments:
+        # Checked on the parsed cell, so comments and strings do not count and aliases do
+        try:
+            denied = CellAnalysis.parse(code).denied(frozenset(["input"]))
+        except SyntaxError:
+            denied = []  # Reported when the cell runs
+        if denied:
             return {
                 "text": "",
                 "error": "User input is disabled. Please use predefined variables instead.",
@@ -74,7 +71,8 @@ class CodeExecutor:
                 print(f"Error saving plot: {e}")
                 return None
         try:
-            with contextlib.redirect_stdout(output):
+            # Sessions run concurrently, so output and figures are kept per thread
+            with redirect("stdout", output), figure_scope():
                 try:
                     exec(code, session_globals)
                     if plt.get_fignums():
@@ -95,30 +93,16 @@ class CodeExecutor:
 
 executor = CodeExecutor()
 
-def cleanup_sessions():
-    """Removes sessions that have been inactive for more than 30 minutes."""
-    current_time = time.time()
-    for user_id in list(user_sessions.keys()):
-        for notebook_id in list(user_sessions[user_id].keys()):
-            if current_time - user_sessions[user_id][notebook_id]["lastActive"] > SESSION_TIMEOUT:
-                del user_sessions[user_id][notebook_id]
-        if not user_sessions[user_id]:
-            del user_sessions[user_id]
-
 @app.route('/<user_id>', methods=['GET'])
 def get_user_notebooks(user_id):
     """Returns a list of all notebooks for a user with correct names."""
-    if user_id not in user_sessions:
-        return jsonify({"notebooks": []})
-
     notebooks = [
         {
             "notebookId": nb_id,
-            "name": user_sessions[user_id][nb_id].get("name", f"Notebook {nb_id}")  # Fetch actual stored name
+            "name": session.get("name", f"Notebook {nb_id}")  # Fetch actual stored name
         }
-        for nb_id in user_sessions[user_id]
+        for nb_id, session in user_sessions.notebooks(user_id).items()
     ]
-    print(user_sessions)
     return jsonify({"notebooks": notebooks})
 
 
@@ -129,54 +113,39 @@ def create_notebook(user_id):
     cur_time = int(time.time())
     notebook_name = data.get("name")  # Get user-defined name if provided
 
-    if user_id not in user_sessions:
-        user_sessions[user_id] = {}
-
-    # Check if the user-defined name already exists
-    if notebook_name and any(nb["name"] == notebook_name for nb in user_sessions[user_id].values()):
-        return jsonify({"error": "A notebook with this name already exists."}), 400
-    print(notebook_name)
-
     # Generate a system-defined notebook name if none is provided
-    notebook_id = f"notebook_{int(time.time())}"
+    notebook_id = f"notebook_{time.time_ns()}"
     if not notebook_name:
         notebook_name = f"Notebook {notebook_id}"
-    print(notebook_id,notebook_name)
-
-    # ✅ Ensure the notebook name is saved in the dictionary
-    user_sessions[user_id][notebook_id] = {
-        "name": notebook_name,
-        "cells": [],
-        "globals": {"__builtins__": __builtins__},
-        "lastActive": time.time()
-    }
-    print(f"Stored notebook: {user_sessions[user_id][notebook_id]}")
+
+    # The name check and the insert happen under one lock, so two requests cannot both claim a name
+    if not user_sessions.add(user_id, notebook_id, user_sessions.new_session(name=notebook_name), unique_name=True):
+        return jsonify({"error": "A notebook with this name already exists."}), 400
     return jsonify({"notebookId": notebook_id, "name": notebook_name})
 
 
 @app.route('/<user_id>/<notebook_id>', methods=['GET'])
 def load_notebook(user_id, notebook_id):
     """Loads a specific notebook."""
-    cleanup_sessions()
-    if user_id in user_sessions and notebook_id in user_sessions[user_id]:
-        return jsonify({"cells": user_sessions[user_id][notebook_id]["cells"]})
+    session = user_sessions.get(user_id, notebook_id)
+    if session:
+        return jsonify({"cells": list(session["cells"])})
     return jsonify({"error": "Notebook not found."}), 404
 
 @app.route('/<user_id>/<notebook_id>/execute', methods=['POST'])
 def execute_code(user_id, notebook_id):
     """Executes code inside a specific notebook in an isolated session."""
-    cleanup_sessions()
     data = request.json
     code = data.get('code', '')
     if not code:
         return jsonify({"error": "Code is required."}), 400
-    if user_id not in user_sessions or notebook_id not in user_sessions[user_id]:
-        return jsonify({"error": "Notebook not found."}), 404
     
-    session = user_sessions[user_id][notebook_id]
-    session["lastActive"] = time.time()
-    result = executor.capture_output(code, session["globals"])
-    session["cells"].append({"code": code, "output": result["text"]})
+    # Cells of one notebook run one at a time, other notebooks are not blocked
+    with user_sessions.use(user_id, notebook_id) as session:
+        if session is None:
+            return jsonify({"error": "Notebook not found."}), 404
+        result = executor.capture_output(code, session["globals"])
+        session["cells"].append({"code": code, "output": result["text"]})
     return jsonify(result)
 
 @app.route('/<user_id>/delete_notebook', methods=['POST'])
@@ -184,36 +153,49 @@ def delete_notebook(user_id):
     """Deletes a notebook from a user's session."""
     data = request.json
     notebook_id = data.get('notebookId')
-    if not notebook_id or user_id not in user_sessions or notebook_id not in user_sessions[user_id]:
+    if not notebook_id or not user_sessions.delete(user_id, notebook_id):
         return jsonify({"error": "Notebook not found."}), 404
-    del user_sessions[user_id][notebook_id]
     return jsonify({"message": "Notebook deleted successfully."})
 
 
+@app.route('/sessions/stats', methods=['GET'])
+def session_stats():
+    """Returns the number of active sessions and of sessions expired so far."""
+    return jsonify(user_sessions.stats())
+
+
 @app.route('/')
 def home():
     return "welcome to main page"
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, url_for, Response, stream_with_context, g
 from flask_cors import CORS
-import sys
 import io
+import sys
 import os
-import contextlib
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import base64
 import time
-import traceback
-import re
+import contextlib
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 from dotenv import load_dotenv
+import re
 import json
-import tempfile
-import dill  # Use dill for serialization
+import gzip
+import mimetypes
+from urllib.parse import quote
+from kernel_pool import KernelPool, KernelError, KernelTimeout, EXECUTION_KILL_AFTER
+from namespace_cache import NamespaceCache
+from storage import NotebookStore, CommandMetrics
+from image_store import create_image_store, image_name, IMAGE_NAME
+from job_queue import JobQueue, QueueFull, QUEUED, RUNNING, FAILED
+from dependency_graph import DependencyGraph, cell_names
+from snapshots import SnapshotStore
+from ipynb import export_chunks, gzip_chunks, read_ipynb
+from profiling import parse_profile, stage, stage_stats, timed_request
+from serializer import serializer
+import metrics
 
 # Load environment variables from .env file
 load_dotenv()
@@ -221,61 +203,84 @@ load_dotenv()
 app = Flask(__name__)
 CORS(app)
 
+# Fork the kernel template before any MongoDB sockets or threads exist
+kernel_pool = KernelPool()
+
 # Connect to MongoDB Atlas
 MONGO_URI = os.getenv("MONGO_URI")
 if not MONGO_URI:
     raise ValueError("MONGO_URI is not set in .env file")
 
-client = MongoClient(MONGO_URI)
+client = MongoClient(MONGO_URI, event_listeners=[CommandMetrics()])
 db = client["NotebookDB"]
-user_sessions = db["user_sessions"]
-
-class CodeExecutor:
-    def __init__(self, timeout=10):
-        self.timeout = timeout
-
-    def remove_comments(self, code):
-        code = re.sub(r'\#.*', '', code)
-        code = re.sub(r'""".*?"""', '', code, flags=re.DOTALL)
-        code = re.sub(r"'''.*?'''", '', code, flags=re.DOTALL)
-        return code
-    
-    def capture_output(self, code, session_globals):
-        output = io.StringIO()
-        error = None
-        images = []
-        
-        code_without_comments = self.remove_comments(code)
-        if "input(" in code_without_comments:
-            return {"text": "", "error": "User input is disabled.", "images": None}
-        
-        def save_plot():
-            try:
-                buf = io.BytesIO()
-                plt.savefig(buf, format='png', bbox_inches='tight', pad_inches=0.2)
-                plt.close('all')
-                buf.seek(0)
-                return f"data:image/png;base64,{base64.b64encode(buf.getvalue()).decode()}"
-            except Exception as e:
-                return None
-        
-        try:
-            with contextlib.redirect_stdout(output):
-                try:
-                    exec(code, session_globals)
-                    if plt.get_fignums():
-                        img = save_plot()
-                        if img:
-                            images.append(img)
-                except Exception as e:
-                    error = str(e)
-                    traceback.print_exc(file=output)
-        except Exception as e:
-            error = f"Execution error: {str(e)}"
-        
-        return {"text": output.getvalue(), "error": error, "images": images if images else None}
-
-executor = CodeExecutor()
+store = NotebookStore(db)
+store.ensure_indexes()
+NOTEBOOK_PAGE_SIZE = 50
+NOTEBOOK_PAGE_SIZE_MAX = 200
+
+# Plots are stored once by content hash and referenced from cells by name
+image_store = create_image_store(db)
+IMAGE_MAX_AGE = 31536000  # Image URLs never change content, let clients cache them for a year
+
+def save_namespace(notebook_id, changes):
+    for variable in changes["changed"].values():
+        metrics.namespace_variable_bytes.observe(len(variable["data"]), codec=serializer.codec_name(variable["data"]))
+    store.save_namespace(notebook_id, changes)
+
+# Notebook globals stay in their kernels and are only written back when evicted, checkpointed or idle
+namespace_cache = NamespaceCache(kernel_pool, store.load_namespace, save_namespace)
+
+# Forked copies of notebook kernels, to roll back to or duplicate without serializing globals
+snapshot_store = SnapshotStore()
+
+def store_images(result):
+    """Moves rendered plots out of a kernel's execution result into the image store, leaving their names."""
+    metrics.cell_results.inc(error_type=result.get("error_type") or "none")
+    if result.get("images"):
+        for data, mime in result["images"]:
+            metrics.images_rendered.inc(mime=mime)
+            metrics.image_bytes.inc(len(data), mime=mime)
+        result["images"] = [image_store.put(data, mime) for data, mime in result["images"]]
+    if result.get("plots"):
+        metrics.plot_render_duration.observe(result["plots"]["render_time"])
+    return result
+
+def killed_result(error, rolled_back=False):
+    """The result of a cell whose kernel had to be killed, in the same shape as any other result."""
+    metrics.cell_results.inc(error_type="killed")
+    if rolled_back:
+        error = f"{error} Variables were rolled back to their state before the cell."
+    else:
+        error = f"{error} The kernel was restarted, variables changed since the last save were lost."
+    return {"text": "", "error": error, "error_type": "killed", "images": None}
+
+def restore_snapshot(notebook_id, snapshot):
+    """Makes a fork of the snapshot the notebook's kernel, the snapshot itself stays available.
+
+    Call inside namespace_cache.use() for the notebook.
+    """
+    kernel = snapshot["kernel"].fork(reseed=False)
+    kernel_pool.bind(notebook_id, kernel)
+    # Saves made after the snapshot are undone by the next save
+    kernel.call("assume_saved", store.load_variable_hashes(notebook_id))
+    namespace_cache.mark_dirty(notebook_id)
+    return kernel
+
+def dependency_graph(notebook_id):
+    """Builds the notebook's dependency graph, storing names for cells saved before they were tracked."""
+    cells = store.load_dependency_cells(notebook_id)
+    missing = {cell["cell_id"]: cell_names(cell["code"]) for cell in cells if "defines" not in cell}
+    store.set_cell_names(notebook_id, missing)
+    return DependencyGraph([dict(cell, **missing.get(cell["cell_id"], {})) for cell in cells])
+
+def with_image_urls(output):
+    """Returns a copy of a cell output with stored image names turned into /images URLs."""
+    if not output or not output.get("images"):
+        return output
+    return dict(output, images=[
+        url_for('get_image', name=image, _external=True) if IMAGE_NAME.match(image) else image  # Older cells hold data: URLs
+        for image in output["images"]
+    ])
 
 # @app.route('/<user_id>', methods=['GET'])
 # def get_user_notebooks(user_id):
@@ -293,52 +298,36 @@ executor = CodeExecutor()
 
 @app.route('/<user_id>', methods=['GET'])
 def get_user_notebooks(user_id):
-    # Fetch fresh data from MongoDB
-    user_data = user_sessions.find_one({"user_id": user_id})
-    
-    # If the user has no remaining notebooks, return an empty list
-    if not user_data or "notebooks" not in user_data:
-        return jsonify({"notebooks": []})
-
-    # Extract only notebook_name and notebook_id
-    notebooks_in = [
-        {"notebook_id": nb["notebook_id"], "notebook_name": nb["notebook_name"]}
-        for nb in user_data.get("notebooks", [])
-    ]
+    # Page through the user's notebooks, most recently modified first
+    try:
+        limit = min(max(int(request.args.get('limit', NOTEBOOK_PAGE_SIZE)), 1), NOTEBOOK_PAGE_SIZE_MAX)
+        notebooks_in, next_cursor = store.list_notebooks(user_id, limit, request.args.get('cursor'))
+    except ValueError:
+        return jsonify({"error": "Invalid limit or cursor."}), 400
 
-    return jsonify({"notebooks": notebooks_in})
+    return jsonify({"notebooks": notebooks_in, "next_cursor": next_cursor})
 
 
 @app.route('/<user_id>/create_notebook', methods=['POST'])
 def create_notebook(user_id):
     """Creates a new notebook and initializes the globals dictionary."""
     data = request.json
-    notebook_name = data.get("name", f"Notebook_{user_id}_{int(time.time())}")
+    # Nanoseconds, so notebooks created in the same second get distinct ids and default names
+    created = time.time_ns()
+    notebook_name = data.get("name", f"Notebook_{user_id}_{created}")
     
     # Check if the notebook name already exists for the user
-    user_data = user_sessions.find_one({"user_id": user_id})
-    if user_data:
-        for notebook in user_data.get("notebooks", []):
-            if notebook["notebook_name"] == notebook_name:
-                return jsonify({"error": "Notebook name already exists."}), 400
+    if store.notebook_name_exists(user_id, notebook_name):
+        return jsonify({"error": "Notebook name already exists."}), 400
     
     # Generate a unique notebook ID
-    notebook_id = f"notebook_{user_id}_{int(time.time())}"
-    
-    # Create the new notebook with an initialized globals dictionary
-    new_notebook = {
-        "notebook_id": notebook_id,
-        "notebook_name": notebook_name,
-        "cells": [],
-        "globals": {}  # Initialize without __builtins__
-    }
+    notebook_id = f"notebook_{user_id}_{created}"
     
-    # Update the user's notebooks in the database
-    user_sessions.update_one(
-        {"user_id": user_id},
-        {"$push": {"notebooks": new_notebook}},
-        upsert=True
-    )
+    # Create the new notebook, its globals start empty in its kernel
+    try:
+        store.create_notebook(user_id, notebook_id, notebook_name)
+    except DuplicateKeyError:
+        return jsonify({"error": "Notebook name already exists."}), 400
     return jsonify({"notebookId": notebook_id, "name": notebook_name})
 
 # @app.route('/<user_id>/<notebook_id>', methods=['GET'])
@@ -427,86 +416,458 @@ def create_notebook(user_id):
 
 @app.route('/<user_id>/<notebook_id>/execute', methods=['POST'])
 def execute_code(user_id, notebook_id):
+    """Executes code as a new cell. With profile, the output carries a profile and the response the request's stage timings."""
+    with timed_request() as timings:
+        with stage("request_parse"):
+            data = request.json
+        code = data.get('code', '')
+        if not code:
+            return jsonify({"error": "Code is required."}), 400
+        try:
+            profile = parse_profile(data.get('profile'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # Fetch only the notebook's metadata, its cells live in their own collection
+        with stage("db_load"):
+            notebook = store.get_notebook(user_id, notebook_id)
+        if not notebook:
+            return jsonify({"error": "Notebook not found."}), 404
+        
+        try:
+            new_cell = run_cell(notebook_id, code, rollback_on_error=bool(data.get('rollback_on_error')), profile=profile)
+        except KernelError as e:
+            return jsonify({"error": f"Kernel error: {e}"}), 500
+    
+    response = with_image_urls(new_cell["output"])
+    if profile is not None:
+        response["stages"] = timings
+    return jsonify(response)
+
+def run_cell(notebook_id, code, rollback_on_error=False, profile=None, job=None):
+    """Executes code in the notebook's kernel and appends it as a new cell, returns the cell.
+
+    With rollback_on_error, the kernel is forked before the cell runs and the
+    notebook goes back to that fork if the cell fails. For a job, the cell is
+    skipped with JobCancelled if the job was cancelled before it got the kernel.
+    """
+    # The kernel keeps the notebook's globals between cells
+    try:
+        with namespace_cache.use(notebook_id) as kernel:
+            snapshot = snapshot_store.take(notebook_id, kernel, listed=False) if rollback_on_error else None
+            try:
+                try:
+                    start = time.perf_counter()
+                    with stage("exec"), executing(job):
+                        result = kernel.call("execute", code, profile=profile, kill_after=EXECUTION_KILL_AFTER)
+                    metrics.execution_duration.observe(time.perf_counter() - start, mode="cell")
+                    result = store_images(result)
+                    namespace_cache.mark_dirty(notebook_id)
+                except KernelTimeout as e:
+                    if snapshot is None:
+                        raise
+                    result = killed_result(str(e), rolled_back=True)
+                if snapshot and result["error"]:
+                    restore_snapshot(notebook_id, snapshot)
+                    result["rolled_back"] = True
+            finally:
+                if snapshot:
+                    snapshot["kernel"].shutdown()
+    except KernelTimeout as e:
+        namespace_cache.discard(notebook_id)
+        result = killed_result(str(e))
+    except KernelError:
+        namespace_cache.discard(notebook_id)
+        raise
+    
+    # Append the new cell, changed variables are saved later by the namespace cache
+    with stage("db_write"):
+        return store.append_cell(notebook_id, {
+            "cell_id": f"cell_{time.time_ns()}",
+            "cell_type": "code",
+            "code": code,
+            "output": result,
+            **cell_names(code)
+        })
+
+def run_job(job):
+    metrics.job_queue_wait.observe(job["started_at"] - job["created_at"])
+    with timed_request() as timings:
+        with stage("db_load"):
+            notebook = store.get_notebook(job["user_id"], job["notebook_id"])
+        if not notebook:
+            raise LookupError("Notebook not found.")
+        if job["kind"] == "run_all":
+            status = None
+            cells = store.load_code_cells(job["notebook_id"])
+            if cells:
+                for event, data in run_cells(job["notebook_id"], cells, profile=job["profile"], job=job):
+                    if event == "status":
+                        status = data
+                    elif event == "cell" and job.get("cancel_requested"):
+                        # The cancel may have reached the kernel before the batch started, the batch still runs here
+                        interrupt_job(job)
+            return {"run": status}
+        new_cell = run_cell(job["notebook_id"], job["code"], profile=job["profile"], job=job)
+    result = {"cell_id": new_cell["cell_id"], "output": new_cell["output"]}
+    if job["profile"] is not None:
+        result["stages"] = timings
+    return result
+
+def interrupt_job(job):
+    # Only called while the job holds the notebook and its cell runs, see JobQueue.executing
+    kernel = kernel_pool.get(job["notebook_id"])
+    if kernel is not None:
+        kernel.interrupt()
+
+# Background execution, so long cells do not hold an HTTP worker or connection
+job_queue = JobQueue(run_job, interrupt_job)
+
+def executing(job):
+    return job_queue.executing(job) if job else contextlib.nullcontext()
+
+def job_status(job):
+    return {
+        "job_id": job["job_id"],
+        "notebook_id": job["notebook_id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"]
+    }
+
+@app.route('/<user_id>/<notebook_id>/jobs', methods=['POST'])
+def submit_job(user_id, notebook_id):
+    """Queues code for execution and returns a job id to poll instead of waiting for the cell."""
     data = request.json
     code = data.get('code', '')
     if not code:
         return jsonify({"error": "Code is required."}), 400
+    try:
+        profile = parse_profile(data.get('profile'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
-    # Fetch the user's data from MongoDB
-    user_data = user_sessions.find_one({"user_id": user_id})
-    if not user_data:
-        return jsonify({"error": "User not found."}), 404
-    
-    # Find the notebook in the user's data
-    notebook = next((nb for nb in user_data["notebooks"] if nb["notebook_id"] == notebook_id), None)
-    if not notebook:
+    if not store.get_notebook(user_id, notebook_id):
         return jsonify({"error": "Notebook not found."}), 404
     
-    # Get the notebook's globals (or initialize if it doesn't exist)
-    if "globals_serialized" in notebook:
-        notebook["globals"] = dill.loads(notebook["globals_serialized"])
-    else:
-        notebook["globals"] = {}  # Initialize globals as empty
+    try:
+        job = job_queue.submit(user_id, notebook_id, code, profile=profile)
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 429
+    return jsonify(job_status(job)), 202
+
+@app.route('/<user_id>/jobs/<job_id>', methods=['GET'])
+def get_job(user_id, job_id):
+    job = job_queue.get(user_id, job_id)
+    if not job:
+        return jsonify({"error": "Job not found."}), 404
+    return jsonify(job_status(job))
+
+@app.route('/<user_id>/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(user_id, job_id):
+    """Returns the job's cell output, or the status of a run_all job, once it has finished.
+
+    Jobs that have not finished get their status with 202.
+    """
+    job = job_queue.get(user_id, job_id)
+    if not job:
+        return jsonify({"error": "Job not found."}), 404
+    if job["status"] in (QUEUED, RUNNING):
+        return jsonify(job_status(job)), 202
     
-    # Add __builtins__ to the globals for execution
-    execution_globals = notebook["globals"].copy()
-    execution_globals["__builtins__"] = __builtins__
+    response = job_status(job)
+    if job["status"] == FAILED:
+        response["error"] = job["error"]
+    if job["result"] and "run" in job["result"]:
+        response["run"] = job["result"]["run"]
+    elif job["result"]:
+        response["cell_id"] = job["result"]["cell_id"]
+        response["output"] = with_image_urls(job["result"]["output"])
+        if "stages" in job["result"]:
+            response["stages"] = job["result"]["stages"]
+    return jsonify(response)
+
+@app.route('/<user_id>/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(user_id, job_id):
+    """Removes a queued job, or interrupts a running one keeping the notebook's globals."""
+    job = job_queue.cancel(user_id, job_id)
+    if not job:
+        return jsonify({"error": "Job not found."}), 404
+    return jsonify(job_status(job))
+
+def run_cells(notebook_id, cells, stop_on_error=False, restart=False, profile=None, job=None):
+    """Runs stored code cells in one kernel call, yielding (event, data) as they run.
+
+    Events are stdout chunks and each cell's output as it finishes (with
+    stored image names), then a final status. Outputs are written in one bulk write and the globals
+    checkpointed when the run ends, or when the generator is closed early. Closing it early also
+    interrupts the batch, the cells after the running one do not run. For a job, see run_cell.
+    """
+    outputs = {}  # cell_id -> output, in run order
+    saved = False
     
-    # Execute the code in the notebook's globals
-    result = executor.capture_output(code, execution_globals)
+    def record(payload):
+        index, result = payload
+        result = store_images(result)
+        outputs[cells[index]["cell_id"]] = result
+        return cells[index]["cell_id"], result
     
-    # Remove __builtins__ before saving to MongoDB
-    if "__builtins__" in execution_globals:
-        del execution_globals["__builtins__"]
+    def save_outputs():
+        # Every output in one bulk write, then the globals in one more
+        store.update_outputs(notebook_id, outputs)
+        try:
+            namespace_cache.checkpoint(notebook_id)
+        except KernelError as e:
+            print(f"Error saving globals for {notebook_id}: {e}")
     
-    # Serialize the globals dictionary for storage in MongoDB
-    globals_serialized = dill.dumps(execution_globals)
+    try:
+        try:
+            with namespace_cache.use(notebook_id) as kernel:
+                if restart:
+                    kernel.call("reset")
+                start = time.perf_counter()
+                with executing(job):
+                    stream = kernel.stream(
+                        "execute_batch", [cell["code"] for cell in cells],
+                        stop_on_error=stop_on_error, stream=True, profile=profile,
+                        kill_after=EXECUTION_KILL_AFTER * len(cells) if EXECUTION_KILL_AFTER else None
+                    )
+                    try:
+                        for kind, value in stream:
+                            if kind == "result":
+                                metrics.execution_duration.observe(time.perf_counter() - start, mode="batch")
+                                continue
+                            name, payload = value
+                            if name == "cell_result":
+                                cell_id, result = record(payload)
+                                yield "cell", {"cell_id": cell_id, "output": result}
+                            else:
+                                yield name, {"cell_id": cells[len(outputs)]["cell_id"], "text": payload}
+                    except GeneratorExit:
+                        # The client went away, stop the batch instead of running the rest with no output
+                        # kept, and save the cells that did run, the interrupted one included
+                        kernel.interrupt()
+                        try:
+                            for kind, value in stream:
+                                if kind == "stream" and value[0] == "cell_result":
+                                    record(value[1])
+                        except KernelError:
+                            namespace_cache.discard(notebook_id)
+                        raise
+                    finally:
+                        stream.close()
+                        namespace_cache.mark_dirty(notebook_id)
+        except KernelTimeout as e:
+            namespace_cache.discard(notebook_id)
+            cell_id = cells[len(outputs)]["cell_id"]
+            outputs[cell_id] = killed_result(str(e))
+            yield "cell", {"cell_id": cell_id, "output": outputs[cell_id]}
+        except KernelError as e:
+            namespace_cache.discard(notebook_id)
+            yield "status", {"status": "error", "error": f"Kernel error: {e}", "executed": len(outputs)}
+            return
+        
+        save_outputs()
+        saved = True
+        errors = sum(1 for output in outputs.values() if output["error"])
+        yield "status", {
+            "status": "error" if errors else "ok",
+            "executed": len(outputs),
+            "errors": errors,
+            "stopped": len(outputs) < len(cells)
+        }
+    finally:
+        # Also reached when the client disconnects mid-run, keep what already ran
+        if not saved:
+            save_outputs()
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/<user_id>/<notebook_id>/execute_stream', methods=['POST'])
+def execute_code_stream(user_id, notebook_id):
+    """Executes code like /execute, but sends output as server-sent events while the cell runs.
+
+    Events are stdout chunks, then image URLs, then a final status with the
+    saved cell's id. Output beyond MAX_OUTPUT_CHARS, or CELL_OUTPUT_MAX_CHARS for the
+    whole cell, is truncated in the kernel. A client that disconnects does not
+    stop the cell, it is saved with its output as usual.
+    """
+    data = request.json
+    code = data.get('code', '')
+    if not code:
+        return jsonify({"error": "Code is required."}), 400
+    try:
+        profile = parse_profile(data.get('profile'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
-    # Create a new cell with the code and output
-    new_cell = {
-        "cell_id": f"cell_{int(time.time())}",
-        "cell_type": "code",
-        "code": code,
-        "output": result
-    }
+    notebook = store.get_notebook(user_id, notebook_id)
+    if not notebook:
+        return jsonify({"error": "Notebook not found."}), 404
     
-    # Update the notebook in the database:
-    # 1. Add the new cell to the notebook's cells
-    # 2. Update the notebook's serialized globals
-    user_sessions.update_one(
-        {"user_id": user_id, "notebooks.notebook_id": notebook_id},
-        {
-            "$push": {"notebooks.$.cells": new_cell},
-            "$set": {"notebooks.$.globals_serialized": globals_serialized}
-        }
+    def events():
+        result = None
+        connected = True
+        try:
+            with namespace_cache.use(notebook_id) as kernel:
+                start = time.perf_counter()
+                stream = kernel.stream("execute", code, stream=True, profile=profile, kill_after=EXECUTION_KILL_AFTER)
+                try:
+                    for kind, value in stream:
+                        if kind == "result":
+                            result = value
+                            metrics.execution_duration.observe(time.perf_counter() - start, mode="stream")
+                        elif connected:
+                            name, text = value
+                            try:
+                                yield sse(name, {"text": text})
+                            except GeneratorExit:
+                                # The client went away, the cell still finishes and is saved like any other
+                                connected = False
+                finally:
+                    stream.close()
+                    namespace_cache.mark_dirty(notebook_id)
+        except KernelTimeout as e:
+            namespace_cache.discard(notebook_id)
+            result = killed_result(str(e))
+        except KernelError as e:
+            namespace_cache.discard(notebook_id)
+            if connected:
+                yield sse("status", {"status": "error", "error": f"Kernel error: {e}"})
+            return
+        
+        store_images(result)
+        new_cell = store.append_cell(notebook_id, {
+            "cell_id": f"cell_{time.time_ns()}",
+            "cell_type": "code",
+            "code": code,
+            "output": result,
+            **cell_names(code)
+        })
+        if not connected:
+            return
+        
+        for url in with_image_urls(result).get("images") or []:
+            yield sse("image", {"url": url})
+        for display in result.get("displays") or []:
+            yield sse("display", display)
+        yield sse("status", {
+            "status": "error" if result["error"] else "ok",
+            "error": result["error"],
+            "error_type": result.get("error_type"),
+            "cell_id": new_cell["cell_id"],
+            "profile": result.get("profile")
+        })
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
+
+@app.route('/<user_id>/<notebook_id>/run_all', methods=['POST'])
+def run_all(user_id, notebook_id):
+    """Re-runs the notebook's code cells in one kernel call, sending each cell's output as server-sent events.
+
+    The body may give cell_ids to run in that order, start and end ordinals
+    for a range, or downstream_of to run a cell and every later cell that
+    depends on it; otherwise every code cell runs. With restart the
+    globals are cleared first, with stop_on_error the run stops at the first
+    failing cell, with profile every cell's output carries a profile.
+    Outputs and globals are written once, when the run ends. A client that
+    disconnects stops the run at the cell running then.
+    """
+    data = request.json or {}
+    cell_ids = data.get('cell_ids')
+    start, end = data.get('start'), data.get('end')
+    if cell_ids is not None and not (isinstance(cell_ids, list) and all(isinstance(c, str) for c in cell_ids)):
+        return jsonify({"error": "cell_ids must be a list of cell ids."}), 400
+    if any(v is not None and (not isinstance(v, int) or isinstance(v, bool)) for v in (start, end)):
+        return jsonify({"error": "start and end must be integers."}), 400
+    stop_on_error = bool(data.get('stop_on_error', False))
+    restart = bool(data.get('restart', False))
+    try:
+        profile = parse_profile(data.get('profile'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
-    return jsonify(result)
+    notebook = store.get_notebook(user_id, notebook_id)
+    if not notebook:
+        return jsonify({"error": "Notebook not found."}), 404
+    if data.get('downstream_of'):
+        graph = dependency_graph(notebook_id)
+        cell_id = data['downstream_of']
+        if cell_id not in graph.index:
+            return jsonify({"error": "Cell not found."}), 404
+        cell_ids = [cell_id] + graph.downstream(cell_id, graph.cells[graph.index[cell_id]]["defines"])
+    cells = store.load_code_cells(notebook_id, cell_ids, start, end)
+    if not cells:
+        return jsonify({"error": "No code cells to run."}), 400
+    
+    def events():
+        with contextlib.closing(run_cells(notebook_id, cells, stop_on_error, restart, profile)) as run:
+            for event, data in run:
+                if event == "cell":
+                    data = dict(data, output=with_image_urls(data["output"]))
+                yield sse(event, data)
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route('/<user_id>/<notebook_id>/update_cell', methods=['POST'])
+def update_cell(user_id, notebook_id):
+    """Saves a cell's edited code and returns the later cells that depend on what it defines.
+
+    The stale cells can be re-run, with the edited cell, through run_all with
+    downstream_of set to the cell.
+    """
+    data = request.json
+    cell_id = data.get('cell_id')
+    code = data.get('code')
+    if not cell_id or code is None:
+        return jsonify({"error": "Cell ID and code are required."}), 400
+    
+    if not store.get_notebook(user_id, notebook_id):
+        return jsonify({"error": "Notebook not found."}), 404
+    cell = store.get_cell(notebook_id, cell_id)
+    if not cell:
+        return jsonify({"error": "Cell not found."}), 404
+    if cell["cell_type"] != "code":
+        store.update_cell(notebook_id, cell_id, {"code": code})
+        return jsonify({"cell_id": cell_id, "stale": []})
+    
+    # Cells reading what the old or the new code defines may now see different values
+    names = cell_names(code)
+    old_defines = cell["defines"] if "defines" in cell else cell_names(cell["code"])["defines"]
+    changed = set(old_defines) | set(names["defines"])
+    store.update_cell(notebook_id, cell_id, dict(names, code=code))
+    stale = dependency_graph(notebook_id).downstream(cell_id, changed)
+    return jsonify({"cell_id": cell_id, "stale": stale})
 
 @app.route('/<user_id>/<notebook_id>', methods=['GET'])
 def load_notebook(user_id, notebook_id):
     """Loads a specific notebook and ensures globals are properly initialized."""
-    # Fetch the user's data from MongoDB
-    user_data = user_sessions.find_one({"user_id": user_id})
-    if not user_data:
-        return jsonify({"error": "User not found."}), 404
-    
-    # Find the notebook in the user's data
-    notebook = next((nb for nb in user_data["notebooks"] if nb["notebook_id"] == notebook_id), None)
+    # Fetch only the notebook's metadata, its cells live in their own collection
+    notebook = store.get_notebook(user_id, notebook_id)
     if not notebook:
         return jsonify({"error": "Notebook not found."}), 404
     
-    # Deserialize the globals dictionary if it exists
-    if "globals_serialized" in notebook:
-        notebook["globals"] = cloudpickle.loads(notebook["globals_serialized"])
-    else:
-        notebook["globals"] = {}  # Initialize globals as empty
+    # Warm up the notebook's kernel so the first cell does not pay for restoring globals
+    try:
+        with namespace_cache.use(notebook_id):
+            pass
+    except KernelError as e:
+        return jsonify({"error": f"Kernel error: {e}"}), 500
     
-    # Add __builtins__ to the globals for execution
-    notebook["globals"]["__builtins__"] = __builtins__
-    
-    # Return the notebook's cells
-    return jsonify({"cells": notebook["cells"]})
+    # Return the notebook's cells, with images as URLs instead of inline bytes
+    cells = [dict(cell, output=with_image_urls(cell.get("output"))) for cell in store.load_cells(notebook_id)]
+    return jsonify({"cells": cells})
 
 
 @app.route('/<user_id>/<notebook_id>/save_markdown', methods=['POST'])
@@ -517,111 +878,242 @@ def save_markdown(user_id, notebook_id):
     if not markdown_content:
         return jsonify({"error": "Markdown content is required."}), 400
     
-    # Fetch the user's data from MongoDB
-    user_data = user_sessions.find_one({"user_id": user_id})
-    if not user_data:
-        return jsonify({"error": "User not found."}), 404
-    
-    # Find the notebook in the user's data
-    notebook = next((nb for nb in user_data["notebooks"] if nb["notebook_id"] == notebook_id), None)
+    # Fetch only the notebook's metadata, its cells live in their own collection
+    notebook = store.get_notebook(user_id, notebook_id)
     if not notebook:
         return jsonify({"error": "Notebook not found."}), 404
     
     # Create a new markdown cell
     new_cell = {
-        "cell_id": f"cell_{int(time.time())}",
+        "cell_id": f"cell_{time.time_ns()}",
         "cell_type": "markdown",
         "code": markdown_content,  # Store markdown content in the 'code' field
         "output": {"text": "", "error": None, "images": None}  # No output for markdown cells
     }
     
-    # Update the notebook in the database:
-    # Add the new markdown cell to the notebook's cells
-    user_sessions.update_one(
-        {"user_id": user_id, "notebooks.notebook_id": notebook_id},
-        {"$push": {"notebooks.$.cells": new_cell}}
-    )
+    # Append the new markdown cell to the notebook's cells
+    store.append_cell(notebook_id, new_cell)
     
     return jsonify({"message": "Markdown cell saved successfully."})
 
-@app.route('/<user_id>/<notebook_id>/export', methods=['GET'])
-def export_notebook(user_id, notebook_id):
-    """Exports a notebook as an .ipynb file."""
-    # Fetch the user's data from MongoDB
-    user_data = user_sessions.find_one({"user_id": user_id})
-    if not user_data:
-        return jsonify({"error": "User not found."}), 404
-    
-    # Find the notebook in the user's data
-    notebook = next((nb for nb in user_data["notebooks"] if nb["notebook_id"] == notebook_id), None)
+@app.route('/<user_id>/<notebook_id>/checkpoint', methods=['POST'])
+def checkpoint_notebook(user_id, notebook_id):
+    """Saves the notebook's in-memory globals to the database right away."""
+    if not store.get_notebook(user_id, notebook_id):
+        return jsonify({"error": "Notebook not found."}), 404
+
+    try:
+        saved = namespace_cache.checkpoint(notebook_id)
+    except KernelError as e:
+        return jsonify({"error": f"Kernel error: {e}"}), 500
+    return jsonify({
+        "message": "Checkpoint saved." if saved else "Nothing to save.",
+        "skipped": namespace_cache.skipped(notebook_id)  # Variables that could not be stored, with the reason
+    })
+
+@app.route('/<user_id>/<notebook_id>/snapshots', methods=['POST'])
+def take_snapshot(user_id, notebook_id):
+    """Forks the notebook's kernel into a snapshot its globals can be restored from instantly."""
+    if not store.get_notebook(user_id, notebook_id):
+        return jsonify({"error": "Notebook not found."}), 404
+    
+    label = (request.json or {}).get('label')
+    try:
+        with namespace_cache.use(notebook_id) as kernel:
+            snapshot = snapshot_store.take(notebook_id, kernel, label)
+    except KernelError as e:
+        return jsonify({"error": f"Kernel error: {e}"}), 500
+    return jsonify(snapshot_store.describe(snapshot))
+
+@app.route('/<user_id>/<notebook_id>/snapshots', methods=['GET'])
+def list_snapshots(user_id, notebook_id):
+    if not store.get_notebook(user_id, notebook_id):
+        return jsonify({"error": "Notebook not found."}), 404
+    return jsonify({"snapshots": snapshot_store.list(notebook_id)})
+
+@app.route('/<user_id>/<notebook_id>/snapshots/<snapshot_id>/restore', methods=['POST'])
+def restore_notebook_snapshot(user_id, notebook_id, snapshot_id):
+    """Puts the notebook's globals back to a snapshot. Cells are left as they are."""
+    if not store.get_notebook(user_id, notebook_id):
+        return jsonify({"error": "Notebook not found."}), 404
+    snapshot = snapshot_store.get(notebook_id, snapshot_id)
+    if not snapshot:
+        return jsonify({"error": "Snapshot not found."}), 404
+    
+    try:
+        with namespace_cache.use(notebook_id):
+            restore_snapshot(notebook_id, snapshot)
+    except KernelError as e:
+        return jsonify({"error": f"Kernel error: {e}"}), 500
+    return jsonify({"message": "Snapshot restored."})
+
+@app.route('/<user_id>/<notebook_id>/snapshots/<snapshot_id>', methods=['DELETE'])
+def delete_snapshot(user_id, notebook_id, snapshot_id):
+    if not store.get_notebook(user_id, notebook_id):
+        return jsonify({"error": "Notebook not found."}), 404
+    if not snapshot_store.delete(notebook_id, snapshot_id):
+        return jsonify({"error": "Snapshot not found."}), 404
+    return jsonify({"message": "Snapshot deleted."})
+
+@app.route('/<user_id>/<notebook_id>/duplicate', methods=['POST'])
+def duplicate_notebook(user_id, notebook_id):
+    """Copies a notebook with its cells and its live globals, forking the kernel instead of reloading them."""
+    notebook = store.get_notebook(user_id, notebook_id)
     if not notebook:
         return jsonify({"error": "Notebook not found."}), 404
     
-    # Prepare the cells for the .ipynb file
-    cells = []
-    for cell in notebook["cells"]:
-        if cell["cell_type"] == "code":
-            cell_data = {
-                "cell_type": "code",
-                "execution_count": None,  # Execution count is not tracked in this implementation
-                "metadata": {},
-                "source": cell["code"].splitlines(True),  # Split code into lines
-                "outputs": []
-            }
-            
-            # Add output if available
-            if cell["output"]:
-                output_data = {
-                    "name": "stdout",
-                    "output_type": "stream",
-                    "text": cell["output"]["text"].splitlines(True)  # Split output into lines
-                }
-                cell_data["outputs"].append(output_data)
-        elif cell["cell_type"] == "markdown":
-            cell_data = {
-                "cell_type": "markdown",
-                "metadata": {},
-                "source": cell["code"].splitlines(True)  # Split markdown into lines
-            }
+    notebook_name = (request.json or {}).get("name") or f"{notebook['notebook_name']} (copy)"
+    if store.notebook_name_exists(user_id, notebook_name):
+        return jsonify({"error": "Notebook name already exists."}), 400
+    new_notebook_id = f"notebook_{user_id}_{time.time_ns()}"
+    
+    try:
+        # Hold the source's lock so no save lands between the fork and the copy of its variables
+        with namespace_cache.use(notebook_id) as kernel:
+            new_kernel = kernel.fork(reseed=False)
+            try:
+                store.duplicate_notebook(user_id, notebook_id, new_notebook_id, notebook_name)
+            except Exception:
+                new_kernel.shutdown()
+                raise
+        # Unsaved changes of the source come along and are saved for the copy
+        namespace_cache.adopt(new_notebook_id, new_kernel)
+    except DuplicateKeyError:
+        return jsonify({"error": "Notebook name already exists."}), 400
+    except KernelError as e:
+        return jsonify({"error": f"Kernel error: {e}"}), 500
+    return jsonify({"notebookId": new_notebook_id, "name": notebook_name})
+
+@app.route('/<user_id>/import_notebook', methods=['POST'])
+def import_notebook(user_id):
+    """Creates a notebook from an uploaded .ipynb (or .ipynb.gz) with all its cells in one write.
+
+    The file is the "file" field of a multipart form, or the request body
+    itself. Outputs and plots in the file are kept. With run, the imported
+    code cells are queued to run as a background job, whose id is returned.
+    """
+    # Only a multipart body is parsed as a form, any other body is the file itself
+    upload = request.files.get('file') if request.mimetype == 'multipart/form-data' else None
+    filename = upload.filename if upload else request.args.get('filename', '')
+    # Buffered, as werkzeug takes the zero-byte read ijson starts with for a disconnect
+    stream = upload.stream if upload else io.BufferedReader(request.stream)
+    if filename.endswith('.gz') or request.mimetype == 'application/gzip':
+        stream = gzip.GzipFile(fileobj=stream)
+    options = request.form if upload else request.args
+    notebook_name = options.get('name') or re.sub(r'\.ipynb(\.gz)?$', '', filename) or f"Notebook_{user_id}_{time.time_ns()}"
+    if store.notebook_name_exists(user_id, notebook_name):
+        return jsonify({"error": "Notebook name already exists."}), 400
+    
+    # Images this import added to the store, removed again if the import is rejected
+    added_images = []
+    def put_image(data, mime):
+        name = image_name(data, mime)
+        if name not in added_images and not image_store.exists(name):
+            added_images.append(name)
+        return image_store.put(data, mime)
+    def discard_images():
+        for name in added_images:
+            try:
+                image_store.delete(name)
+            except Exception as e:
+                print(f"Error deleting image {name}: {e}")
+    
+    try:
+        cells = read_ipynb(stream, put_image)
+        first_id = time.time_ns()
+        for index, cell in enumerate(cells):
+            cell["cell_id"] = f"cell_{first_id + index}"
+            if cell["cell_type"] == "code":
+                cell.update(cell_names(cell["code"]))
         
-        cells.append(cell_data)
-    
-    # Create the .ipynb structure
-    ipynb_data = {
-        "cells": cells,
-        "metadata": {
-            "kernelspec": {
-                "display_name": "Python 3",
-                "language": "python",
-                "name": "python3"
-            },
-            "language_info": {
-                "codemirror_mode": {
-                    "name": "ipython",
-                    "version": 3
-                },
-                "file_extension": ".py",
-                "mimetype": "text/x-python",
-                "name": "python",
-                "nbconvert_exporter": "python",
-                "pygments_lexer": "ipython3",
-                "version": "3.x"
-            }
-        },
-        "nbformat": 4,
-        "nbformat_minor": 5
-    }
+        notebook_id = f"notebook_{user_id}_{time.time_ns()}"
+        store.import_notebook(user_id, notebook_id, notebook_name, cells)
+    except ValueError as e:
+        discard_images()
+        return jsonify({"error": str(e)}), 400
+    except DuplicateKeyError:
+        discard_images()
+        return jsonify({"error": "Notebook name already exists."}), 400
+    except Exception:
+        discard_images()
+        raise
     
-    # Save the .ipynb file temporarily
-    with tempfile.NamedTemporaryFile(suffix=".ipynb", delete=False) as temp_file:
-        temp_filename = temp_file.name
-        json.dump(ipynb_data, temp_file, indent=2)
+    response = {"notebookId": notebook_id, "name": notebook_name, "cells": len(cells), "job": None}
+    if options.get('run', '').lower() in ('1', 'true', 'yes'):
+        try:
+            response["job"] = job_status(job_queue.submit(user_id, notebook_id, None, kind="run_all"))
+        except QueueFull as e:
+            response["job_error"] = str(e)
+    return jsonify(response)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_duration(response):
+    if "request_start" in g:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.request_duration.observe(time.perf_counter() - g.request_start,
+                                         method=request.method, route=route, status=response.status_code)
+    return response
+
+# Gauges read the state they report when /metrics is scraped
+metrics.Gauge("notebook_kernels", "Kernel processes bound to notebooks and kept as spares.", labels=("state",),
+              function=lambda: {(state,): count for state, count in kernel_pool.stats().items() if state != "size"})
+metrics.Gauge("notebook_active_namespaces", "Notebooks with their globals loaded in a kernel.",
+              function=lambda: namespace_cache.stats()["active"])
+metrics.Gauge("notebook_snapshots", "Kernel snapshots held.", function=snapshot_store.count)
+metrics.Gauge("notebook_jobs", "Background jobs waiting or running.", labels=("state",),
+              function=lambda: {(state,): job_queue.stats()[state] for state in ("queued", "running")})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics of this worker process."""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/stats/stages', methods=['GET'])
+def get_stage_stats():
+    """Returns how long each request stage took across this worker's requests, for operators."""
+    return jsonify(stage_stats.stats())
+
+@app.route('/images/<name>', methods=['GET'])
+def get_image(name):
+    """Serves a stored plot. Names are content hashes, so responses are cached as immutable."""
+    digest = name.split(".")[0]
+    if digest in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        data = image_store.get(name)
+        if data is None:
+            return jsonify({"error": "Image not found."}), 404
+        response = app.response_class(data, mimetype=mimetypes.guess_type(name)[0])
+    response.set_etag(digest)
+    response.cache_control.public = True
+    response.cache_control.max_age = IMAGE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/<user_id>/<notebook_id>/export', methods=['GET'])
+def export_notebook(user_id, notebook_id):
+    """Exports a notebook as an .ipynb file, or .ipynb.gz with ?gzip=1.
+
+    The file is written into the response a cell at a time straight from the
+    cells cursor, so memory use does not grow with the notebook and nothing
+    is written to disk.
+    """
+    # Fetch only the notebook's metadata, its cells live in their own collection
+    notebook = store.get_notebook(user_id, notebook_id)
+    if not notebook:
+        return jsonify({"error": "Notebook not found."}), 404
     
-    # Return the file as a downloadable response
-    return send_file(
-        temp_filename,
-        as_attachment=True,
-        download_name=f"{notebook['notebook_name']}.ipynb"  # Use notebook name as the filename
+    compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+    filename = f"{notebook['notebook_name']}.ipynb" + (".gz" if compress else "")
+    chunks = export_chunks(store.iter_cells(notebook_id), image_store.get)
+    return Response(
+        stream_with_context(gzip_chunks(chunks) if compress else chunks),
+        mimetype="application/gzip" if compress else "application/x-ipynb+json",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"}
     )
 
 # @app.route('/<user_id>/delete_notebook', methods=['POST'])
@@ -643,27 +1135,13 @@ def delete_notebook(user_id):
     if not notebook_id:
         return jsonify({"error": "Notebook ID is required."}), 400
 
-    # Debugging: Check if the user exists before deletion
-    user_data = user_sessions.find_one({"user_id": user_id})
-    if not user_data:
-        return jsonify({"error": "User not found."}), 404
-
-    # Perform the deletion
-    result = user_sessions.update_one(
-        {"user_id": user_id},
-        {"$pull": {"notebooks": {"notebook_id": notebook_id}}}
-    )
-
-    # Check if the notebook was actually deleted
-    if result.modified_count == 0:
+    # Delete the notebook with its cells and variables, and the user once it has no notebooks left
+    if not store.delete_notebook(user_id, notebook_id):
         return jsonify({"error": "Notebook not found or already deleted."}), 404
 
-    # Debugging: Check if the notebook still exists
-    updated_user_data = user_sessions.find_one({"user_id": user_id})
-    
-    # If the user has no remaining notebooks, remove the entire user document
-    if updated_user_data and not updated_user_data.get("notebooks"):
-        user_sessions.delete_one({"user_id": user_id})
+    # Free the notebook's kernel and snapshots without saving its globals
+    namespace_cache.discard(notebook_id)
+    snapshot_store.drop(notebook_id)
 
     return jsonify({"message": "Notebook deleted successfully."})
 
@@ -731,20 +1209,19 @@ def delete_cell(user_id, notebook_id):
     if not cell_id:
         return jsonify({"error": "Cell ID is required."}), 400
 
-    user_data = user_sessions.find_one({"user_id": user_id})
-    if not user_data:
-        return jsonify({"error": "User not found."}), 404
-
-    notebook = next((nb for nb in user_data["notebooks"] if nb["notebook_id"] == notebook_id), None)
+    notebook = store.get_notebook(user_id, notebook_id)
     if not notebook:
         return jsonify({"error": "Notebook not found."}), 404
 
-    cell_to_delete = next((cell for cell in notebook["cells"] if cell["cell_id"] == cell_id), None)
+    cell_to_delete = store.get_cell(notebook_id, cell_id)
     if not cell_to_delete:
         return jsonify({"error": "Cell not found."}), 404
     
-    # Extract variable assignments from the deleted cell
-    cell_code = cell_to_delete["code"]
+    # Cells reading what the deleted cell defined no longer have their inputs
+    stale = []
+    if cell_to_delete["cell_type"] == "code":
+        graph = dependency_graph(notebook_id)
+        stale = graph.downstream(cell_id, graph.cells[graph.index[cell_id]]["defines"])
     # assigned_vars = re.findall(r'^(\w+)\s*=\s*.*$', cell_code, re.MULTILINE)
     
     # # Remove matching variables from the notebook's global scope BEFORE deleting the cell
@@ -760,12 +1237,9 @@ def delete_cell(user_id, notebook_id):
     #     )
     
     # Remove cell from notebook
-    user_sessions.update_one(
-        {"user_id": user_id, "notebooks.notebook_id": notebook_id},
-        {"$pull": {"notebooks.$.cells": {"cell_id": cell_id}}}
-    )
+    store.delete_cell(notebook_id, cell_id)
     
-    return jsonify({"message": "Cell deleted successfully and related globals removed."})
+    return jsonify({"message": "Cell deleted successfully and related globals removed.", "stale": stale})
 
 @app.route('/')
 def home():
@@ -0,0 +1,63 @@
+"""Compares the namespace serializer with plain dill on typical notebook variables.
+
+Usage: python benchmark_serializer.py [--rows N]
+
+For each variable it prints the codec chosen, the stored size and the time to
+save and load it, next to the same numbers for dill.dumps / dill.loads.
+"""
+import sys
+import time
+
+import dill
+import numpy as np
+import pandas as pd
+
+from serializer import NamespaceSerializer
+
+
+def sample_namespace(rows):
+    rng = np.random.default_rng(0)
+    return {
+        "floats": rng.random(rows),
+        "ints": np.arange(rows, dtype=np.int64),
+        "matrix": rng.random((rows // 100, 100)).astype(np.float32),
+        "frame": pd.DataFrame({
+            "id": np.arange(rows),
+            "value": rng.random(rows),
+            "category": rng.choice(["red", "green", "blue"], rows),
+            "label": [f"item {i % 1000}" for i in range(rows)]
+        }),
+        "records": [{"id": i, "name": f"row {i}", "score": i * 0.5} for i in range(rows // 10)],
+        "helper": lambda x: x * 2
+    }
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    rows = int(sys.argv[sys.argv.index("--rows") + 1]) if "--rows" in sys.argv else 1_000_000
+    serializer = NamespaceSerializer()
+    print(f"{rows} rows, compression: {serializer.compression}")
+    print(f"{'variable':<10} {'codec':<8} {'size MB':>9} {'dump s':>8} {'load s':>8} | {'dill MB':>9} {'dump s':>8} {'load s':>8}")
+
+    totals = [0, 0, 0, 0, 0, 0]
+    for name, value in sample_namespace(rows).items():
+        data, dump_time = timed(serializer.dumps, value)
+        _, load_time = timed(serializer.loads, data)
+        dill_data, dill_dump_time = timed(dill.dumps, value)
+        _, dill_load_time = timed(dill.loads, dill_data)
+
+        row = [len(data) / 1e6, dump_time, load_time, len(dill_data) / 1e6, dill_dump_time, dill_load_time]
+        totals = [total + value for total, value in zip(totals, row)]
+        print(f"{name:<10} {serializer.codec_name(data):<8} {row[0]:>9.2f} {row[1]:>8.3f} {row[2]:>8.3f} | "
+              f"{row[3]:>9.2f} {row[4]:>8.3f} {row[5]:>8.3f}")
+    print(f"{'total':<10} {'':<8} {totals[0]:>9.2f} {totals[1]:>8.3f} {totals[2]:>8.3f} | "
+          f"{totals[3]:>9.2f} {totals[4]:>8.3f} {totals[5]:>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+import os
+import ast
+
+# Names a cell may not use ("input", "os.system", ...), also when reached through an alias or builtins
+EXECUTION_DENYLIST = frozenset(name.strip() for name in os.getenv("EXECUTION_DENYLIST", "input").split(",") if name.strip())
+# Part of the code cache key, bumped when analyses change so ones cached on disk are made again
+ANALYSIS_VERSION = 2
+
+
+def dotted_name(node):
+    """Returns "a.b.c" for a Name or a chain of Attributes on one, None for anything else."""
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        base = dotted_name(node.value)
+        return f"{base}.{node.attr}" if base else None
+    return None
+
+
+def _resolve(name, aliases):
+    """Maps a dotted name through the cell's import aliases, with builtins.x and __builtins__.x as x."""
+    first, dot, rest = name.partition(".")
+    name = aliases.get(first, first) + dot + rest
+    for prefix in ("builtins.", "__builtins__."):
+        if name.startswith(prefix):
+            return name[len(prefix):]
+    return name
+
+
+def _bound_names(scope):
+    """Names a module, function, lambda, class or comprehension binds other than by import.
+
+    Nested scopes are not looked into, names declared global or nonlocal are
+    left out since they are bound in another scope.
+    """
+    if isinstance(scope, (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+        return {node.id for generator in scope.generators for node in ast.walk(generator.target)
+                if isinstance(node, ast.Name)}
+    names, declared = set(), set()
+    if isinstance(scope, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+        args = scope.args
+        names.update(arg.arg for arg in args.posonlyargs + args.args + args.kwonlyargs + [args.vararg, args.kwarg] if arg)
+    stack = list(scope.body) if isinstance(scope.body, list) else [scope.body]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+            continue
+        elif isinstance(node, (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+            continue
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            declared.update(node.names)
+        elif isinstance(node, (ast.ExceptHandler, ast.MatchAs, ast.MatchStar)) and node.name:
+            names.add(node.name)
+        stack.extend(ast.iter_child_nodes(node))
+    return names - declared
+
+
+class _NameCollector(ast.NodeVisitor):
+    """Collects the globals a cell binds and reads, and the names and attributes it uses."""
+
+    def __init__(self):
+        self.defined = set()
+        self.read = set()
+        self.uses = {}  # resolved dotted name -> first line it is used on
+        self._aliases = {}  # name an import binds -> dotted name it stands for
+        self._depth = 0  # > 0 inside function, class, lambda and comprehension scopes
+        self._globals = set()
+        self._scopes = []  # (is_class, names bound other than by import) of the enclosing scopes, innermost last
+
+    def _bind(self, name):
+        if self._depth == 0 or name in self._globals:
+            self.defined.add(name)
+
+    def _scope(self, node):
+        self._depth += 1
+        self._scopes.append((isinstance(node, ast.ClassDef), _bound_names(node)))
+        self.generic_visit(node)
+        self._scopes.pop()
+        self._depth -= 1
+
+    def _shadowed(self, name):
+        # A class body's names are not visible in the functions defined in it
+        innermost = len(self._scopes) - 1
+        return any(name in names for index, (is_class, names) in enumerate(self._scopes)
+                   if not is_class or index == innermost)
+
+    def _use(self, name, node):
+        # A parameter, loop variable or assignment of the same name is not what the name resolves to
+        if not self._shadowed(name.partition(".")[0]):
+            self.uses.setdefault(_resolve(name, self._aliases), node.lineno)
+
+    def visit_Module(self, node):
+        self._scopes.append((False, _bound_names(node)))
+        self.generic_visit(node)
+        self._scopes.pop()
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.read.add(node.id)
+            self._use(node.id, node)
+        else:
+            self._bind(node.id)
+
+    def visit_Attribute(self, node):
+        name = dotted_name(node)
+        if name:
+            self._use(name, node)
+        self.generic_visit(node)
+
+    def visit_Subscript(self, node):
+        # __builtins__["input"]
+        base = dotted_name(node.value)
+        if base and isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+            self._use(f"{base}.{node.slice.value}", node)
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        # x += 1 reads x before binding it again
+        if isinstance(node.target, ast.Name):
+            self.read.add(node.target.id)
+        self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        self._bind(node.name)
+        self._scope(node)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_ClassDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        self._scope(node)
+
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = visit_Lambda
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self._bind(alias.asname or alias.name.split(".")[0])
+            if alias.asname:
+                self._aliases[alias.asname] = alias.name
+
+    def visit_ImportFrom(self, node):
+        for alias in node.names:
+            if alias.name == "*":
+                continue
+            self._bind(alias.asname or alias.name)
+            if node.module and not node.level:
+                self._aliases[alias.asname or alias.name] = f"{node.module}.{alias.name}"
+                self.uses.setdefault(_resolve(f"{node.module}.{alias.name}", {}), node.lineno)
+
+    def visit_Global(self, node):
+        self._globals.update(node.names)
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self._bind(node.name)
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        # getattr(builtins, "input")
+        if isinstance(node.func, ast.Name) and node.func.id == "getattr" and len(node.args) >= 2:
+            base = dotted_name(node.args[0])
+            attr = node.args[1]
+            if base and isinstance(attr, ast.Constant) and isinstance(attr.value, str):
+                self._use(f"{base}.{attr.value}", node)
+        self.generic_visit(node)
+
+
+def _split_last_expression(source, filename, tree):
+    """Compiles a cell ending in an expression as (body, expression), None for any other cell."""
+    last = tree.body[-1] if tree.body else None
+    if not isinstance(last, ast.Expr):
+        return None
+    # Column offsets count UTF-8 bytes
+    rest = source.splitlines()[last.end_lineno - 1].encode()[last.end_col_offset:].decode(errors="ignore")
+    if rest.lstrip().startswith(";"):
+        return None
+    body = ast.Module(body=tree.body[:-1], type_ignores=[])
+    return compile(body, filename, "exec"), compile(ast.Expression(last.value), filename, "eval")
+
+
+class CellAnalysis:
+    """The result of parsing a cell once: its syntax tree, compiled code and the names it uses.
+
+    defined holds the globals the cell binds (assignments, imports, def and
+    class at the top level, and names declared global in its functions).
+    read holds every name the cell loads, wherever it does so.
+    split_code is (body, expression) when the cell ends in an expression
+    whose value is displayed, as in IPython a trailing semicolon hides it.
+    """
+
+    def __init__(self, source, filename, code, defined, read, uses, tree=None, split_code=None):
+        self.source = source
+        self.filename = filename
+        self.code = code
+        self.split_code = split_code
+        self.defined = frozenset(defined)
+        self.read = frozenset(read)
+        self.uses = uses
+        self._tree = tree
+
+    @classmethod
+    def parse(cls, source, filename="<string>"):
+        """Parses and compiles a cell, raising SyntaxError like compile() does."""
+        tree = ast.parse(source, filename, "exec")
+        collector = _NameCollector()
+        collector.visit(tree)
+        code = compile(tree, filename, "exec")
+        return cls(source, filename, code, collector.defined, collector.read, collector.uses, tree,
+                   _split_last_expression(source, filename, tree))
+
+    @property
+    def tree(self):
+        # Analyses loaded from disk carry no tree, parse again only if a stage asks for it
+        if self._tree is None:
+            self._tree = ast.parse(self.source, self.filename, "exec")
+        return self._tree
+
+    def denied(self, denylist=EXECUTION_DENYLIST):
+        """Returns (name, line) for each use of a denylisted name, called or not, in order of appearance."""
+        return sorted(((name, line) for name, line in self.uses.items() if name in denylist), key=lambda use: use[1])
+
+    def to_marshal(self):
+        """Returns everything but the tree, as values marshal can write."""
+        return {"source": self.source, "filename": self.filename, "code": self.code,
+                "defined": self.defined, "read": self.read, "uses": self.uses, "split_code": self.split_code}
+
+    @classmethod
+    def from_marshal(cls, data):
+        return cls(data["source"], data["filename"], data["code"], data["defined"], data["read"], data["uses"],
+                   split_code=data["split_code"])
@@ -0,0 +1,104 @@
+import os
+import sys
+import marshal
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from cell_analysis import CellAnalysis, ANALYSIS_VERSION
+
+CODE_CACHE_SIZE = int(os.getenv("CODE_CACHE_SIZE", "512"))  # Compiled cells kept in memory per kernel
+CODE_CACHE_PATH = os.getenv("CODE_CACHE_PATH", "")  # Directory for compiled cells shared between kernels, empty disables
+
+
+class CodeCache:
+    """LRU cache of analysed and compiled cells, so re-running an unchanged cell skips parsing and compiling.
+
+    Entries are CellAnalysis objects keyed by a hash of the source and the
+    interpreter's cache tag, since code objects are only valid for the Python
+    version that made them. With a path, analyses are also written there with
+    marshal and loaded back on a miss, which lets fresh kernels reuse cells
+    any kernel has compiled before.
+    """
+
+    def __init__(self, size=CODE_CACHE_SIZE, path=CODE_CACHE_PATH):
+        self.size = size
+        self.path = os.path.join(path, sys.implementation.cache_tag) if path else None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> CellAnalysis, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, source, filename):
+        digest = hashlib.sha256(f"{sys.implementation.cache_tag}\0{ANALYSIS_VERSION}\0{filename}\0".encode())
+        digest.update(source.encode("utf-8", "surrogatepass"))
+        return digest.hexdigest()
+
+    def analyze(self, source, filename="<string>"):
+        """Returns the CellAnalysis of a cell, raising SyntaxError like compile() does."""
+        key = self.key(source, filename)
+        with self._lock:
+            analysis = self._entries.get(key)
+            if analysis is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return analysis
+            self.misses += 1
+
+        analysis = self._load(key)
+        if analysis is None:
+            analysis = CellAnalysis.parse(source, filename)
+            self._store(key, analysis.to_marshal())
+        self._add(key, analysis)
+        return analysis
+
+    def compile(self, source, filename="<string>"):
+        return self.analyze(source, filename).code
+
+    def warm(self):
+        """Loads the most recently compiled cells from disk, e.g. in the template process before kernels fork."""
+        if not self.path or not os.path.isdir(self.path):
+            return
+        files = sorted(
+            (entry for entry in os.scandir(self.path) if entry.name.endswith(".bin")),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in files[-self.size:]:
+            key = entry.name[:-len(".bin")]
+            analysis = self._load(key)
+            if analysis is not None:
+                self._add(key, analysis)
+
+    def _add(self, key, analysis):
+        with self._lock:
+            self._entries[key] = analysis
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def _load(self, key):
+        if not self.path:
+            return None
+        try:
+            with open(os.path.join(self.path, f"{key}.bin"), "rb") as f:
+                return CellAnalysis.from_marshal(marshal.load(f))
+        except (OSError, EOFError, ValueError, TypeError, KeyError):
+            return None
+
+    def _store(self, key, data):
+        if not self.path:
+            return
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            # Write to a temporary file first so other kernels never load a partial entry
+            fd, temp_path = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, "wb") as f:
+                marshal.dump(data, f)
+            os.replace(temp_path, os.path.join(self.path, f"{key}.bin"))
+        except OSError as e:
+            print(f"Error writing compiled cell {key}: {e}")
+
+
+# Shared by every notebook executed in this process
+code_cache = CodeCache()
@@ -0,0 +1,48 @@
+from cell_analysis import CellAnalysis
+
+
+def cell_names(code):
+    """Returns the globals a cell defines and reads, as stored on code cells.
+
+    A cell that does not parse has no dependencies, it fails again when run.
+    """
+    try:
+        analysis = CellAnalysis.parse(code)
+    except (SyntaxError, ValueError):
+        return {"defines": [], "reads": []}
+    return {"defines": sorted(analysis.defined), "reads": sorted(analysis.read)}
+
+
+class DependencyGraph:
+    """Which code cells depend on which, from the names each one defines and reads.
+
+    Cells are taken in notebook order, a cell reading a name depends on the
+    closest earlier cell that defines it. Each cell only carries its own
+    names, so editing a cell just updates that cell and the graph is rebuilt
+    from the stored names without parsing anything.
+    """
+
+    def __init__(self, cells):
+        # cells: dicts with cell_id, defines and reads, in notebook order
+        self.cells = cells
+        self.index = {cell["cell_id"]: i for i, cell in enumerate(cells)}
+
+    def downstream(self, cell_id, changed_names):
+        """Returns the ids of later cells affected when cell_id's definitions of changed_names change, in run order.
+
+        A cell is affected if it reads a changed name, and the names it
+        defines change in turn. A cell that redefines a name without reading
+        it hides the change from the cells after it.
+        """
+        stale = set(changed_names)
+        affected = []
+        for cell in self.cells[self.index[cell_id] + 1:]:
+            if not stale:
+                break
+            defines = set(cell.get("defines") or [])
+            if stale.intersection(cell.get("reads") or []):
+                affected.append(cell["cell_id"])
+                stale |= defines
+            else:
+                stale -= defines
+        return affected
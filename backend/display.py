@@ -0,0 +1,162 @@
+import os
+import sys
+import base64
+import builtins
+import threading
+import contextlib
+
+DISPLAY_MAX_ROWS = int(os.getenv("DISPLAY_MAX_ROWS", "50"))  # DataFrame rows shown, split between head and tail
+DISPLAY_MAX_COLUMNS = int(os.getenv("DISPLAY_MAX_COLUMNS", "20"))  # DataFrame columns shown
+DISPLAY_MAX_CHARS = int(os.getenv("DISPLAY_MAX_CHARS", "100000"))  # Per representation of a displayed object
+DISPLAY_MAX_OUTPUTS = int(os.getenv("DISPLAY_MAX_OUTPUTS", "100"))  # Displays kept per cell
+TEXT_MIMES = ("text/html", "text/markdown", "text/latex", "text/plain")
+IMAGE_MIMES = ("image/png", "image/svg+xml", "image/jpeg")
+REPR_METHODS = {
+    "text/html": "_repr_html_",
+    "text/markdown": "_repr_markdown_",
+    "text/latex": "_repr_latex_",
+    "image/png": "_repr_png_",
+    "image/svg+xml": "_repr_svg_",
+    "image/jpeg": "_repr_jpeg_",
+}
+
+_current = threading.local()
+_pandas_configured = False
+
+
+def configure_pandas():
+    """Caps the rows and columns pandas prints, so print(df) stays as small as display(df).
+
+    Done once per process, after that a notebook's own pd.set_option calls win.
+    """
+    global _pandas_configured
+    pandas = sys.modules.get("pandas")
+    if _pandas_configured or pandas is None:
+        return
+    pandas.set_option("display.max_rows", DISPLAY_MAX_ROWS, "display.max_columns", DISPLAY_MAX_COLUMNS)
+    _pandas_configured = True
+
+
+def _is_pandas(value, name):
+    return type(value).__name__ == name and type(value).__module__.startswith("pandas")
+
+
+def _pandas_bundle(value):
+    """HTML and text of a DataFrame or Series, only formatting the rows and columns that are shown."""
+    frame = value.to_frame() if _is_pandas(value, "Series") else value
+    html = frame.to_html(max_rows=DISPLAY_MAX_ROWS, max_cols=DISPLAY_MAX_COLUMNS, show_dimensions=True)
+    if _is_pandas(value, "Series"):
+        text = value.to_string(max_rows=DISPLAY_MAX_ROWS, length=True, dtype=True)
+    else:
+        text = value.to_string(max_rows=DISPLAY_MAX_ROWS, max_cols=DISPLAY_MAX_COLUMNS, show_dimensions=True)
+    return {"text/html": html, "text/plain": text}
+
+
+def mime_bundle(value):
+    """Returns {mime: data} for an object, from _repr_mimebundle_ or the _repr_*_ methods IPython uses."""
+    if _is_pandas(value, "DataFrame") or _is_pandas(value, "Series"):
+        return _pandas_bundle(value)
+    bundle = {}
+    if not isinstance(value, type):
+        # A representation that fails is left out, as IPython does, repr() is the fallback
+        try:
+            method = getattr(value, "_repr_mimebundle_", None)
+            data = method(include=None, exclude=None) if callable(method) else None
+            bundle.update(data[0] if isinstance(data, tuple) else data or {})
+        except Exception:
+            pass
+        for mime, name in REPR_METHODS.items():
+            try:
+                method = getattr(value, name, None)
+                data = method() if mime not in bundle and callable(method) else None
+            except Exception:
+                continue
+            if data is not None:
+                bundle[mime] = data[0] if isinstance(data, tuple) else data
+    bundle.setdefault("text/plain", repr(value))
+    return bundle
+
+
+class Displays:
+    """The objects one execution displayed, with display() or as the value of its last line.
+
+    Figures and images become (data, mime) images like the plots a cell
+    leaves open, everything else a bundle of its text representations.
+    """
+
+    def __init__(self, renderer, limit=DISPLAY_MAX_OUTPUTS, budget=None):
+        self.renderer = renderer
+        self.limit = limit
+        self.budget = budget  # executor.OutputBudget the text of displays counts against
+        self.images = []
+        self.bundles = []
+        self.figures = []  # Figures displayed, not rendered again when the cell ends unless changed
+        self.dropped = 0
+
+    def publish(self, value, raw=False):
+        if len(self.images) + len(self.bundles) >= self.limit:
+            self.dropped += 1
+            return
+        if type(value).__name__ == "Figure" and type(value).__module__.startswith("matplotlib"):
+            self.images.append(self.renderer.render(value)[0])
+            self.figures.append(value)
+            return
+        bundle = dict(value) if raw else mime_bundle(value)
+        mime = next((mime for mime in IMAGE_MIMES if mime in bundle), None)
+        if mime:
+            data = bundle[mime]
+            if isinstance(data, str):
+                data = data.encode() if mime == "image/svg+xml" else base64.b64decode(data)
+            self.images.append((data, mime))
+            return
+        data = {}
+        for mime in TEXT_MIMES:
+            text = bundle.get(mime)
+            if isinstance(text, str):
+                if len(text) > DISPLAY_MAX_CHARS:
+                    if mime != "text/plain":
+                        continue  # Cut markup would not render, the plain text is kept instead
+                    text = text[:DISPLAY_MAX_CHARS] + f"\n[Output truncated after {DISPLAY_MAX_CHARS} characters]"
+                data[mime] = text
+        size = sum(len(text) for text in data.values())
+        if size and self.budget and not self.budget.take(size, partial=False):
+            # Over the cell's output budget, keep what still fits of the plain text
+            text = data.get("text/plain", "")
+            kept = self.budget.take(len(text))
+            if not kept:
+                self.dropped += 1
+                return
+            data = {"text/plain": text[:kept] + self.budget.marker()}
+        if data:
+            self.bundles.append({"data": data})
+
+    def result(self):
+        """The display bundles for a cell's result, None when there are none."""
+        if self.dropped:
+            self.bundles.append({"data": {"text/plain": f"[{self.dropped} more displays not shown]"}})
+        return self.bundles or None
+
+
+@contextlib.contextmanager
+def collect(displays):
+    """Sends display() calls made on this thread in the block to displays."""
+    previous = getattr(_current, "displays", None)
+    _current.displays = displays
+    try:
+        yield displays
+    finally:
+        _current.displays = previous
+
+
+def display(*objs, raw=False):
+    """Shows objects in the cell's output, like IPython's display(). With raw, objs are {mime: data} bundles."""
+    displays = getattr(_current, "displays", None)
+    for value in objs:
+        if displays is None:
+            print(value if raw else mime_bundle(value)["text/plain"])
+        else:
+            displays.publish(value, raw=raw)
+
+
+# Notebooks call display() without importing it, as in IPython
+builtins.display = display
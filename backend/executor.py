@@ -0,0 +1,345 @@
+import io
+import os
+import sys
+import math
+import time
+import signal
+import resource
+import threading
+import contextlib
+import contextvars
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import traceback
+
+import thread_context  # Threads a cell starts inherit its output
+from code_cache import code_cache
+from cell_analysis import EXECUTION_DENYLIST
+from profiling import CellProfiler
+from plots import PlotRenderer, figure_scope
+from display import Displays, collect, configure_pandas
+
+MAX_OUTPUT_CHARS = int(os.getenv("MAX_OUTPUT_CHARS", "1000000"))  # Printed output kept per cell
+CELL_OUTPUT_MAX_CHARS = int(os.getenv("CELL_OUTPUT_MAX_CHARS", "2000000"))  # Stdout, stderr and displays kept per cell together
+STREAM_CHUNK_CHARS = 4096
+STREAM_INTERVAL = 0.1
+EXECUTION_TIMEOUT = int(os.getenv("EXECUTION_TIMEOUT", "60"))  # Wall-clock seconds per cell, 0 disables
+EXECUTION_CPU_LIMIT = int(os.getenv("EXECUTION_CPU_LIMIT", "60"))  # CPU seconds per cell, 0 disables
+
+
+class TimeoutException(BaseException):
+    """Raised inside a cell that ran out of wall-clock or CPU time.
+
+    It derives from BaseException so an `except Exception` in user code
+    cannot swallow it.
+    """
+
+    def __init__(self, message, error_type):
+        super().__init__(message)
+        self.error_type = error_type
+
+
+def timeout_handler(signum, frame):
+    raise TimeoutException("Code execution timed out", "timeout")
+
+
+def cpu_limit_handler(signum, frame):
+    raise TimeoutException("CPU time limit exceeded", "cpu_limit")
+
+
+class PendingInterrupt:
+    """SIGINT handler while a kernel handles a command outside a cell, remembers the interrupt for the cell."""
+
+    def __init__(self):
+        self.pending = False
+
+    def __call__(self, signum, frame):
+        self.pending = True
+
+
+class OutputBudget:
+    """The characters a cell's stdout, stderr and displays may take together, so its stored output stays small.
+
+    Each cap on its own still allowed far more than a MongoDB document holds.
+    """
+
+    def __init__(self, limit=CELL_OUTPUT_MAX_CHARS):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def take(self, size, partial=True):
+        """Counts up to size more characters as used and returns how many fit, without partial all or none."""
+        with self.lock:
+            room = max(self.limit - self.used, 0)
+            if size > room and not partial:
+                return 0
+            granted = min(size, room)
+            self.used += granted
+            return granted
+
+    def marker(self):
+        return f"\n[Output truncated, a cell keeps at most {self.limit} characters of output]\n"
+
+
+class CellOutput(io.TextIOBase):
+    """Collects a cell's printed output up to a size cap.
+
+    With a sink, output is also forwarded as ("stdout", text) chunks while the
+    cell runs: whenever a chunk fills up, and every STREAM_INTERVAL seconds
+    from a background thread, so a long loop shows its progress.
+    """
+
+    def __init__(self, stream="stdout", sink=None, limit=MAX_OUTPUT_CHARS, budget=None):
+        self.stream = stream
+        self.sink = sink
+        self.limit = limit
+        self.budget = budget  # OutputBudget shared with the cell's other outputs
+        self.parts = []
+        self.size = 0
+        self.truncated = False
+        self.pending = []
+        self.pending_size = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        if sink:
+            threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        with self.lock:
+            if self.truncated:
+                return len(text)
+            room = self.limit - self.size
+            kept = text
+            if len(text) > room:
+                kept = text[:room]
+                marker = f"\n[Output truncated after {self.limit} characters]\n"
+            if self.budget:
+                granted = self.budget.take(len(kept))
+                if granted < len(kept):
+                    kept = kept[:granted]
+                    marker = self.budget.marker()
+            if len(kept) < len(text):
+                kept += marker
+                self.truncated = True
+            self.parts.append(kept)
+            self.size += len(kept)
+
+            if self.sink:
+                self.pending.append(kept)
+                self.pending_size += len(kept)
+                if self.pending_size >= STREAM_CHUNK_CHARS:
+                    self._send_pending()
+        return len(text)
+
+    def flush(self):
+        with self.lock:
+            self._send_pending()
+
+    def close(self):
+        """Stops the background flushing and sends whatever is still pending."""
+        self.stopped.set()
+        self.flush()
+
+    def _send_pending(self):
+        if self.sink and self.pending:
+            self.sink(self.stream, "".join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def _flush_loop(self):
+        while not self.stopped.wait(STREAM_INTERVAL):
+            self.flush()
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+
+class ThreadOutput(io.TextIOBase):
+    """Stands in for sys.stdout or sys.stderr, sending writes to the stream the writing thread redirected to.
+
+    contextlib.redirect_stdout swaps the process-wide sys.stdout, so cells
+    running on several threads would print into each other's output. The
+    target is a context variable, which threads a cell starts inherit (see
+    thread_context), so their output goes to that cell. Once the cell's
+    redirect ended, or for threads started outside any, writes go to default.
+    """
+
+    def __init__(self, default):
+        self.default = default
+        self._target = contextvars.ContextVar("output_target", default=None)
+        self._active = []  # Targets of the redirects in progress on any thread
+        self._lock = threading.Lock()
+
+    def current(self):
+        target = self._target.get()
+        if target is None:
+            return self.default
+        with self._lock:
+            # By identity, distinct outputs may compare equal
+            active = any(other is target for other in self._active)
+        return target if active else self.default
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        return self.current().write(text)
+
+    def flush(self):
+        self.current().flush()
+
+    @contextlib.contextmanager
+    def redirect(self, target):
+        token = self._target.set(target)
+        with self._lock:
+            self._active.append(target)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active = [active for active in self._active if active is not target]
+            self._target.reset(token)
+
+
+def redirect(stream, target):
+    """Like contextlib.redirect_stdout, for "stdout" or "stderr" and only the current thread."""
+    output = getattr(sys, stream)
+    if not isinstance(output, ThreadOutput):
+        output = ThreadOutput(output)
+        setattr(sys, stream, output)
+    return output.redirect(target)
+
+
+class CodeExecutor:
+    def __init__(self, timeout=10, cpu_limit=None, cache=code_cache, denylist=EXECUTION_DENYLIST, renderer=None,
+                 output_limit=CELL_OUTPUT_MAX_CHARS):
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+        self.output_limit = output_limit
+        self.cache = cache
+        self.denylist = denylist
+        self.renderer = renderer or PlotRenderer()
+
+    @contextlib.contextmanager
+    def limits(self):
+        """Interrupts the cell with TimeoutException once it exceeds its wall-clock or CPU time.
+
+        SIGINT raises KeyboardInterrupt only while the cell runs, so cancelling
+        a cell that just finished cannot hit the kernel between commands. A
+        PendingInterrupt caught before the cell started interrupts it at once.
+        """
+        # Signal handlers can only be installed from the main thread
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        old_alarm = signal.signal(signal.SIGALRM, timeout_handler)
+        old_xcpu = signal.signal(signal.SIGXCPU, cpu_limit_handler)
+        old_int = signal.signal(signal.SIGINT, signal.default_int_handler)
+        cpu_soft, cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)
+        try:
+            if isinstance(old_int, PendingInterrupt) and old_int.pending:
+                raise KeyboardInterrupt
+            if self.cpu_limit:
+                usage = resource.getrusage(resource.RUSAGE_SELF)
+                soft = math.ceil(usage.ru_utime + usage.ru_stime) + self.cpu_limit
+                if cpu_hard != resource.RLIM_INFINITY:
+                    soft = min(soft, cpu_hard)
+                resource.setrlimit(resource.RLIMIT_CPU, (soft, cpu_hard))
+            if self.timeout:
+                signal.setitimer(signal.ITIMER_REAL, self.timeout)
+            yield
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_soft, cpu_hard))
+            signal.signal(signal.SIGALRM, old_alarm)
+            signal.signal(signal.SIGXCPU, old_xcpu)
+            signal.signal(signal.SIGINT, old_int)
+
+    def capture_output(self, code, session_globals, sink=None, profile=None):
+        """Runs a cell, with profile options from parse_profile the result also carries a "profile" of the run.
+
+        Images are (data, mime) pairs, one per figure displayed or left open
+        by the cell, and "plots" reports how rendering them went. "displays"
+        holds the {mime: text} bundles of other displayed objects, including
+        the value of a last line that is an expression.
+        """
+        budget = OutputBudget(self.output_limit)
+        output = CellOutput("stdout", sink, budget=budget)
+        errors = CellOutput("stderr", sink, budget=budget)
+        displays = Displays(self.renderer, budget=budget)
+        error = None
+        error_type = None
+        images = []
+        plots = None
+        profiler = CellProfiler(profile) if profile is not None else None
+        render_time = 0.0
+
+        # Parsed once, the same analysis is checked here and compiled below
+        compile_start = time.perf_counter()
+        try:
+            analysis = self.cache.analyze(code)
+        except (SyntaxError, ValueError) as e:
+            text = "".join(traceback.format_exception_only(type(e), e))
+            return {"text": text, "error": str(e), "error_type": "exception", "images": None}
+        for name, line in analysis.denied(self.denylist):
+            if name == "input":
+                return {"text": "", "error": "User input is disabled.", "error_type": "input_disabled", "images": None}
+            return {"text": "", "error": f"Using {name} is disabled (line {line}).", "error_type": "call_disabled", "images": None}
+
+        try:
+            # Figures the cell leaves open are closed with its scope, whether or not it failed
+            with redirect("stdout", output), redirect("stderr", errors), figure_scope(), collect(displays):
+                configure_pandas()
+                try:
+                    with self.limits():
+                        compile_time = time.perf_counter() - compile_start
+                        if profiler:
+                            profiler.start()
+                        try:
+                            if analysis.split_code:
+                                body, expression = analysis.split_code
+                                exec(body, session_globals)
+                                value = eval(expression, session_globals)
+                                if value is not None:
+                                    displays.publish(value)
+                            else:
+                                exec(analysis.code, session_globals)
+                        finally:
+                            if profiler:
+                                profiler.stop()
+                        if plt.get_fignums():
+                            images, plots = self.renderer.render_open_figures(shown=displays.figures)
+                            render_time = plots["render_time"]
+                except TimeoutException as e:
+                    error = str(e)
+                    error_type = e.error_type
+                except KeyboardInterrupt:
+                    error = "Execution interrupted"
+                    error_type = "interrupted"
+                except MemoryError:
+                    error = "Memory limit exceeded"
+                    error_type = "memory"
+                except BaseException as e:
+                    # Includes SystemExit, which must not take the kernel down
+                    error = str(e) or type(e).__name__
+                    error_type = "exception"
+                    traceback.print_exc(file=output)
+        except Exception as e:
+            error = f"Execution error: {str(e)}"
+            error_type = "exception"
+        output.close()
+        errors.close()
+
+        images = displays.images + images
+        result = {"text": output.getvalue(), "error": error, "error_type": error_type, "images": images if images else None,
+                  "stderr": errors.getvalue(), "displays": displays.result()}
+        if plots:
+            result["plots"] = plots
+        if profiler and hasattr(profiler, "result"):
+            result["profile"] = dict(profiler.result, compile_time=compile_time, render_time=render_time)
+        return result
@@ -0,0 +1,96 @@
+import os
+import re
+import hashlib
+import tempfile
+from gridfs import GridFS
+from gridfs.errors import FileExists, NoFile
+
+IMAGE_STORE = os.getenv("IMAGE_STORE", "local")  # "local" or "gridfs"
+IMAGE_STORE_PATH = os.getenv("IMAGE_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "images"))
+
+# Image names are the SHA-256 of the content plus an extension for the format
+IMAGE_NAME = re.compile(r'^[0-9a-f]{64}\.(png|svg|jpg|webp)$')
+EXTENSIONS = {"image/png": "png", "image/svg+xml": "svg", "image/jpeg": "jpg", "image/webp": "webp"}
+
+
+def image_name(data, mime="image/png"):
+    return f"{hashlib.sha256(data).hexdigest()}.{EXTENSIONS[mime]}"
+
+
+class LocalImageStore:
+    """Content-addressed images on the local filesystem, sharded by hash prefix."""
+
+    def __init__(self, root=IMAGE_STORE_PATH):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.root, name[:2], name)
+
+    def put(self, data, mime="image/png"):
+        name = image_name(data, mime)
+        path = self._path(name)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so readers never see a partial image
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        return name
+
+    def get(self, name):
+        if not IMAGE_NAME.match(name):
+            return None
+        try:
+            with open(self._path(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, name):
+        return bool(IMAGE_NAME.match(name)) and os.path.exists(self._path(name))
+
+    def delete(self, name):
+        if IMAGE_NAME.match(name):
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+
+
+class GridFSImageStore:
+    """Content-addressed images in MongoDB GridFS, for deployments without a shared disk."""
+
+    def __init__(self, db):
+        self.fs = GridFS(db, collection="images")
+
+    def put(self, data, mime="image/png"):
+        name = image_name(data, mime)
+        if not self.fs.exists(name):
+            try:
+                self.fs.put(data, _id=name, contentType=mime)
+            except FileExists:
+                pass  # Another worker stored the same image first
+        return name
+
+    def get(self, name):
+        if not IMAGE_NAME.match(name):
+            return None
+        try:
+            return self.fs.get(name).read()
+        except NoFile:
+            return None
+
+    def exists(self, name):
+        return bool(IMAGE_NAME.match(name)) and self.fs.exists(name)
+
+    def delete(self, name):
+        if IMAGE_NAME.match(name):
+            self.fs.delete(name)
+
+
+def create_image_store(db):
+    if IMAGE_STORE == "gridfs":
+        return GridFSImageStore(db)
+    return LocalImageStore()
@@ -0,0 +1,219 @@
+import os
+import re
+import json
+import zlib
+import base64
+import mimetypes
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+NBFORMAT = 4
+NBFORMAT_MINOR = 5
+CELL_ID = re.compile(r'^[a-zA-Z0-9_-]{1,64}$')  # Cell ids nbformat 4.5 accepts
+IMPORT_MAX_CELLS = int(os.getenv("IMPORT_MAX_CELLS", "5000"))
+IMAGE_MIMES = ("image/png", "image/svg+xml", "image/jpeg", "image/webp")  # Preferred first when an output has several
+DISPLAY_MIMES = ("text/html", "text/markdown", "text/latex", "text/plain")  # Kept from other display outputs
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')  # Colors in IPython tracebacks
+NOTEBOOK_METADATA = {
+    "kernelspec": {
+        "display_name": "Python 3",
+        "language": "python",
+        "name": "python3"
+    },
+    "language_info": {
+        "codemirror_mode": {
+            "name": "ipython",
+            "version": 3
+        },
+        "file_extension": ".py",
+        "mimetype": "text/x-python",
+        "name": "python",
+        "nbconvert_exporter": "python",
+        "pygments_lexer": "ipython3",
+        "version": "3.x"
+    }
+}
+
+
+def _indent(text, prefix="  "):
+    return "\n".join(prefix + line for line in text.split("\n"))
+
+
+def image_output(image, load_image):
+    """Returns a display_data output for a stored image name or a data: URL, None if the image is gone."""
+    if image.startswith("data:"):
+        # Cells saved before the image store hold the plot inline
+        header, _, data = image.partition(",")
+        mime = header[len("data:"):].split(";")[0]
+    else:
+        content = load_image(image)
+        if content is None:
+            return None
+        mime = mimetypes.guess_type(image)[0]
+        data = content.decode() if mime == "image/svg+xml" else base64.b64encode(content).decode()
+    return {"output_type": "display_data", "data": {mime: data}, "metadata": {}}
+
+
+def cell_to_ipynb(cell, load_image, index=0):
+    """Converts a stored cell to its .ipynb form, with printed output and plots as outputs."""
+    source = cell["code"].splitlines(True)
+    cell_id = cell.get("cell_id") if CELL_ID.match(cell.get("cell_id") or "") else f"cell-{index}"
+    if cell["cell_type"] == "markdown":
+        return {"id": cell_id, "cell_type": "markdown", "metadata": {}, "source": source}
+
+    outputs = []
+    output = cell.get("output")
+    if output:
+        if output.get("text"):
+            outputs.append({"name": "stdout", "output_type": "stream", "text": output["text"].splitlines(True)})
+        if output.get("stderr"):
+            outputs.append({"name": "stderr", "output_type": "stream", "text": output["stderr"].splitlines(True)})
+        for display in output.get("displays") or []:
+            data = {mime: text.splitlines(True) for mime, text in display["data"].items()}
+            outputs.append({"output_type": "display_data", "data": data, "metadata": {}})
+        for image in output.get("images") or []:
+            display = image_output(image, load_image)
+            if display:
+                outputs.append(display)
+    return {
+        "id": cell_id,
+        "cell_type": "code",
+        "execution_count": None,  # Execution count is not tracked in this implementation
+        "metadata": {},
+        "source": source,
+        "outputs": outputs
+    }
+
+
+def export_chunks(cells, load_image):
+    """Yields a notebook's .ipynb JSON piece by piece, one cell at a time from the cells iterable."""
+    yield '{\n "cells": ['
+    for index, cell in enumerate(cells):
+        yield ("," if index else "") + "\n" + _indent(json.dumps(cell_to_ipynb(cell, load_image, index), indent=1))
+    yield "\n ],\n"
+    yield ' "metadata": ' + json.dumps(NOTEBOOK_METADATA, indent=1).replace("\n", "\n ") + ",\n"
+    yield f' "nbformat": {NBFORMAT},\n "nbformat_minor": {NBFORMAT_MINOR}\n}}\n'
+
+
+def gzip_chunks(chunks, level=6):
+    """Compresses text chunks into a gzip stream as they come."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31 writes a gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _text(value, what):
+    """Joins nbformat multiline strings, which may be a string or a list of strings."""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list) and all(isinstance(line, str) for line in value):
+        return "".join(value)
+    raise ValueError(f"{what} must be a string or a list of strings.")
+
+
+def output_from_ipynb(outputs, put_image):
+    """Converts a code cell's .ipynb outputs to a stored output, storing images with put_image(data, mime).
+
+    Returns None for a cell without outputs.
+    """
+    if not isinstance(outputs, list):
+        raise ValueError("outputs must be a list.")
+    if not outputs:
+        return None
+    text, stderr, images, displays, error = [], [], [], [], None
+    for output in outputs:
+        kind = output.get("output_type") if isinstance(output, dict) else None
+        if kind == "stream":
+            (stderr if output.get("name") == "stderr" else text).append(_text(output.get("text", ""), "Stream text"))
+        elif kind in ("display_data", "execute_result"):
+            data = output.get("data") or {}
+            mime = next((mime for mime in IMAGE_MIMES if mime in data), None)
+            if mime:
+                content = _text(data[mime], "Image data")
+                content = content.encode() if mime == "image/svg+xml" else base64.b64decode(content)
+                images.append(put_image(content, mime))
+            elif any(mime in data for mime in DISPLAY_MIMES):
+                displays.append({"data": {mime: _text(data[mime], "Output text") for mime in DISPLAY_MIMES if mime in data}})
+        elif kind == "error":
+            error = str(output.get("evalue") or output.get("ename") or "Error")
+            text.append("\n".join(ANSI_ESCAPE.sub("", line) for line in output.get("traceback") or []) + "\n")
+        else:
+            raise ValueError(f"Unknown output type {kind!r}.")
+    return {"text": "".join(text), "error": error, "error_type": "exception" if error else None,
+            "images": images or None, "stderr": "".join(stderr), "displays": displays or None}
+
+
+def cell_from_ipynb(cell, put_image):
+    """Converts an .ipynb cell to the stored form, raw cells become markdown cells."""
+    if not isinstance(cell, dict):
+        raise ValueError("A cell must be an object.")
+    cell_type = cell.get("cell_type")
+    if cell_type not in ("code", "markdown", "raw"):
+        raise ValueError(f"Unknown cell type {cell_type!r}.")
+    source = _text(cell.get("source", ""), "source")
+    if cell_type != "code":
+        return {"cell_type": "markdown", "code": source, "output": {"text": "", "error": None, "images": None}}
+    return {"cell_type": "code", "code": source, "output": output_from_ipynb(cell.get("outputs", []), put_image)}
+
+
+def _parse_cells(stream, header):
+    """Yields the cells of an .ipynb one at a time, filling header with the top-level scalars."""
+    if ijson is None:
+        # Without ijson the whole file is parsed at once
+        notebook = json.load(stream)
+        if not isinstance(notebook, dict) or not isinstance(notebook.get("cells"), list):
+            raise ValueError("Not a notebook, cells are missing.")
+        header.update((key, value) for key, value in notebook.items() if key != "cells")
+        header["has_cells"] = True
+        yield from notebook["cells"]
+        return
+
+    builder = None
+    for prefix, event, value in ijson.parse(stream):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == "cells.item" and event in ("end_map", "end_array"):
+                yield builder.value
+                builder = None
+        elif prefix == "cells.item":
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            if event not in ("start_map", "start_array"):
+                yield builder.value  # A scalar where a cell should be, rejected by cell_from_ipynb
+                builder = None
+        elif prefix == "cells" and event == "start_array":
+            header["has_cells"] = True
+        elif prefix in ("nbformat", "nbformat_minor") and event == "number":
+            header[prefix] = value
+
+
+def read_ipynb(stream, put_image):
+    """Parses an uploaded .ipynb from a binary stream and returns its cells in the stored form.
+
+    Cells are converted as soon as they are parsed, so with ijson installed
+    only one cell's outputs are held in memory at a time; images go to
+    put_image(data, mime). Raises ValueError for anything that is not a
+    valid nbformat 4 notebook.
+    """
+    header, cells = {}, []
+    try:
+        for index, cell in enumerate(_parse_cells(stream, header)):
+            if index >= IMPORT_MAX_CELLS:
+                raise ValueError(f"Notebooks can have at most {IMPORT_MAX_CELLS} cells.")
+            try:
+                cells.append(cell_from_ipynb(cell, put_image))
+            except (ValueError, TypeError) as e:
+                raise ValueError(f"Cell {index}: {e}")
+    except (ijson.JSONError if ijson else json.JSONDecodeError, UnicodeDecodeError, EOFError, OSError) as e:
+        raise ValueError("Invalid notebook file: " + " ".join(str(e).split()))
+    if not header.get("has_cells"):
+        raise ValueError("Not a notebook, cells are missing.")
+    if header.get("nbformat") != NBFORMAT:
+        raise ValueError(f"Only nbformat {NBFORMAT} notebooks can be imported.")
+    return cells
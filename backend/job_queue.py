@@ -0,0 +1,198 @@
+import os
+import time
+import uuid
+import threading
+import contextlib
+from collections import OrderedDict, deque
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))  # Cells running at the same time
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "1000"))  # Jobs waiting across all users
+JOB_MAX_QUEUED_PER_USER = int(os.getenv("JOB_MAX_QUEUED_PER_USER", "20"))  # Jobs waiting for one user
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "3600"))  # Seconds finished jobs stay available
+
+# Job states, a job only moves forward through them
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the user's or the server's queue is full."""
+    pass
+
+
+class JobCancelled(Exception):
+    """Raised by JobQueue.executing for a job cancelled before its cell started."""
+    pass
+
+
+class JobQueue:
+    """Runs cells in background workers so HTTP requests only submit and poll.
+
+    Users take turns: workers pick the next job round-robin across users with
+    queued work, so one user queueing many cells does not hold up everyone
+    else. Jobs of the same notebook run one at a time, in submission order.
+    """
+
+    def __init__(self, run, interrupt, workers=JOB_WORKERS, max_queued=JOB_MAX_QUEUED,
+                 max_queued_per_user=JOB_MAX_QUEUED_PER_USER, result_ttl=JOB_RESULT_TTL):
+        self.run = run  # run(job) -> result, raising to fail the job
+        self.interrupt = interrupt  # interrupt(job) stops the job's cell, only called inside executing(job)
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.result_ttl = result_ttl
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._jobs = {}  # job_id -> job dict
+        self._queues = OrderedDict()  # user_id -> deque of queued jobs, next user to serve first
+        self._queued = 0
+        self._running_notebooks = set()
+
+        for _ in range(workers):
+            threading.Thread(target=self._work_loop, daemon=True).start()
+
+    def submit(self, user_id, notebook_id, code, profile=None, kind="cell"):
+        """Queues a cell and returns its job, raises QueueFull if the user or the server has too much waiting.
+
+        kind tells run what to do, "cell" runs code as a new cell and
+        "run_all" re-runs the notebook's code cells.
+        """
+        with self._lock:
+            self._purge()
+            user_queue = self._queues.get(user_id)
+            if self._queued >= self.max_queued:
+                raise QueueFull("The server has too many queued jobs, try again later.")
+            if user_queue and len(user_queue) >= self.max_queued_per_user:
+                raise QueueFull(f"You already have {len(user_queue)} queued jobs.")
+
+            job = {
+                "job_id": uuid.uuid4().hex,
+                "user_id": user_id,
+                "notebook_id": notebook_id,
+                "kind": kind,
+                "code": code,
+                "profile": profile,
+                "status": QUEUED,
+                "result": None,
+                "error": None,
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None
+            }
+            self._jobs[job["job_id"]] = job
+            self._queues.setdefault(user_id, deque()).append(job)
+            self._queued += 1
+            self._ready.notify()
+            return job
+
+    def get(self, user_id, job_id):
+        """Returns the user's job, or None if it does not exist or has expired."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["user_id"] != user_id:
+                return None
+            return job
+
+    def cancel(self, user_id, job_id):
+        """Cancels a queued job or interrupts a running one, returns the job or None if not found.
+
+        A running job whose cell has not started yet is only flagged, run
+        then skips it, see executing().
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["user_id"] != user_id:
+                return None
+            if job["status"] == QUEUED:
+                self._queues[user_id].remove(job)
+                if not self._queues[user_id]:
+                    del self._queues[user_id]
+                self._queued -= 1
+                self._finish(job, CANCELLED)
+                return job
+            if job["status"] != RUNNING:
+                return job
+            job["cancel_requested"] = True
+            # The job is marked cancelled by its worker once the kernel stops the cell. Sent under
+            # the lock, so the cell cannot end and the kernel move on to another request meanwhile.
+            if job.get("executing"):
+                self.interrupt(job)
+        return job
+
+    @contextlib.contextmanager
+    def executing(self, job):
+        """Wraps the kernel call that runs a job's cell, raising JobCancelled if the job was cancelled before.
+
+        Enter it holding the notebook's lock, cancel() only interrupts the
+        kernel while the block runs.
+        """
+        with self._lock:
+            if job.get("cancel_requested"):
+                raise JobCancelled("The job was cancelled before it started.")
+            job["executing"] = True
+        try:
+            yield
+        finally:
+            with self._lock:
+                job["executing"] = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queued,
+                "running": len(self._running_notebooks),
+                "users_waiting": len(self._queues)
+            }
+
+    def _next_job(self):
+        # Serve users round-robin, skipping notebooks that already have a job running
+        for user_id in list(self._queues):
+            user_queue = self._queues[user_id]
+            for job in user_queue:
+                if job["notebook_id"] not in self._running_notebooks:
+                    user_queue.remove(job)
+                    if user_queue:
+                        self._queues.move_to_end(user_id)
+                    else:
+                        del self._queues[user_id]
+                    self._queued -= 1
+                    return job
+        return None
+
+    def _work_loop(self):
+        while True:
+            with self._lock:
+                job = self._next_job()
+                while job is None:
+                    self._ready.wait()
+                    job = self._next_job()
+                job["status"] = RUNNING
+                job["started_at"] = time.time()
+                self._running_notebooks.add(job["notebook_id"])
+
+            try:
+                result, error = self.run(job), None
+            except Exception as e:
+                result, error = None, str(e)
+
+            with self._lock:
+                self._running_notebooks.discard(job["notebook_id"])
+                job["result"] = result
+                job["error"] = error
+                if job.get("cancel_requested"):
+                    self._finish(job, CANCELLED)
+                else:
+                    self._finish(job, FAILED if error else DONE)
+                # The notebook's next job may be waiting on this one
+                self._ready.notify_all()
+
+    def _finish(self, job, status):
+        job["status"] = status
+        job["finished_at"] = time.time()
+        job["code"] = None  # Only the result is kept around once the job is over
+
+    def _purge(self):
+        cutoff = time.time() - self.result_ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job["status"] in FINISHED and job["finished_at"] < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
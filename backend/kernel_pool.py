@@ -0,0 +1,425 @@
+import os
+import time
+import signal
+import resource
+import atexit
+import random
+import threading
+import contextlib
+import importlib
+import multiprocessing
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+from collections import OrderedDict
+
+from executor import CodeExecutor, PendingInterrupt, EXECUTION_TIMEOUT, EXECUTION_CPU_LIMIT
+from code_cache import code_cache
+from namespace_tracker import NamespaceTracker
+from spill import NamespaceSpiller
+
+# Pool sizing, overridable from the .env file
+KERNEL_POOL_SIZE = int(os.getenv("KERNEL_POOL_SIZE", "8"))  # Max notebooks with a live kernel
+KERNEL_WARM_SPARES = int(os.getenv("KERNEL_WARM_SPARES", "2"))  # Idle kernels kept ready to bind
+KERNEL_PRELOAD = [m for m in os.getenv("KERNEL_PRELOAD", "numpy,pandas,matplotlib.pyplot").split(",") if m]
+KERNEL_MEMORY_LIMIT_MB = int(os.getenv("KERNEL_MEMORY_LIMIT_MB", "4096"))  # Address space per kernel, 0 disables
+KERNEL_KILL_GRACE = 5  # Seconds past the cell timeout before an unresponsive kernel is killed
+EXECUTION_KILL_AFTER = EXECUTION_TIMEOUT + KERNEL_KILL_GRACE if EXECUTION_TIMEOUT else None
+
+
+class KernelError(Exception):
+    """Raised when a kernel process fails or can no longer be reached."""
+    pass
+
+
+class KernelTimeout(KernelError):
+    """Raised when a kernel ignored its cell timeout and had to be killed."""
+    pass
+
+
+class KernelServer:
+    """Runs inside a kernel process and answers commands sent by a Kernel handle."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        # Cells stream stdout and stderr from flusher threads, every send to the pipe goes through this lock
+        self.send_lock = threading.Lock()
+        self.globals = {"__builtins__": __builtins__}
+        self.executor = CodeExecutor(timeout=EXECUTION_TIMEOUT, cpu_limit=EXECUTION_CPU_LIMIT)
+        self.tracker = NamespaceTracker()
+        self.spiller = NamespaceSpiller()
+
+    def serve(self):
+        while True:
+            try:
+                method, args, kwargs = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            if method == "shutdown":
+                break
+            handler = getattr(self, f"do_{method}", None)
+            try:
+                if handler is None:
+                    raise KernelError(f"Unknown kernel command: {method}")
+                reply = ("result", handler(*args, **kwargs))
+            except BaseException as e:
+                reply = ("error", f"{type(e).__name__}: {e}")
+            try:
+                with self.send_lock:
+                    self.conn.send(reply)
+            except OSError:
+                break
+        os._exit(0)
+
+    def do_ping(self):
+        return os.getpid()
+
+    def emit(self, kind, value):
+        """Sends an event to the web worker before the command's result."""
+        with self.send_lock:
+            self.conn.send(("stream", (kind, value)))
+
+    @contextlib.contextmanager
+    def catch_interrupts(self):
+        """Remembers a SIGINT that arrives outside the cell, the cell then does not start, see CodeExecutor.limits."""
+        handler = PendingInterrupt()
+        previous = signal.signal(signal.SIGINT, handler)
+        try:
+            yield handler
+        finally:
+            signal.signal(signal.SIGINT, previous)
+
+    def do_execute(self, code, stream=False, profile=None):
+        with self.catch_interrupts():
+            return self.executor.capture_output(code, self.globals, sink=self.emit if stream else None, profile=profile)
+
+    def do_execute_batch(self, codes, stop_on_error=False, stream=False, profile=None):
+        """Runs cells in order, sending each result as a ("cell_result", (index, result)) event.
+
+        Returns the number of cells that ran. An interrupt stops the batch,
+        also one that arrives between two cells.
+        """
+        with self.catch_interrupts() as interrupted:
+            for index, code in enumerate(codes):
+                result = self.executor.capture_output(code, self.globals, sink=self.emit if stream else None, profile=profile)
+                self.emit("cell_result", (index, result))
+                if interrupted.pending or result["error_type"] == "interrupted" or (stop_on_error and result["error"]):
+                    return index + 1
+            return len(codes)
+
+    def do_reset(self):
+        """Clears the globals. The tracker still knows what was saved, so the next save deletes it."""
+        self.globals.clear()
+        self.globals["__builtins__"] = __builtins__
+
+    def do_load_namespace(self, state):
+        self.tracker.reset()
+        return self.tracker.load(state, self.globals)
+
+    def do_dump_changes(self):
+        return self.tracker.changes(self.globals)
+
+    def do_confirm_saved(self):
+        self.tracker.confirm()
+
+    def do_assume_saved(self, hashes):
+        """Makes the tracker compare against the given stored {name: hash}, e.g. after restoring a snapshot."""
+        self.tracker.assume_saved(hashes)
+
+    def do_spill(self):
+        """Moves large arrays and frames into memory-mapped files while the notebook is idle."""
+        return self.spiller.spill(self.globals)
+
+    def do_fork(self, reseed=True):
+        """Forks a copy of this kernel that serves the connection handed over after the command."""
+        fd = reduction.recv_handle(self.conn)
+        pid = os.fork()
+        if pid == 0:
+            # Double fork so the new kernel is reparented and never becomes our zombie
+            if os.fork() != 0:
+                os._exit(0)
+            self.conn.close()
+            self.conn = Connection(fd)
+            if reseed:
+                _reseed()
+            self.conn.send(("ready", os.getpid()))
+            self.serve()
+        os.close(fd)
+        os.waitpid(pid, 0)
+
+
+def _reseed():
+    """Forked kernels must not share the random state of their parent."""
+    random.seed()
+    try:
+        import numpy
+        numpy.random.seed()
+    except ImportError:
+        pass
+
+
+def _run_template(conn):
+    """Entry point of the template process every kernel is forked from."""
+    # Kernels only react to SIGINT while a cell runs, see CodeExecutor.limits
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for module in KERNEL_PRELOAD:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    # Kernels inherit the compiled cells loaded here
+    code_cache.warm()
+    # Inherited by every kernel, so one cell cannot take the whole host's memory
+    if KERNEL_MEMORY_LIMIT_MB:
+        limit = KERNEL_MEMORY_LIMIT_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    server = KernelServer(conn)
+    conn.send(("ready", os.getpid()))
+    server.serve()
+
+
+class Kernel:
+    """Handle used by the web worker to talk to one kernel process."""
+
+    def __init__(self, conn, pid):
+        self.conn = conn
+        self.pid = pid
+        self.notebook_id = None
+        self.lock = threading.Lock()
+
+    def call(self, method, *args, kill_after=None, **kwargs):
+        for kind, value in self.stream(method, *args, kill_after=kill_after, **kwargs):
+            pass
+        return value
+
+    def stream(self, method, *args, kill_after=None, **kwargs):
+        """Yields the ("stream", event) messages a command sends while it runs, then ("result", value).
+
+        The kernel blocks once the connection's buffer is full, so a slow
+        reader holds back a chatty cell instead of letting output pile up.
+        With kill_after, a kernel that has not answered within that many
+        seconds is killed and KernelTimeout is raised.
+        """
+        with self.lock:
+            done = False
+            try:
+                self.conn.send((method, args, kwargs))
+                deadline = time.monotonic() + kill_after if kill_after else None
+                while True:
+                    if deadline and not self.conn.poll(max(deadline - time.monotonic(), 0)):
+                        done = True
+                        self.kill()
+                        raise KernelTimeout(f"Kernel {self.pid} did not stop after {kill_after}s and was killed.")
+                    kind, value = self.conn.recv()
+                    if kind == "error":
+                        done = True
+                        raise KernelError(value)
+                    done = kind == "result"
+                    yield kind, value
+                    if done:
+                        return
+            except (EOFError, OSError) as e:
+                done = True
+                raise KernelError(f"Kernel {self.pid} is not responding.") from e
+            finally:
+                if not done:
+                    self._drain()
+
+    def _drain(self):
+        # The reader went away mid-command, discard the rest so the next command gets its own reply
+        try:
+            while self.conn.recv()[0] == "stream":
+                pass
+        except (EOFError, OSError):
+            pass
+
+    def fork(self, reseed=True):
+        """Returns a new Kernel forked from this one, sharing its loaded modules and state.
+
+        Memory is copy-on-write, so forking a kernel holding large data is cheap.
+        Without reseed the copy also keeps the random number generators' state.
+        """
+        parent_conn, child_conn = multiprocessing.Pipe()
+        try:
+            with self.lock:
+                try:
+                    self.conn.send(("fork", (), {"reseed": reseed}))
+                    reduction.send_handle(self.conn, child_conn.fileno(), self.pid)
+                    kind, value = self.conn.recv()
+                except (EOFError, OSError) as e:
+                    raise KernelError(f"Kernel {self.pid} is not responding.") from e
+        finally:
+            child_conn.close()
+        if kind == "error":
+            parent_conn.close()
+            raise KernelError(value)
+        _, pid = parent_conn.recv()
+        return Kernel(parent_conn, pid)
+
+    def is_alive(self):
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        return not self.conn.closed
+
+    def shutdown(self):
+        try:
+            self.conn.send(("shutdown", (), {}))
+        except (OSError, ValueError):
+            pass
+        self.kill()
+
+    def interrupt(self):
+        """Stops the cell the kernel is running with a KeyboardInterrupt, keeping its globals."""
+        try:
+            os.kill(self.pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+
+    def kill(self):
+        self.conn.close()
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+class KernelPool:
+    """Pre-imported kernel processes, one bound to each active notebook.
+
+    Kernels are forked from a template process that has already imported the
+    heavy libraries, and a few warm spares are kept around so binding a new
+    notebook does not wait on a fork.
+    """
+
+    def __init__(self, size=KERNEL_POOL_SIZE, spares=KERNEL_WARM_SPARES):
+        self.size = size
+        self.spares = spares
+        self.on_evict = None  # Called with (notebook_id, kernel) before an evicted kernel is shut down
+        self._lock = threading.Lock()
+        self._bound = OrderedDict()  # notebook_id -> Kernel, least recently used first
+        self._forking = set()  # Notebooks whose kernel is being forked, outside the lock
+        self._forked = threading.Condition(self._lock)
+        self._idle = []
+        self._filling = False
+
+        ctx = multiprocessing.get_context("fork")
+        parent_conn, child_conn = ctx.Pipe()
+        self._template_process = ctx.Process(target=_run_template, args=(child_conn,), daemon=True)
+        self._template_process.start()
+        child_conn.close()
+        _, pid = parent_conn.recv()
+        self._template = Kernel(parent_conn, pid)
+
+        self._fill_spares()
+        atexit.register(self.shutdown)
+
+    def acquire(self, notebook_id):
+        """Returns (kernel, is_new) for a notebook, binding a warm spare if it has no kernel yet.
+
+        Without a spare a kernel is forked for the notebook. The fork happens
+        outside the pool's lock, so requests for other notebooks do not wait
+        on it; one for the same notebook waits and gets the forked kernel.
+        """
+        evicted = []
+        with self._lock:
+            while notebook_id in self._forking:
+                self._forked.wait()
+            kernel = self._bound.get(notebook_id)
+            if kernel is not None and kernel.is_alive():
+                self._bound.move_to_end(notebook_id)
+                return kernel, False
+            self._bound.pop(notebook_id, None)
+            # Kernels still being forked take their place too
+            while self._bound and len(self._bound) + len(self._forking) >= self.size:
+                evicted.append(self._bound.popitem(last=False))
+            kernel = self._idle.pop() if self._idle else None
+            if kernel is None:
+                self._forking.add(notebook_id)
+            else:
+                kernel.notebook_id = notebook_id
+                self._bound[notebook_id] = kernel
+
+        for evicted_id, evicted_kernel in evicted:
+            self._evict(evicted_id, evicted_kernel)
+        if kernel is None:
+            try:
+                kernel = self._template.fork()
+            finally:
+                with self._lock:
+                    self._forking.discard(notebook_id)
+                    if kernel is not None:
+                        kernel.notebook_id = notebook_id
+                        self._bound[notebook_id] = kernel
+                    self._forked.notify_all()
+        threading.Thread(target=self._fill_spares, daemon=True).start()
+        return kernel, True
+
+    def bind(self, notebook_id, kernel):
+        """Makes a kernel, e.g. one forked from a snapshot, the notebook's kernel, shutting down the one it replaces."""
+        evicted = []
+        with self._lock:
+            replaced = self._bound.pop(notebook_id, None)
+            while len(self._bound) >= self.size:
+                evicted.append(self._bound.popitem(last=False))
+            kernel.notebook_id = notebook_id
+            self._bound[notebook_id] = kernel
+
+        if replaced is not None:
+            replaced.shutdown()
+        for evicted_id, evicted_kernel in evicted:
+            self._evict(evicted_id, evicted_kernel)
+
+    def get(self, notebook_id):
+        """Returns the kernel bound to a notebook, or None if it has none."""
+        with self._lock:
+            return self._bound.get(notebook_id)
+
+    def release(self, notebook_id):
+        """Shuts down the kernel bound to a notebook, dropping its in-memory state."""
+        with self._lock:
+            kernel = self._bound.pop(notebook_id, None)
+        if kernel is not None:
+            kernel.shutdown()
+
+    def _evict(self, notebook_id, kernel):
+        if self.on_evict:
+            try:
+                self.on_evict(notebook_id, kernel)
+            except Exception as e:
+                print(f"Error evicting kernel for {notebook_id}: {e}")
+        kernel.shutdown()
+
+    def _fill_spares(self):
+        with self._lock:
+            if self._filling:
+                return
+            self._filling = True
+        try:
+            while True:
+                with self._lock:
+                    if len(self._idle) >= self.spares:
+                        return
+                try:
+                    kernel = self._template.fork()
+                except KernelError as e:
+                    print(f"Error forking spare kernel: {e}")
+                    return
+                with self._lock:
+                    self._idle.append(kernel)
+        finally:
+            self._filling = False
+
+    def stats(self):
+        with self._lock:
+            return {"bound": len(self._bound), "spare": len(self._idle), "size": self.size}
+
+    def shutdown(self):
+        with self._lock:
+            kernels = list(self._bound.values()) + self._idle
+            self._bound.clear()
+            self._idle = []
+        for kernel in kernels:
+            kernel.shutdown()
+        if self._template_process.is_alive():
+            self._template.shutdown()
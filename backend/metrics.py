@@ -0,0 +1,181 @@
+import math
+import bisect
+import threading
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(11))  # 1KB to 1GB
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """The metrics of this process, rendered in the Prometheus text format.
+
+    Each worker process has its own registry, so a multi-process server is
+    scraped per process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered.")
+            self._metrics[metric.name] = metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+class Metric:
+    """Base of the metric types, values are kept per tuple of label values."""
+    type = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        registry.register(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} takes the labels {', '.join(self.labels) or 'none'}.")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _items(self):
+        with self._lock:
+            return list(self._values.items())
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in self._items()]
+
+
+class Gauge(Metric):
+    """A value that goes up and down, set directly or read from function when scraped.
+
+    function returns the value, or for a gauge with labels a dict from
+    tuples of label values to values.
+    """
+    type = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None, registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        if self.function is None:
+            items = self._items()
+        else:
+            try:
+                values = self.function()
+            except Exception as e:
+                print(f"Error reading metric {self.name}: {e}")
+                return []
+            items = values.items() if isinstance(values, dict) else [((), values)]
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS, registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]  # per-bucket counts, sum, count
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _items(self):
+        with self._lock:
+            return [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+
+    def render(self):
+        lines = []
+        for key, (counts, total, count) in self._items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+# Metrics recorded across modules, gauges reading app state are defined where that state lives
+request_duration = Histogram(
+    "http_request_duration_seconds", "Time to produce a response, streamed bodies not included.",
+    labels=("method", "route", "status"))
+stage_duration = Histogram(
+    "notebook_stage_duration_seconds", "Time spent in each stage of a request.", labels=("stage",))
+execution_duration = Histogram(
+    "notebook_execution_duration_seconds", "Time kernels took to run cells, per endpoint kind.", labels=("mode",))
+cell_results = Counter(
+    "notebook_cell_results_total", "Executed cells by outcome.", labels=("error_type",))
+job_queue_wait = Histogram(
+    "notebook_job_queue_wait_seconds", "Time jobs waited in the queue before running.")
+mongo_command_duration = Histogram(
+    "mongodb_command_duration_seconds", "MongoDB command latency.", labels=("command",))
+mongo_command_failures = Counter(
+    "mongodb_command_failures_total", "MongoDB commands that failed.", labels=("command",))
+namespace_variable_bytes = Histogram(
+    "notebook_namespace_variable_bytes", "Size of stored notebook variables.", labels=("codec",),
+    buckets=SIZE_BUCKETS)
+images_rendered = Counter("notebook_images_total", "Plots rendered by cells.", labels=("mime",))
+image_bytes = Counter("notebook_image_bytes_total", "Bytes of plots rendered by cells.", labels=("mime",))
+plot_render_duration = Histogram(
+    "notebook_plot_render_seconds", "Time a cell spent rendering its figures.")
@@ -0,0 +1,144 @@
+"""Moves notebooks from the old one-document-per-user user_sessions collection
+into the users, notebooks, cells and variables collections used by NotebookStore.
+
+Usage: python migrate_storage.py [--delete-source]
+
+Notebooks that were already migrated are skipped, so the script can be re-run
+safely. A notebook whose id is taken, e.g. by another one created in the same
+second, gets a suffixed id. With --delete-source, each user document is
+removed from user_sessions once all of its notebooks, cells and variables are
+confirmed to be in the new collections.
+"""
+import os
+import sys
+import time
+from pymongo import MongoClient, InsertOne
+from dotenv import load_dotenv
+
+from storage import NotebookStore
+
+
+def find_migrated(store, user_id, notebook, index):
+    """Returns the id the notebook was migrated to, or None if it was not migrated yet."""
+    source = {"user_id": user_id, "notebook_id": notebook["notebook_id"], "index": index}
+    migrated = store.notebooks.find_one({"migrated_from": source}, {"notebook_id": 1})
+    if migrated:
+        return migrated["notebook_id"]
+    # Runs before migrated_from was recorded kept the id and, if it was taken, suffixed the name
+    legacy = store.notebooks.find_one({"notebook_id": notebook["notebook_id"], "user_id": user_id,
+                                       "migrated_from": {"$exists": False}})
+    if legacy and legacy["notebook_name"] in (notebook["notebook_name"],
+                                               f"{notebook['notebook_name']} ({notebook['notebook_id']})"):
+        return legacy["notebook_id"]
+    return None
+
+
+def free_notebook_id(store, notebook_id, index):
+    """The notebook's id, with a suffix if another notebook has it, e.g. one created in the same second."""
+    candidate, attempt = notebook_id, 0
+    while store.notebooks.count_documents({"notebook_id": candidate}, limit=1):
+        attempt += 1
+        candidate = f"{notebook_id}_{index}" if attempt == 1 else f"{notebook_id}_{index}_{attempt}"
+    return candidate
+
+
+def is_complete(store, notebook_id, notebook):
+    """Whether the notebook and all its cells and variables are in the new collections."""
+    return (store.notebooks.count_documents({"notebook_id": notebook_id}, limit=1) == 1
+            and store.cells.count_documents({"notebook_id": notebook_id}) == len(notebook.get("cells", []))
+            and store.variables.count_documents({"notebook_id": notebook_id}) == len(notebook.get("namespace") or {}))
+
+
+def migrate_notebook(store, user_id, notebook, index):
+    """Copies the user's index-th notebook, returns the id it has in the new collections."""
+    notebook_id = free_notebook_id(store, notebook["notebook_id"], index)
+    # Clear leftovers of an interrupted run before copying the notebook again
+    store.cells.delete_many({"notebook_id": notebook_id})
+    store.variables.delete_many({"notebook_id": notebook_id})
+
+    now = time.time()
+    cells = notebook.get("cells", [])
+    store.users.update_one(
+        {"user_id": user_id},
+        {"$setOnInsert": {"user_id": user_id, "created_at": now}},
+        upsert=True
+    )
+    if cells:
+        # Old cell ids were second timestamps, so cells created in the same second shared one
+        operations, seen = [], set()
+        for ordinal, cell in enumerate(cells):
+            cell_id = cell.get("cell_id") or f"cell_{ordinal}"
+            if cell_id in seen:
+                cell_id = f"{cell_id}_{ordinal}"
+            seen.add(cell_id)
+            operations.append(InsertOne(dict(cell, cell_id=cell_id, notebook_id=notebook_id, ordinal=ordinal)))
+        store.cells.bulk_write(operations, ordered=False)
+    namespace = notebook.get("namespace") or {}
+    if namespace:
+        store.variables.bulk_write([
+            InsertOne({"notebook_id": notebook_id, "name": name, "hash": variable["hash"], "data": variable["data"]})
+            for name, variable in namespace.items()
+        ], ordered=False)
+
+    # Notebook names are unique per user in the new layout
+    notebook_name = notebook["notebook_name"]
+    if store.notebook_name_exists(user_id, notebook_name):
+        notebook_name = f"{notebook_name} ({notebook_id})"
+
+    new_notebook = {
+        "notebook_id": notebook_id,
+        "user_id": user_id,
+        "notebook_name": notebook_name,
+        "created_at": now,
+        "updated_at": now,
+        "cell_count": len(cells),
+        "next_ordinal": len(cells),
+        "migrated_from": {"user_id": user_id, "notebook_id": notebook["notebook_id"], "index": index}
+    }
+    # Whole-namespace blobs are kept as they are, kernels convert them on their next save
+    if notebook.get("globals_serialized"):
+        new_notebook["globals_serialized"] = notebook["globals_serialized"]
+    # Insert the notebook last so an interrupted run is retried on the next one
+    store.notebooks.insert_one(new_notebook)
+    return notebook_id
+
+
+def main():
+    load_dotenv()
+    MONGO_URI = os.getenv("MONGO_URI")
+    if not MONGO_URI:
+        raise ValueError("MONGO_URI is not set in .env file")
+    delete_source = "--delete-source" in sys.argv[1:]
+
+    db = MongoClient(MONGO_URI)["NotebookDB"]
+    store = NotebookStore(db)
+    store.ensure_indexes()
+    store.notebooks.create_index("migrated_from", sparse=True)
+
+    migrated = skipped = kept = 0
+    for user_data in db["user_sessions"].find({}):
+        user_id = user_data["user_id"]
+        complete = True
+        for index, notebook in enumerate(user_data.get("notebooks", [])):
+            notebook_id = find_migrated(store, user_id, notebook, index)
+            if notebook_id:
+                skipped += 1
+            else:
+                notebook_id = migrate_notebook(store, user_id, notebook, index)
+                migrated += 1
+            if not is_complete(store, notebook_id, notebook):
+                print(f"Notebook {notebook['notebook_id']} of user {user_id} is incomplete in the new collections")
+                complete = False
+        if delete_source and complete:
+            db["user_sessions"].delete_one({"_id": user_data["_id"]})
+        elif delete_source:
+            kept += 1
+        print(f"Migrated user {user_id}")
+
+    print(f"Done: {migrated} notebooks migrated, {skipped} already present.")
+    if kept:
+        print(f"Kept {kept} users in user_sessions whose notebooks could not all be verified.")
+
+
+if __name__ == '__main__':
+    main()
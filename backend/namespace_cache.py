@@ -0,0 +1,248 @@
+import os
+import time
+import atexit
+import threading
+import contextlib
+from collections import OrderedDict
+
+from kernel_pool import KernelError
+from profiling import stage
+
+NAMESPACE_IDLE_TIMEOUT = int(os.getenv("NAMESPACE_IDLE_TIMEOUT", "1800"))  # Evict notebooks idle for 30 minutes
+NAMESPACE_SAVE_DELAY = float(os.getenv("NAMESPACE_SAVE_DELAY", "30"))  # Save once a notebook has been quiet this long
+NAMESPACE_SAVE_MAX_DELAY = float(os.getenv("NAMESPACE_SAVE_MAX_DELAY", "300"))  # Never leave changes unsaved longer than this
+NAMESPACE_SPILL_AFTER = float(os.getenv("NAMESPACE_SPILL_AFTER", "300"))  # Spill large values of notebooks idle this long, 0 disables
+NAMESPACE_SWEEP_INTERVAL = 5
+
+
+class NamespaceCache:
+    """Keeps notebook globals resident in their kernels between cells.
+
+    Globals are only loaded when a notebook gets a fresh kernel, and only saved
+    when the notebook is evicted (idle or least recently used), checkpointed
+    explicitly, or after a debounce delay once it stops changing. A save only
+    writes the variables that changed since the previous one. Notebooks idle
+    for spill_after have their large arrays and frames moved to memory-mapped
+    files before they are evicted, see NamespaceSpiller.
+    """
+
+    def __init__(self, pool, load, save, idle_timeout=NAMESPACE_IDLE_TIMEOUT,
+                 save_delay=NAMESPACE_SAVE_DELAY, save_max_delay=NAMESPACE_SAVE_MAX_DELAY,
+                 spill_after=NAMESPACE_SPILL_AFTER):
+        self.pool = pool
+        self.load = load  # load(notebook_id) -> stored namespace state or None
+        self.save = save  # save(notebook_id, changes) with the changed and deleted variables
+        self.idle_timeout = idle_timeout
+        self.save_delay = save_delay
+        self.save_max_delay = save_max_delay
+        self.spill_after = spill_after
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # notebook_id -> entry dict, least recently used first
+        self._skipped = {}  # notebook_id -> {name: reason} of variables the last save could not store
+        self._stopped = threading.Event()
+
+        pool.on_evict = self._on_pool_evict
+        threading.Thread(target=self._sweep_loop, daemon=True).start()
+        atexit.register(self.flush)
+
+    @contextlib.contextmanager
+    def use(self, notebook_id):
+        """Yields the notebook's kernel with its globals loaded, holding the notebook's lock."""
+        entry = self._enter(notebook_id)
+        try:
+            kernel, is_new = self.pool.acquire(notebook_id)
+            if is_new:
+                try:
+                    with stage("db_load"):
+                        state = self.load(notebook_id)
+                    with stage("deserialize"):
+                        needs_save = state and kernel.call("load_namespace", state)
+                    if needs_save:
+                        self.mark_dirty(notebook_id)
+                except Exception:
+                    self._drop(notebook_id)
+                    raise
+            yield kernel
+        finally:
+            entry["last_used"] = time.time()
+            entry["spilled"] = False  # The cell may have created new large values
+            entry["lock"].release()
+
+    def adopt(self, notebook_id, kernel):
+        """Makes a kernel forked from another notebook's this notebook's, with its globals to be saved.
+
+        Least recently used notebooks are evicted under their own locks to make
+        room, as for use(), so the pool never shuts down a kernel in use.
+        """
+        entry = self._enter(notebook_id)
+        try:
+            self.pool.bind(notebook_id, kernel)
+            self.mark_dirty(notebook_id)
+        finally:
+            entry["last_used"] = time.time()
+            entry["lock"].release()
+
+    def mark_dirty(self, notebook_id):
+        """Records that the notebook's globals changed and need saving eventually."""
+        with self._lock:
+            entry = self._entries.get(notebook_id)
+        if entry is not None:
+            now = time.time()
+            entry["changed_at"] = now
+            if entry["dirty_since"] is None:
+                entry["dirty_since"] = now
+
+    def checkpoint(self, notebook_id):
+        """Saves the notebook's globals now if they changed since the last save."""
+        with self._lock:
+            entry = self._entries.get(notebook_id)
+        if entry is None:
+            return False
+        with entry["lock"]:
+            return self._persist(notebook_id, entry)
+
+    def evict(self, notebook_id):
+        """Saves the notebook's globals and frees its kernel."""
+        with self._lock:
+            entry = self._entries.get(notebook_id)
+        if entry is None:
+            return
+        with entry["lock"]:
+            try:
+                self._persist(notebook_id, entry)
+            finally:
+                self._drop(notebook_id)
+
+    def skipped(self, notebook_id):
+        """Returns {name: reason} for the variables the notebook's last save left out."""
+        return self._skipped.get(notebook_id, {})
+
+    def stats(self):
+        with self._lock:
+            entries = list(self._entries.values())
+        return {
+            "active": len(entries),
+            "dirty": sum(1 for entry in entries if entry["dirty_since"] is not None),
+            "spilled": sum(1 for entry in entries if entry["spilled"])
+        }
+
+    def discard(self, notebook_id):
+        """Frees the notebook's kernel without saving, e.g. when the notebook is deleted."""
+        self._drop(notebook_id)
+
+    def flush(self):
+        """Saves every notebook with unsaved changes."""
+        with self._lock:
+            notebook_ids = list(self._entries)
+        for notebook_id in notebook_ids:
+            try:
+                self.checkpoint(notebook_id)
+            except KernelError as e:
+                print(f"Error saving globals for {notebook_id}: {e}")
+
+    def _persist(self, notebook_id, entry):
+        if entry["dirty_since"] is None:
+            return False
+        kernel = self.pool.get(notebook_id)
+        if kernel is None:
+            return False
+        self._save_changes(notebook_id, kernel)
+        entry["dirty_since"] = None
+        entry["changed_at"] = None
+        return True
+
+    def _save_changes(self, notebook_id, kernel):
+        with stage("serialize"):
+            changes = kernel.call("dump_changes")
+        for name, error in changes["errors"].items():
+            print(f"Skipped saving {name} in {notebook_id}: {error}")
+        self._skipped[notebook_id] = changes["errors"]
+        if changes["changed"] or changes["deleted"]:
+            with stage("db_write"):
+                self.save(notebook_id, changes)
+        kernel.call("confirm_saved")
+
+    def _spill(self, notebook_id, entry):
+        kernel = self.pool.get(notebook_id)
+        if kernel is None:
+            return
+        entry["spilled"] = True  # Not retried on every sweep if it fails
+        result = kernel.call("spill")
+        if result["spilled"]:
+            print(f"Spilled {', '.join(result['spilled'])} of {notebook_id} to disk ({result['bytes'] // 2 ** 20} MB)")
+
+    def _drop(self, notebook_id):
+        # The kernel goes before the entry, so the pool never holds more kernels than there are entries
+        self.pool.release(notebook_id)
+        with self._lock:
+            self._entries.pop(notebook_id, None)
+            self._skipped.pop(notebook_id, None)
+
+    def _enter(self, notebook_id):
+        """Returns the notebook's entry, created if needed, with its lock held.
+
+        A new entry takes its place under the same lock that checks there is
+        room, so concurrent requests never make the pool evict a kernel itself.
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(notebook_id)
+                victim = None
+                if entry is None and len(self._entries) >= self.pool.size:
+                    victim = next(iter(self._entries))
+                elif entry is None:
+                    entry = {"lock": threading.RLock(), "last_used": time.time(),
+                             "dirty_since": None, "changed_at": None, "spilled": False}
+                    self._entries[notebook_id] = entry
+                if entry is not None:
+                    self._entries.move_to_end(notebook_id)
+            if victim is not None:
+                # Evict the least recently used notebook ourselves so it is saved before its kernel goes
+                self.evict(victim)
+                continue
+            entry["lock"].acquire()
+            # The notebook may have been evicted while we waited for its lock
+            with self._lock:
+                if self._entries.get(notebook_id) is entry:
+                    return entry
+            entry["lock"].release()
+
+    def _on_pool_evict(self, notebook_id, kernel):
+        # Not reached while _enter keeps room, the pool shuts the kernel down once this returns so wait out its cell
+        with self._lock:
+            entry = self._entries.get(notebook_id)
+        if entry is None:
+            return
+        with entry["lock"]:
+            with self._lock:
+                if self._entries.get(notebook_id) is entry:
+                    del self._entries[notebook_id]
+                self._skipped.pop(notebook_id, None)
+            if entry["dirty_since"] is not None:
+                self._save_changes(notebook_id, kernel)
+
+    def _sweep_loop(self):
+        while not self._stopped.wait(NAMESPACE_SWEEP_INTERVAL):
+            now = time.time()
+            with self._lock:
+                entries = list(self._entries.items())
+            for notebook_id, entry in entries:
+                # Skip notebooks that are busy running a cell, the next sweep will catch them
+                if not entry["lock"].acquire(blocking=False):
+                    continue
+                try:
+                    if now - entry["last_used"] > self.idle_timeout:
+                        self.evict(notebook_id)
+                    elif entry["dirty_since"] is not None and (
+                            now - entry["changed_at"] >= self.save_delay
+                            or now - entry["dirty_since"] >= self.save_max_delay):
+                        self._persist(notebook_id, entry)
+                    elif self.spill_after and not entry["spilled"] and now - entry["last_used"] > self.spill_after:
+                        self._spill(notebook_id, entry)
+                except Exception as e:
+                    print(f"Error saving or spilling globals for {notebook_id}: {e}")
+                finally:
+                    entry["lock"].release()
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,194 @@
+import os
+import types
+import pickle
+import hashlib
+
+import dill
+
+from serializer import serializer as default_serializer
+
+# Values of these types cannot change in place, so an unchanged binding means an unchanged value
+IMMUTABLE_TYPES = (int, float, complex, bool, str, bytes, type(None), range, frozenset)
+# Values whose identity does not matter, other variables store copies of them instead of references
+REFERENCE_FREE_TYPES = IMMUTABLE_TYPES + (types.ModuleType,)
+# Stored in place of the globals dict itself, e.g. for g = globals()
+GLOBALS_REFERENCE = "<globals>"
+# Each variable is one MongoDB document, which cannot exceed 16 MB with its name and hash
+NAMESPACE_MAX_VARIABLE_SIZE = int(os.getenv("NAMESPACE_MAX_VARIABLE_SIZE", str(16 * 1024 * 1024 - 64 * 1024)))
+
+
+def _reaches(refs, start, target):
+    """Whether target can be reached from start following the references of the variables stored so far."""
+    seen, stack = set(), [start]
+    while stack:
+        name = stack.pop()
+        if name == target:
+            return True
+        if name not in seen:
+            seen.add(name)
+            stack.extend(refs.get(name, ()))
+    return False
+
+
+def fingerprint(value):
+    """Hashes arrays and frames straight from their buffers, None for anything that must be pickled first."""
+    module = type(value).__module__
+    try:
+        # Spilled arrays are memmaps, they must hash the same as the array they replaced
+        if module == "numpy" and type(value).__name__ in ("ndarray", "memmap") and value.dtype != object:
+            import numpy
+            digest = hashlib.sha256(f"ndarray:{value.dtype.str}:{value.shape}".encode())
+            digest.update(numpy.ascontiguousarray(value).data)
+            return digest.hexdigest()
+        if module.startswith("pandas") and type(value).__name__ in ("DataFrame", "Series"):
+            import pandas
+            header = value.dtypes if hasattr(value, "columns") else (value.name, value.dtype)
+            digest = hashlib.sha256(f"{type(value).__name__}:{header}".encode())
+            digest.update(pandas.util.hash_pandas_object(value, index=True).values.tobytes())
+            return digest.hexdigest()
+    except Exception:
+        return None
+    return None
+
+
+class NamespaceTracker:
+    """Tracks which variables of a kernel's globals changed since they were last saved.
+
+    Each variable is stored on its own, keyed by name with a content hash, so
+    a save only carries the variables that were added, rebound or mutated.
+    An object that is the value of another variable is stored as a reference
+    to that variable's name, so aliases (a = b = []), objects shared between
+    variables and instances of classes defined in the notebook are the same
+    objects again after a reload.
+    """
+
+    def __init__(self, serializer=default_serializer):
+        self.serializer = serializer
+        self._saved = {}  # name -> (hash, value if immutable)
+        self._pending = None
+
+    def load(self, state, namespace):
+        """Fills namespace from a stored state, returns True if it should be saved again right away."""
+        needs_save = False
+        if state.get("globals_serialized"):
+            # Notebooks saved before per-variable storage keep one blob for the whole namespace
+            namespace.update(dill.loads(state["globals_serialized"]))
+            needs_save = True
+        variables = state.get("namespace") or {}
+        loaded, failed, loading = {}, {}, set()
+
+        def load_variable(name):
+            # Also the persistent_load of the variables that refer to this one
+            if name == GLOBALS_REFERENCE:
+                return namespace
+            if name in loaded:
+                return loaded[name]
+            if name in failed:
+                raise failed[name]
+            if name not in variables or name in loading:
+                raise pickle.UnpicklingError(f"variable {name} is not stored")
+            loading.add(name)
+            try:
+                loaded[name] = self.serializer.loads(variables[name]["data"], persistent_load=load_variable)
+            except Exception as e:
+                failed[name] = e
+                raise
+            finally:
+                loading.discard(name)
+            return loaded[name]
+
+        for name, variable in variables.items():
+            try:
+                value = load_variable(name)
+            except Exception as e:
+                print(f"Error loading variable {name}: {e}")
+                continue
+            namespace[name] = value
+            self._saved[name] = (variable["hash"], value if isinstance(value, IMMUTABLE_TYPES) else None)
+        return needs_save
+
+    def changes(self, namespace):
+        """Serializes only the variables that differ from what was last saved."""
+        names = [name for name in namespace if name != "__builtins__" and name.isidentifier()]
+        # Objects other variables may refer to, each by one name that stays the same from save to save
+        owners = {}
+        for name in sorted(names):
+            if not isinstance(namespace[name], REFERENCE_FREE_TYPES):
+                owners.setdefault(id(namespace[name]), name)
+
+        changed, errors, saved, refs = {}, {}, {}, {}
+        # Data first, so it refers to the functions and classes it uses. Their pickles carry a
+        # copy of the globals, which refers back to the data only where that makes no cycle.
+        pending = sorted(names, key=lambda name: isinstance(namespace[name], (types.FunctionType, type)))
+        while pending:
+            for name in pending:
+                self._track(name, namespace, owners, refs, changed, errors, saved)
+            # A variable that could not be stored cannot be referred to, the others store a copy instead
+            failed = {name for name in errors if owners.get(id(namespace[name])) == name}
+            for name in failed:
+                del owners[id(namespace[name])]
+            pending = [name for name in saved if refs.get(name, set()) & failed]
+            for name in pending:
+                del saved[name]
+                changed.pop(name, None)
+
+        deleted = [name for name in self._saved if name not in saved]
+        self._pending = saved
+        return {"changed": changed, "deleted": deleted, "errors": errors}
+
+    def _track(self, name, namespace, owners, refs, changed, errors, saved):
+        value = namespace[name]
+        previous = self._saved.get(name)
+        if previous and isinstance(value, IMMUTABLE_TYPES) and previous[1] is value:
+            saved[name] = previous
+            return
+
+        owner = owners.get(id(value))
+        # Another name for an object is stored as a reference to it, however large it is
+        digest = fingerprint(value) if owner in (None, name) else None
+        if digest is not None and previous and previous[0] == digest:
+            saved[name] = previous
+            return
+
+        name_refs = refs[name] = set()
+
+        def reference(obj):
+            if obj is namespace:
+                return GLOBALS_REFERENCE
+            target = owners.get(id(obj))
+            # No references in a cycle, a variable is loaded after the ones it refers to
+            if target is None or target == name or _reaches(refs, target, name):
+                return None
+            name_refs.add(target)
+            return target
+
+        try:
+            data = self.serializer.dumps(value, persistent_id=reference)
+        except Exception as e:
+            errors[name] = str(e)
+            return
+        if len(data) > NAMESPACE_MAX_VARIABLE_SIZE:
+            errors[name] = (f"{len(data) / 2 ** 20:.1f} MB when stored, over the "
+                            f"{NAMESPACE_MAX_VARIABLE_SIZE / 2 ** 20:.1f} MB a variable can take")
+            return
+        if digest is None:
+            digest = hashlib.sha256(data).hexdigest()
+        saved[name] = (digest, value if isinstance(value, IMMUTABLE_TYPES) else None)
+        if not previous or previous[0] != digest:
+            changed[name] = {"hash": digest, "data": data}
+
+    def confirm(self):
+        """Marks the last computed changes as written."""
+        if self._pending is not None:
+            self._saved = self._pending
+            self._pending = None
+
+    def assume_saved(self, hashes):
+        """Treats {name: hash} as what is stored, so the next save writes the difference to it."""
+        self._saved = {name: (digest, None) for name, digest in hashes.items()}
+        self._pending = None
+
+    def reset(self):
+        """Forgets what was saved so the next save writes every variable."""
+        self._saved = {}
+        self._pending = None
@@ -0,0 +1,194 @@
+import io
+import os
+import math
+import time
+import weakref
+import threading
+import contextlib
+import contextvars
+from collections import OrderedDict
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib._pylab_helpers import Gcf
+
+import thread_context  # Threads a cell starts inherit its figure scope
+
+PLOT_FORMAT = os.getenv("PLOT_FORMAT", "png")  # png, svg, webp or jpeg
+PLOT_DPI = int(os.getenv("PLOT_DPI", "100"))
+PLOT_QUALITY = int(os.getenv("PLOT_QUALITY", "80"))  # webp and jpeg quality, 1 to 100
+PLOT_MAX_PIXELS = int(os.getenv("PLOT_MAX_PIXELS", "4000000"))  # Larger figures are rendered at a lower DPI
+PLOT_MAX_FIGURES = int(os.getenv("PLOT_MAX_FIGURES", "20"))  # Figures kept per cell
+PLOT_MAX_BYTES = int(os.getenv("PLOT_MAX_BYTES", str(10 * 1024 * 1024)))  # Image bytes kept per cell
+PLOT_TIGHT = os.getenv("PLOT_TIGHT", "1") == "1"  # Crop to the drawn area, costs an extra layout pass
+MIMES = {"png": "image/png", "svg": "image/svg+xml", "webp": "image/webp", "jpeg": "image/jpeg"}
+LOSSY = ("webp", "jpeg")  # Written through Pillow, which matplotlib depends on, with a quality setting
+
+
+class FigureRegistry:
+    """Stands in for pyplot's process-wide figure registry, Gcf.figs.
+
+    Inside figure_scope() the code run gets a registry of its own, so pyplot
+    calls (plt.figure, plt.gcf, plt.get_fignums, plt.close('all')) only see
+    the figures created in that scope. The registry is a context variable,
+    which threads a cell starts inherit (see thread_context). Outside any
+    scope, or once the scope ended, the original shared registry is used.
+    """
+
+    def __init__(self, shared):
+        self._shared = shared
+        self._figs = contextvars.ContextVar("figures", default=None)
+        self._active = []  # Registries of the scopes open on any thread
+        self._lock = threading.Lock()
+
+    def current(self):
+        figs = self._figs.get()
+        if figs is None:
+            return self._shared
+        with self._lock:
+            # By identity, two empty registries compare equal
+            active = any(other is figs for other in self._active)
+        return figs if active else self._shared
+
+    def open_scope(self, figs):
+        """Makes figs the registry of the current context, returns the token close_scope takes."""
+        with self._lock:
+            self._active.append(figs)
+        return self._figs.set(figs)
+
+    def close_scope(self, figs, token):
+        with self._lock:
+            self._active = [active for active in self._active if active is not figs]
+        self._figs.reset(token)
+
+    def __getattr__(self, name):
+        # get, pop, values, clear, move_to_end and the rest of the OrderedDict interface
+        return getattr(self.current(), name)
+
+    def __len__(self):
+        return len(self.current())
+
+    def __iter__(self):
+        return iter(self.current())
+
+    def __contains__(self, num):
+        return num in self.current()
+
+    def __getitem__(self, num):
+        return self.current()[num]
+
+    def __setitem__(self, num, manager):
+        self.current()[num] = manager
+
+    def __delitem__(self, num):
+        del self.current()[num]
+
+
+if not isinstance(Gcf.figs, FigureRegistry):
+    Gcf.figs = FigureRegistry(Gcf.figs)
+
+
+@contextlib.contextmanager
+def figure_scope():
+    """Gives the code run in the block its own pyplot figures and closes them when it ends.
+
+    Concurrent executions cannot draw into, save or close each other's
+    figures. Figure objects created in the block stay usable afterwards,
+    they are only no longer open in pyplot.
+    """
+    figs = OrderedDict()
+    token = Gcf.figs.open_scope(figs)
+    try:
+        yield
+    finally:
+        try:
+            Gcf.destroy_all()
+        finally:
+            Gcf.figs.close_scope(figs, token)
+
+
+class PlotRenderer:
+    """Renders matplotlib figures to images in one configured format.
+
+    A figure is rendered again only if it changed since its last render:
+    matplotlib marks a figure stale whenever one of its artists changes, and
+    the renderer clears the mark once it has the image. Renderers can be
+    shared by threads, each rendering the figures of its own figure_scope().
+    """
+
+    def __init__(self, format=PLOT_FORMAT, dpi=PLOT_DPI, quality=PLOT_QUALITY, max_pixels=PLOT_MAX_PIXELS,
+                 max_figures=PLOT_MAX_FIGURES, max_bytes=PLOT_MAX_BYTES, tight=PLOT_TIGHT):
+        if format not in MIMES:
+            raise ValueError(f"Plot format must be one of {', '.join(MIMES)}.")
+        self.format = format
+        self.mime = MIMES[format]
+        self.dpi = dpi
+        self.quality = quality
+        self.max_pixels = max_pixels
+        self.max_figures = max_figures
+        self.max_bytes = max_bytes
+        self.tight = tight
+        self._rendered = weakref.WeakKeyDictionary()  # figure -> (data, mime) of its last render
+        self._lock = threading.Lock()
+
+    def _dpi(self, figure):
+        """The configured DPI, lowered so the image stays within max_pixels."""
+        width, height = figure.get_size_inches()
+        pixels = width * height * self.dpi ** 2
+        if self.max_pixels and pixels > self.max_pixels:
+            return self.dpi * math.sqrt(self.max_pixels / pixels)
+        return self.dpi
+
+    def render(self, figure):
+        """Returns (data, mime) for a figure and whether it was reused from the figure's last render."""
+        with self._lock:
+            image = self._rendered.get(figure)
+        if image is not None and not figure.stale:
+            return image, True
+        options = {"pil_kwargs": {"quality": self.quality}} if self.format in LOSSY else {}
+        if self.tight:
+            options.update(bbox_inches="tight", pad_inches=0.2)
+        buf = io.BytesIO()
+        figure.savefig(buf, format=self.format, dpi=self._dpi(figure), **options)
+        image = (buf.getvalue(), self.mime)
+        with self._lock:
+            self._rendered[figure] = image
+        # Saving leaves the figure stale, any later change to it marks it again
+        figure.stale = False
+        return image, False
+
+    def render_open_figures(self, shown=()):
+        """Renders every figure open in pyplot, in the current figure_scope(), and closes them all.
+
+        Returns the (data, mime) images and a report of the rendering. Figures
+        in shown that did not change since are skipped, as are figures past
+        max_figures or once max_bytes of images were kept.
+        """
+        images = []
+        report = {"figures": 0, "bytes": 0, "render_time": 0.0, "cached": 0, "dropped": 0}
+        start = time.perf_counter()
+        try:
+            for number in plt.get_fignums():
+                if len(images) >= self.max_figures or report["bytes"] >= self.max_bytes:
+                    report["dropped"] += 1
+                    continue
+                figure = plt.figure(number)
+                if not figure.stale and any(figure is other for other in shown):
+                    report["cached"] += 1
+                    continue
+                try:
+                    image, cached = self.render(figure)
+                except Exception as e:
+                    print(f"Error rendering figure {number}: {e}")
+                    continue
+                if report["bytes"] + len(image[0]) > self.max_bytes:
+                    report["dropped"] += 1
+                    continue
+                images.append(image)
+                report["bytes"] += len(image[0])
+                report["cached"] += cached
+        finally:
+            plt.close('all')
+        report["figures"] = len(images)
+        report["render_time"] = time.perf_counter() - start
+        return images, report
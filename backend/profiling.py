@@ -0,0 +1,203 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+from collections import Counter
+
+from metrics import stage_duration
+
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "20"))  # Functions listed per profiled cell
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))  # Seconds between samples
+PROFILE_OPTIONS = ("memory", "cprofile", "sample")
+
+
+def parse_profile(value):
+    """Checks a request's profile option, returns the list of options or None when profiling is off.
+
+    true only times the cell. "memory" adds tracemalloc, "cprofile" or
+    "sample" a list of the functions the time went to; several can be given
+    as a list.
+    """
+    if value is None or value is False:
+        return None
+    if value is True:
+        return []
+    options = [value] if isinstance(value, str) else value
+    if not isinstance(options, list) or not all(option in PROFILE_OPTIONS for option in options):
+        raise ValueError(f"profile must be true, false or some of {', '.join(PROFILE_OPTIONS)}.")
+    if "cprofile" in options and "sample" in options:
+        raise ValueError("profile can use cprofile or sample, not both.")
+    return sorted(set(options))
+
+
+class StageStats:
+    """Count, total and max seconds of each request stage, across every request this process served."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}  # stage -> [count, total, max]
+
+    def record(self, stage, seconds):
+        with self._lock:
+            entry = self._stages.setdefault(stage, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def stats(self):
+        with self._lock:
+            return {
+                stage: {"count": count, "total": total, "mean": total / count, "max": longest}
+                for stage, (count, total, longest) in self._stages.items()
+            }
+
+
+stage_stats = StageStats()
+_current = threading.local()
+
+
+@contextlib.contextmanager
+def timed_request():
+    """Collects the stages run by this thread until the block ends, yields {stage: seconds}."""
+    timings = {}
+    previous = getattr(_current, "timings", None)
+    _current.timings = timings
+    try:
+        yield timings
+    finally:
+        _current.timings = previous
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Times a stage (request_parse, db_load, deserialize, exec, serialize, db_write) of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_stats.record(name, elapsed)
+        stage_duration.observe(elapsed, stage=name)
+        timings = getattr(_current, "timings", None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def _function_name(code):
+    return f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+
+
+class SamplingProfiler:
+    """Samples the stack of the thread that started it every interval seconds.
+
+    Much cheaper than cProfile on code making many small calls, at the cost
+    of missing functions that run between samples.
+    """
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self._own = Counter()  # function -> samples it was running in
+        self._total = Counter()  # function -> samples it was on the stack in
+        self._stopped = threading.Event()
+
+    def start(self, base=None):
+        """Starts sampling, frames at and below base (the caller by default) are not counted."""
+        frame, self._depth = base or sys._getframe(1), 0
+        while frame is not None:
+            frame, self._depth = frame.f_back, self._depth + 1
+        self._thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _loop(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            functions = []
+            while frame is not None:
+                functions.append(_function_name(frame.f_code))
+                frame = frame.f_back
+            functions = functions[:len(functions) - self._depth]
+            if not functions or self._stopped.is_set():
+                continue
+            self.samples += 1
+            self._own[functions[0]] += 1
+            self._total.update(set(functions))
+
+    def top(self, count):
+        return [
+            {"function": function, "samples": samples, "own_samples": self._own[function],
+             "fraction": samples / self.samples}
+            for function, samples in self._total.most_common(count)
+        ]
+
+
+class CellProfiler:
+    """Measures one cell run: wall and CPU time, and with the options from parse_profile, memory and hot functions.
+
+    Memory is traced with tracemalloc, which can make allocation-heavy code
+    many times slower, so it is an option of its own.
+    """
+
+    def __init__(self, options=(), top=PROFILE_TOP):
+        self.memory = "memory" in options
+        self.mode = "cprofile" if "cprofile" in options else "sample" if "sample" in options else None
+        self.top = top
+        self.profiler = None
+
+    def start(self):
+        if self.memory:
+            self._stop_tracing = not tracemalloc.is_tracing()
+            if self._stop_tracing:
+                tracemalloc.start()
+            else:
+                tracemalloc.reset_peak()
+            self._memory = tracemalloc.get_traced_memory()[0]
+        if self.mode == "cprofile":
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # The cell's own code may already be profiling
+                self.profiler = None
+        elif self.mode == "sample":
+            self.profiler = SamplingProfiler()
+            self.profiler.start(sys._getframe(1))
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+    def stop(self):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        if self.mode == "cprofile" and self.profiler is not None:
+            self.profiler.disable()
+        elif self.mode == "sample":
+            self.profiler.stop()
+        self.result = {"profiler": self.mode, "wall_time": wall, "cpu_time": cpu, "top": self._top()}
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stop_tracing:
+                tracemalloc.stop()
+            self.result["memory_peak"] = max(peak - self._memory, 0)
+            self.result["memory_delta"] = current - self._memory
+
+    def _top(self):
+        if self.profiler is None:
+            return None
+        if self.mode == "sample":
+            return self.profiler.top(self.top)
+        stats = pstats.Stats(self.profiler).stats
+        rows = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+        return [
+            {"function": f"{filename}:{line}({name})", "calls": calls, "own_time": own, "cumulative_time": cumulative}
+            for (filename, line, name), (_, calls, own, cumulative, _) in rows
+            if "_lsprof" not in name
+        ][:self.top]
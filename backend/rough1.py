@@ -9,22 +9,14 @@ import matplotlib.pyplot as plt
 import base64
 from threading import Thread
 import queue
-import signal
 import time
 import traceback
 
 app = Flask(__name__)
 CORS(app)
 
-class TimeoutException(Exception):
-    pass
-
-def timeout_handler(signum, frame):
-    raise TimeoutException("Code execution timed out")
-
 class CodeExecutor:
-    def __init__(self, timeout=10):
-        self.timeout = timeout
+    def __init__(self):
         self.globals = {
             'print': print,
             'plt': plt,
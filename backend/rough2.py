@@ -2,34 +2,28 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 import sys
 import io
-import contextlib
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import base64
 from threading import Thread
 import queue
-import signal
-import time
 import traceback
-import re
+from session_store import SessionStore
+from executor import redirect
+from cell_analysis import CellAnalysis
+from plots import figure_scope
 
 app = Flask(__name__)
 CORS(app)
 
 # Stores user notebooks {userId: {sessionId: {"cells": [{"id": "cell_1", "code": "x = 10", "output": ""}], "lastActive": timestamp}}}
-user_sessions = {}
 SESSION_TIMEOUT = 1800  # 30 minutes
-
-class TimeoutException(Exception):
-    pass
-
-def timeout_handler(signum, frame):
-    raise TimeoutException("Code execution timed out")
+# Idle sessions are expired by the store's background thread, not on the request path
+user_sessions = SessionStore(timeout=SESSION_TIMEOUT)
 
 class CodeExecutor:
-    def __init__(self, timeout=10):
-        self.timeout = timeout
+    def __init__(self):
         self.globals = {
             'print': print,
             'plt': plt,
@@ -37,21 +31,17 @@ class CodeExecutor:
             '__builtins__': __builtins__,
         }
 
-    def remove_comments(self, code):
-        """Removes both single-line and multi-line comments from the code."""
-        code = re.sub(r'\#.*', '', code)  # Remove single-line comments
-        code = re.sub(r'""".*?"""', '', code, flags=re.DOTALL)  # Remove multi-line comments
-        code = re.sub(r"'''.*?'''", '', code, flags=re.DOTALL)  # Remove multi-line comments using single quotes
-        return code  
-     
     def capture_output(self, code, session_globals):
         output = io.StringIO()
         error = None
         images = []
 
-        # Remove all types of comments from the code before checking for input()
-        code_without_comments = self.remove_comments(code)
-        if "input(" in code_without_comments:
+        # Checked on the parsed cell, so comments and strings do not count and aliases do
+        try:
+            denied = CellAnalysis.parse(code).denied(frozenset(["input"]))
+        except SyntaxError:
+            denied = []  # Reported when the cell runs
+        if denied:
             return {
                 "text": "",
                 "error": "User input is disabled. Please use predefined variables instead.",
@@ -70,7 +60,8 @@ class CodeExecutor:
                 return None
         
         try:
-            with contextlib.redirect_stdout(output):
+            # Sessions run concurrently, so output and figures are kept per thread
+            with redirect("stdout", output), figure_scope():
                 try:
                     exec(code, session_globals)
                     if plt.get_fignums():
@@ -91,19 +82,8 @@ class CodeExecutor:
 
 executor = CodeExecutor()
 
-def cleanup_sessions():
-    """Removes sessions that have been inactive for more than 30 minutes."""
-    current_time = time.time()
-    for user_id in list(user_sessions.keys()):
-        for session_id in list(user_sessions[user_id].keys()):
-            if current_time - user_sessions[user_id][session_id]["lastActive"] > SESSION_TIMEOUT:
-                del user_sessions[user_id][session_id]
-        if not user_sessions[user_id]:
-            del user_sessions[user_id]
-
 @app.route('/execute', methods=['POST'])
 def execute():
-    cleanup_sessions()
     try:
         data = request.json
         user_id = data.get('userId')
@@ -117,27 +97,16 @@ def execute():
         if not code:
             return jsonify({"error": "Code missing, required parameters."}), 400
 
-               
-        if user_id not in user_sessions:
-            user_sessions[user_id] = {}
-
-        if session_id not in user_sessions[user_id]:
-            user_sessions[user_id][session_id] = {
-                "cells": [],
-                "globals": {"__builtins__": __builtins__},  
-                "lastActive": time.time()
-            }
-        else:
-            # Ensure globals exists for the session
-            if "globals" not in user_sessions[user_id][session_id]:
-                user_sessions[user_id][session_id]["globals"] = {"__builtins__": __builtins__}
 
-        
-        session = user_sessions[user_id][session_id]
-        session["lastActive"] = time.time()
-        
-        result = executor.capture_output(code, session["globals"])
-        session["cells"].append({"code": code, "output": result["text"]})
+        # Cells of one session run one at a time, other sessions are not blocked
+        result = None
+        while result is None:
+            user_sessions.get_or_create(user_id, session_id)
+            with user_sessions.use(user_id, session_id) as session:
+                if session is None:
+                    continue  # Expired between creating and locking it, start a fresh one
+                result = executor.capture_output(code, session["globals"])
+                session["cells"].append({"code": code, "output": result["text"]})
         
         return jsonify(result)
     
@@ -158,7 +127,7 @@ def get_notebooks():
     
     notebooks = [
         {"sessionId": session_id, "name": f"Notebook {session_id}"}
-        for session_id in user_sessions.get(user_id, {})
+        for session_id in user_sessions.notebooks(user_id)
     ]
     return jsonify({"notebooks": notebooks})
 
@@ -172,11 +141,18 @@ def load_notebook():
     if not user_id or not session_id:
         return jsonify({"error": "Missing parameters."}), 400
     
-    if user_id in user_sessions and session_id in user_sessions[user_id]:
-        return jsonify({"cells": user_sessions[user_id][session_id]["cells"]})
+    session = user_sessions.get(user_id, session_id)
+    if session:
+        return jsonify({"cells": list(session["cells"])})
     
     return jsonify({"error": "Notebook not found."}), 404
 
 
+@app.route('/sessions/stats', methods=['GET'])
+def session_stats():
+    """Returns the number of active sessions and of sessions expired so far."""
+    return jsonify(user_sessions.stats())
+
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,278 @@
+import io
+import os
+import sys
+import types
+import pickle
+import struct
+import importlib
+
+import dill
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+NAMESPACE_COMPRESSION = os.getenv("NAMESPACE_COMPRESSION", "auto")  # auto, zstd, lz4 or none
+NAMESPACE_COMPRESS_MIN_SIZE = 4096  # Smaller values are stored as they are
+COMPRESS_SAMPLE_SIZE = 256 * 1024
+
+# Stored values start with MAGIC, a codec id and a compression id, older ones are plain dill pickles
+MAGIC = b"NSV1"
+COMPRESSION_IDS = {"none": 0, "zstd": 1, "lz4": 2}
+
+
+class SkipVariable(Exception):
+    """Raised for values that are not worth or not possible to store, e.g. open files."""
+    pass
+
+
+class NotebookPickler(pickle.Pickler):
+    """Protocol 5 pickler that refuses functions and classes it could only store by a name that will not resolve.
+
+    Functions and classes defined in cells live in the notebook's globals,
+    not in an importable module, so they are left to dill.
+    """
+
+    def reducer_override(self, obj):
+        if isinstance(obj, (types.FunctionType, type)):
+            module = sys.modules.get(getattr(obj, "__module__", None) or "")
+            target = module
+            for part in getattr(obj, "__qualname__", "").split("."):
+                target = getattr(target, part, None)
+            if module is None or module.__name__ == "__main__" or target is not obj:
+                raise pickle.PicklingError(f"{obj!r} is not importable")
+        return NotImplemented
+
+
+def _frame(parts):
+    """Length-prefixed concatenation of byte buffers."""
+    chunks = [struct.pack("<I", len(parts))]
+    for part in parts:
+        chunks.append(struct.pack("<Q", memoryview(part).nbytes))
+        chunks.append(part)
+    return b"".join(chunks)
+
+
+def _unframe(data):
+    view = memoryview(data)
+    (count,), offset = struct.unpack_from("<I", view), 4
+    parts = []
+    for _ in range(count):
+        (size,), offset = struct.unpack_from("<Q", view, offset), offset + 8
+        parts.append(view[offset:offset + size])
+        offset += size
+    return parts
+
+
+class ModuleCodec:
+    """Imported modules, stored by name and imported again on load."""
+    id = 1
+    name = "module"
+
+    def handles(self, value):
+        return isinstance(value, types.ModuleType)
+
+    def dumps(self, value):
+        if getattr(value, "__spec__", None) is None:
+            raise SkipVariable(f"module {value.__name__} cannot be imported again")
+        return value.__name__.encode()
+
+    def loads(self, data):
+        return importlib.import_module(bytes(data).decode())
+
+
+class ArrowCodec:
+    """DataFrames as Arrow IPC streams, compact for string columns and fast for numeric ones.
+
+    Object columns do not survive the trip (None becomes NaN, lists come back
+    as arrays, mixed numbers as floats) and column names of mixed types come
+    back as strings, so such frames are left to pickle.
+    """
+    id = 2
+    name = "arrow"
+
+    def handles(self, value):
+        if pyarrow is None or type(value).__name__ != "DataFrame" or not type(value).__module__.startswith("pandas"):
+            return False
+        if value.columns.inferred_type.startswith("mixed"):
+            return False
+        index_dtypes = getattr(value.index, "dtypes", [value.index.dtype])  # One per level of a MultiIndex
+        return not any(dtype == object for dtype in list(value.dtypes) + list(index_dtypes))
+
+    def dumps(self, value):
+        table = pyarrow.Table.from_pandas(value, preserve_index=True)
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue()
+
+    def loads(self, data):
+        return pyarrow.ipc.open_stream(pyarrow.py_buffer(data)).read_all().to_pandas()
+
+
+class PickleCodec:
+    """Standard pickle protocol 5, with array buffers written out of band instead of copied into the pickle."""
+    id = 3
+    name = "pickle5"
+    references = True  # Takes persistent_id and persistent_load, see NamespaceSerializer.dumps
+
+    def handles(self, value):
+        return True
+
+    def dumps(self, value, persistent_id=None):
+        buffers = []
+        stream = io.BytesIO()
+        pickler = NotebookPickler(stream, protocol=5, buffer_callback=buffers.append)
+        if persistent_id:
+            pickler.persistent_id = persistent_id
+        pickler.dump(value)
+        return _frame([stream.getbuffer()] + [buffer.raw() for buffer in buffers])
+
+    def loads(self, data, persistent_load=None):
+        # Buffers are views into a writable copy, so loaded arrays can be modified in place
+        payload, *buffers = _unframe(bytearray(data))
+        unpickler = pickle.Unpickler(io.BytesIO(payload), buffers=buffers)
+        if persistent_load:
+            unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+
+class DillCodec:
+    """Anything dill can handle, e.g. functions and classes defined in cells."""
+    id = 4
+    name = "dill"
+    references = True
+
+    def handles(self, value):
+        return True
+
+    def dumps(self, value, persistent_id=None):
+        stream = io.BytesIO()
+        pickler = dill.Pickler(stream)
+        if persistent_id:
+            pickler.persistent_id = persistent_id
+        pickler.dump(value)
+        return stream.getvalue()
+
+    def loads(self, data, persistent_load=None):
+        unpickler = dill.Unpickler(io.BytesIO(data))
+        if persistent_load:
+            unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+
+def _skip_reason(value):
+    if isinstance(value, io.IOBase):
+        return "open files are not saved"
+    for cls in type(value).__mro__:
+        if cls.__module__.startswith("matplotlib") and cls.__name__ in ("Figure", "Axes", "Artist"):
+            return "matplotlib figures are not saved, re-run the cell that draws them"
+    return None
+
+
+class NamespaceSerializer:
+    """Turns notebook variables into bytes and back, trying the fastest codec that handles each value.
+
+    Codecs are tried in order and the first one that succeeds is used, so a
+    codec can be registered ahead of the built-in ones for a specific type.
+    Large results are compressed with zstd or lz4 when available.
+    """
+
+    def __init__(self, compression=NAMESPACE_COMPRESSION, compress_min_size=NAMESPACE_COMPRESS_MIN_SIZE):
+        self.codecs = [ModuleCodec(), ArrowCodec(), PickleCodec(), DillCodec()]
+        if compression == "auto":
+            compression = "zstd" if zstandard else "lz4" if lz4 else "none"
+        if (compression == "zstd" and not zstandard) or (compression == "lz4" and not lz4) \
+                or compression not in COMPRESSION_IDS:
+            raise ValueError(f"Compression {compression} is not available.")
+        self.compression = compression
+        self.compress_min_size = compress_min_size
+
+    def register(self, codec, first=True):
+        """Adds a codec with unique id (1-255), name, handles(value), dumps(value) and loads(data)."""
+        if any(existing.id == codec.id for existing in self.codecs):
+            raise ValueError(f"Codec id {codec.id} is already registered.")
+        if first:
+            self.codecs.insert(0, codec)
+        else:
+            self.codecs.append(codec)
+
+    def dumps(self, value, persistent_id=None):
+        """Returns the stored form of a value, raising SkipVariable or the last codec's error if none can store it.
+
+        persistent_id(obj) may return a name to store in place of obj, the
+        value itself included, as pickle's Pickler.persistent_id. Only codecs
+        with references = True take it, loads() must then get persistent_load.
+        """
+        if persistent_id and persistent_id(value) is not None:
+            codecs = [codec for codec in self.codecs if getattr(codec, "references", False)]
+        else:
+            reason = _skip_reason(value)
+            if reason:
+                raise SkipVariable(reason)
+            codecs = self.codecs
+        error = None
+        for codec in codecs:
+            if not codec.handles(value):
+                continue
+            try:
+                if persistent_id and getattr(codec, "references", False):
+                    payload = codec.dumps(value, persistent_id=persistent_id)
+                else:
+                    payload = codec.dumps(value)
+            except SkipVariable:
+                raise
+            except Exception as e:
+                error = e
+                continue
+            return self._pack(codec.id, payload)
+        raise error
+
+    def loads(self, data, persistent_load=None):
+        if not data.startswith(MAGIC):
+            return dill.loads(data)  # Saved before codecs existed
+        codec_id, compression_id = data[len(MAGIC)], data[len(MAGIC) + 1]
+        payload = memoryview(data)[len(MAGIC) + 2:]
+        if compression_id == COMPRESSION_IDS["zstd"]:
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+        elif compression_id == COMPRESSION_IDS["lz4"]:
+            payload = lz4.frame.decompress(payload)
+        codec = next((c for c in self.codecs if c.id == codec_id), None)
+        if codec is None:
+            raise ValueError(f"Unknown codec id {codec_id}.")
+        if persistent_load and getattr(codec, "references", False):
+            return codec.loads(payload, persistent_load=persistent_load)
+        return codec.loads(payload)
+
+    def codec_name(self, data):
+        return next((c.name for c in self.codecs if data.startswith(MAGIC) and c.id == data[len(MAGIC)]), "dill")
+
+    def _pack(self, codec_id, payload):
+        compression = "none"
+        size = memoryview(payload).nbytes
+        if self.compression != "none" and size >= self.compress_min_size:
+            # Random floats and already compressed data do not shrink, try a sample of large payloads first
+            sample = memoryview(payload)[:COMPRESS_SAMPLE_SIZE]
+            if size <= COMPRESS_SAMPLE_SIZE or len(self._compress(sample)) < len(sample) * 0.9:
+                compressed = self._compress(payload)
+                if len(compressed) < size * 0.9:
+                    payload, compression = compressed, self.compression
+        return b"".join([MAGIC, bytes([codec_id, COMPRESSION_IDS[compression]]), payload])
+
+    def _compress(self, data):
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor(level=1).compress(data)
+        return lz4.frame.compress(data)
+
+
+serializer = NamespaceSerializer()
@@ -0,0 +1,148 @@
+import os
+import time
+import zlib
+import heapq
+import itertools
+import threading
+import contextlib
+
+SESSION_SHARDS = int(os.getenv("SESSION_SHARDS", "16"))
+
+
+class SessionStore:
+    """Thread-safe table of in-memory notebook sessions, {user_id: {notebook_id: session}}.
+
+    Users are spread over shards, each with its own write lock. Writers never
+    modify a user's table in place, they swap in an updated copy, so reads
+    take no lock and always see a consistent snapshot. Every session carries
+    a lock that use() holds while a cell runs, so cells of one notebook run
+    in order while different notebooks run in parallel.
+
+    With a timeout, idle sessions are expired by a background thread. Each
+    session has one entry in a min-heap ordered by when it may expire, so the
+    thread only looks at sessions that are due instead of scanning them all;
+    a session used since its entry was pushed is simply pushed back.
+    """
+
+    def __init__(self, shards=SESSION_SHARDS, timeout=None):
+        self._shards = [{"lock": threading.Lock(), "users": {}} for _ in range(shards)]
+        self.timeout = timeout
+        self._expiry = []  # (deadline, seq, user_id, notebook_id, session)
+        self._expiry_seq = itertools.count()
+        self._expiry_lock = threading.Condition()
+        self._active = 0
+        self._expired = 0
+        if timeout:
+            threading.Thread(target=self._expiry_loop, daemon=True).start()
+
+    def _shard(self, user_id):
+        return self._shards[zlib.crc32(user_id.encode()) % len(self._shards)]
+
+    def new_session(self, **fields):
+        session = {"cells": [], "globals": {"__builtins__": __builtins__}, "lastActive": time.time()}
+        session.update(fields)
+        session["lock"] = threading.Lock()
+        return session
+
+    def notebooks(self, user_id):
+        """Returns a snapshot of the user's sessions, safe to iterate while others write."""
+        return self._shard(user_id)["users"].get(user_id, {})
+
+    def get(self, user_id, notebook_id):
+        return self.notebooks(user_id).get(notebook_id)
+
+    def add(self, user_id, notebook_id, session, unique_name=False):
+        """Adds a session, returns False if the id, or with unique_name the session's name, is taken."""
+        shard = self._shard(user_id)
+        with shard["lock"]:
+            sessions = shard["users"].get(user_id, {})
+            if notebook_id in sessions:
+                return False
+            if unique_name and any(s.get("name") == session.get("name") for s in sessions.values()):
+                return False
+            shard["users"][user_id] = {**sessions, notebook_id: session}
+        with self._expiry_lock:
+            self._active += 1
+            if self.timeout:
+                self._schedule(session["lastActive"] + self.timeout, user_id, notebook_id, session)
+        return True
+
+    def get_or_create(self, user_id, notebook_id, **fields):
+        """Returns the session, adding a new one with the given fields if it does not exist."""
+        while True:
+            session = self.get(user_id, notebook_id)
+            if session is not None:
+                return session
+            self.add(user_id, notebook_id, self.new_session(**fields))
+
+    def delete(self, user_id, notebook_id, session=None):
+        """Removes a session, only if it is still the given one when session is passed. Returns True if removed."""
+        shard = self._shard(user_id)
+        with shard["lock"]:
+            sessions = shard["users"].get(user_id, {})
+            if notebook_id not in sessions or (session is not None and sessions[notebook_id] is not session):
+                return False
+            sessions = {nid: s for nid, s in sessions.items() if nid != notebook_id}
+            if sessions:
+                shard["users"][user_id] = sessions
+            else:
+                del shard["users"][user_id]
+        # The session's heap entry is dropped when it comes due
+        with self._expiry_lock:
+            self._active -= 1
+        return True
+
+    @contextlib.contextmanager
+    def use(self, user_id, notebook_id):
+        """Yields the session holding its lock, or None if it does not exist (or was removed while waiting)."""
+        session = self.get(user_id, notebook_id)
+        if session is None:
+            yield None
+            return
+        with session["lock"]:
+            if self.get(user_id, notebook_id) is not session:
+                yield None
+                return
+            session["lastActive"] = time.time()
+            try:
+                yield session
+            finally:
+                session["lastActive"] = time.time()
+
+    def stats(self):
+        with self._expiry_lock:
+            return {"active": self._active, "expired": self._expired, "pending_expiry": len(self._expiry)}
+
+    def _schedule(self, deadline, user_id, notebook_id, session):
+        entry = (deadline, next(self._expiry_seq), user_id, notebook_id, session)
+        heapq.heappush(self._expiry, entry)
+        # Wake the expiry thread if it is sleeping on a later entry, or on an empty heap
+        if self._expiry[0] is entry:
+            self._expiry_lock.notify()
+
+    def _expiry_loop(self):
+        while True:
+            with self._expiry_lock:
+                now = time.time()
+                while not self._expiry or self._expiry[0][0] > now:
+                    self._expiry_lock.wait(self._expiry[0][0] - now if self._expiry else None)
+                    now = time.time()
+                _, _, user_id, notebook_id, session = heapq.heappop(self._expiry)
+            if self.get(user_id, notebook_id) is not session:
+                continue  # Deleted since it was scheduled
+            deadline = session["lastActive"] + self.timeout
+            if deadline <= now:
+                # A session busy running a cell is checked again a full timeout later
+                if not session["lock"].acquire(blocking=False):
+                    deadline = now + self.timeout
+                else:
+                    try:
+                        expired = self.delete(user_id, notebook_id, session)
+                    finally:
+                        session["lock"].release()
+                    if expired:
+                        with self._expiry_lock:
+                            self._expired += 1
+                    continue
+            with self._expiry_lock:
+                self._schedule(deadline, user_id, notebook_id, session)
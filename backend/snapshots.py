@@ -0,0 +1,133 @@
+import os
+import time
+import uuid
+import atexit
+import threading
+
+SNAPSHOT_MAX = int(os.getenv("SNAPSHOT_MAX", "32"))  # Snapshots kept across all notebooks
+SNAPSHOT_MAX_PER_NOTEBOOK = int(os.getenv("SNAPSHOT_MAX_PER_NOTEBOOK", "5"))
+SNAPSHOT_MEMORY_MB = int(os.getenv("SNAPSHOT_MEMORY_MB", "2048"))  # Memory snapshots may hold on to, 0 disables the check
+
+
+def process_memory(pid):
+    """Returns a process's proportional set size in bytes, 0 where /proc is not available.
+
+    Pages a snapshot still shares with its notebook's kernel are split
+    between them, so this grows as the two diverge.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+class SnapshotStore:
+    """Frozen copies of notebook kernels, forked from the live kernel.
+
+    A snapshot is an idle kernel process that shares its memory with the
+    notebook's kernel copy-on-write, so taking one costs a fork rather than
+    serializing the globals, and restoring one is another fork. Snapshots
+    live only as long as the server; the oldest ones are dropped to stay
+    within the count and memory budget.
+    """
+
+    def __init__(self, max_snapshots=SNAPSHOT_MAX, max_per_notebook=SNAPSHOT_MAX_PER_NOTEBOOK,
+                 max_memory_mb=SNAPSHOT_MEMORY_MB):
+        self.max_snapshots = max_snapshots
+        self.max_per_notebook = max_per_notebook
+        self.max_memory = max_memory_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        self._snapshots = []  # oldest first
+        atexit.register(self.shutdown)
+
+    def take(self, notebook_id, kernel, label=None, listed=True):
+        """Forks the notebook's kernel into a new snapshot and returns it.
+
+        Unlisted snapshots, e.g. the one held while a cell may be rolled
+        back, are not returned by list() and not counted against the budget.
+        """
+        snapshot = {
+            "snapshot_id": uuid.uuid4().hex,
+            "notebook_id": notebook_id,
+            "label": label,
+            "created_at": time.time(),
+            "kernel": kernel.fork(reseed=False)
+        }
+        if listed:
+            with self._lock:
+                self._snapshots.append(snapshot)
+            self._enforce_budget(notebook_id)
+        return snapshot
+
+    def get(self, notebook_id, snapshot_id):
+        with self._lock:
+            return next((s for s in self._snapshots
+                         if s["snapshot_id"] == snapshot_id and s["notebook_id"] == notebook_id), None)
+
+    def list(self, notebook_id):
+        with self._lock:
+            snapshots = [s for s in self._snapshots if s["notebook_id"] == notebook_id]
+        return [self.describe(s) for s in snapshots]
+
+    def count(self):
+        with self._lock:
+            return len(self._snapshots)
+
+    def describe(self, snapshot):
+        return {
+            "snapshot_id": snapshot["snapshot_id"],
+            "label": snapshot["label"],
+            "created_at": snapshot["created_at"],
+            "memory": process_memory(snapshot["kernel"].pid)
+        }
+
+    def delete(self, notebook_id, snapshot_id):
+        snapshot = self.get(notebook_id, snapshot_id)
+        if snapshot is None:
+            return False
+        self._remove([snapshot])
+        return True
+
+    def drop(self, notebook_id):
+        """Deletes every snapshot of a notebook, e.g. when the notebook is deleted."""
+        with self._lock:
+            snapshots = [s for s in self._snapshots if s["notebook_id"] == notebook_id]
+        self._remove(snapshots)
+
+    def _remove(self, snapshots):
+        with self._lock:
+            self._snapshots = [s for s in self._snapshots if s not in snapshots]
+        for snapshot in snapshots:
+            snapshot["kernel"].shutdown()
+
+    def _enforce_budget(self, notebook_id):
+        # Drop the oldest snapshots first, but never the one just taken
+        with self._lock:
+            snapshots = list(self._snapshots)
+        notebook_snapshots = [s for s in snapshots if s["notebook_id"] == notebook_id]
+        victims = notebook_snapshots[:max(len(notebook_snapshots) - self.max_per_notebook, 0)]
+        remaining = [s for s in snapshots if s not in victims]
+        excess = max(len(remaining) - self.max_snapshots, 0)
+        victims += remaining[:excess]
+        remaining = remaining[excess:]
+        if self.max_memory:
+            # Snapshots drift apart from their kernels as notebooks keep running, so measure them now
+            sizes = [process_memory(s["kernel"].pid) for s in remaining]
+            total = sum(sizes)
+            for snapshot, size in zip(remaining[:-1], sizes):
+                if total <= self.max_memory:
+                    break
+                victims.append(snapshot)
+                total -= size
+        if victims:
+            self._remove(victims)
+
+    def shutdown(self):
+        with self._lock:
+            snapshots, self._snapshots = self._snapshots, []
+        for snapshot in snapshots:
+            snapshot["kernel"].shutdown()
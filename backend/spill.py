@@ -0,0 +1,148 @@
+import os
+import sys
+import tempfile
+import weakref
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+SPILL_PATH = os.getenv("SPILL_PATH", "/var/tmp/notebook-spill")  # Must be on disk, spilling to a tmpfs saves nothing
+SPILL_MIN_SIZE_MB = int(os.getenv("SPILL_MIN_SIZE_MB", "64"))  # Arrays and frames smaller than this stay in RAM
+SPILL_MIN_COLUMN_SIZE = 1024 * 1024  # Smaller frame columns are not worth a mapping of their own
+
+
+def _owns_memory(array):
+    """Whether nothing but the array refers to the memory it uses.
+
+    Arrays restored from storage, reshaped or sliced derive from a base array
+    or buffer. Spilling them is safe, and frees the base, when no other object
+    holds a reference to any base in the chain.
+    """
+    import numpy
+    base = array.base
+    while base is not None:
+        # The object deriving from it, this variable and getrefcount's argument
+        if sys.getrefcount(base) > 3:
+            return False
+        if isinstance(base, numpy.ndarray):
+            base = base.base
+        elif isinstance(base, memoryview):
+            base = base.obj
+        else:
+            base = None
+    return True
+
+
+class NamespaceSpiller:
+    """Moves large arrays and DataFrame columns of an idle kernel's globals out of RAM.
+
+    Each array is written to a file that is mapped back copy-on-write and
+    unlinked right away. Pages are read back lazily when a cell touches them
+    and the OS can drop them again under memory pressure, writes stay private
+    to the kernel, and the disk space is freed with the last reference to
+    the value, or when the kernel exits. ndarrays become numpy memmaps
+    through .npy files, and Arrow-backed frame columns are mapped from Arrow
+    IPC files, so cells keep working with the same types.
+    """
+
+    def __init__(self, path=SPILL_PATH, min_size=SPILL_MIN_SIZE_MB * 1024 * 1024):
+        self.path = path
+        self.min_size = min_size
+        self._spilled = weakref.WeakValueDictionary()  # name -> value already backed by mapped files
+
+    def spill(self, namespace):
+        """Replaces large values in namespace with mapped copies, returns {"spilled": [names], "bytes": size}."""
+        names, total = [], 0
+        for name in list(namespace):
+            value = namespace[name]
+            # Values also referenced elsewhere (another name, a list, an array viewing them) are left alone,
+            # replacing only this binding would split them in two and keep the original in RAM
+            if self._spilled.get(name) is value or sys.getrefcount(value) > 3:
+                continue
+            try:
+                spilled, size = self._spill_value(value)
+            except OSError as e:
+                print(f"Error spilling {name}: {e}")
+                break
+            if spilled is None:
+                continue
+            namespace[name] = spilled
+            self._spilled[name] = spilled
+            names.append(name)
+            total += size
+        if names and pyarrow is not None:
+            # Arrow's allocator keeps freed memory for reuse, hand the replaced columns back to the OS
+            pyarrow.default_memory_pool().release_unused()
+        return {"spilled": names, "bytes": total}
+
+    def _spill_value(self, value):
+        module, name = type(value).__module__.split(".")[0], type(value).__name__
+        if module == "numpy" and name == "ndarray":
+            if value.dtype != object and value.nbytes >= self.min_size and _owns_memory(value):
+                return self._map_array(value), value.nbytes
+        elif module == "pandas" and name == "DataFrame":
+            return self._spill_frame(value)
+        return None, 0
+
+    def _spill_frame(self, frame):
+        import pandas
+        columns, spilled, size = {}, [], 0
+        for i in range(frame.shape[1]):
+            array = frame.iloc[:, i].array
+            columns[i] = array
+            nbytes = array.nbytes if hasattr(array, "nbytes") else 0
+            if nbytes < SPILL_MIN_COLUMN_SIZE:
+                continue
+            if isinstance(array, pandas.arrays.NumpyExtensionArray) and array.dtype.numpy_dtype != object:
+                spilled.append(i)
+            elif pyarrow is not None and isinstance(array, pandas.arrays.ArrowExtensionArray):
+                spilled.append(i)
+            else:
+                continue
+            size += nbytes
+        if size < self.min_size:
+            return None, 0
+
+        for i in spilled:
+            array = columns[i]
+            if isinstance(array, pandas.arrays.NumpyExtensionArray):
+                columns[i] = self._map_array(array.to_numpy())
+            else:
+                values = self._map_arrow(array.__arrow_array__())
+                if isinstance(array, pandas.arrays.ArrowStringArray):
+                    columns[i] = type(array)(values, dtype=array.dtype)
+                else:
+                    columns[i] = pandas.arrays.ArrowExtensionArray(values)
+        result = pandas.DataFrame(columns, index=frame.index, copy=False)
+        result.columns = frame.columns
+        result.attrs = frame.attrs
+        if not result.dtypes.equals(frame.dtypes):
+            return None, 0
+        return result, size
+
+    def _temp_file(self, suffix):
+        os.makedirs(self.path, exist_ok=True)
+        return tempfile.mkstemp(suffix=suffix, dir=self.path)
+
+    def _map_array(self, array):
+        import numpy
+        fd, path = self._temp_file(".npy")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                numpy.save(f, array, allow_pickle=False)
+            return numpy.load(path, mmap_mode="c")
+        finally:
+            os.unlink(path)
+
+    def _map_arrow(self, values):
+        fd, path = self._temp_file(".arrow")
+        try:
+            table = pyarrow.table({"values": values})
+            with os.fdopen(fd, "wb") as f, pyarrow.ipc.new_file(f, table.schema) as writer:
+                writer.write_table(table)
+            return pyarrow.ipc.open_file(pyarrow.memory_map(path)).read_all().column(0)
+        finally:
+            os.unlink(path)
@@ -0,0 +1,309 @@
+import time
+import json
+import base64
+
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne, DeleteMany, monitoring
+from pymongo.errors import DuplicateKeyError
+
+from metrics import mongo_command_duration, mongo_command_failures
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Records the latency of every MongoDB command, pass it to MongoClient(event_listeners=[...])."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_command_duration.observe(event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        mongo_command_duration.observe(event.duration_micros / 1e6, command=event.command_name)
+        mongo_command_failures.inc(command=event.command_name)
+
+
+class NotebookStore:
+    """MongoDB storage split into users, notebooks, cells and variables collections.
+
+    Notebooks, cells and namespace variables each live in their own documents,
+    so listing notebooks or loading one notebook only reads what it needs and
+    no single document grows with the size of a user's work.
+    """
+
+    def __init__(self, db):
+        self.users = db["users"]
+        self.notebooks = db["notebooks"]
+        self.cells = db["cells"]
+        self.variables = db["variables"]
+
+    def ensure_indexes(self):
+        self.users.create_index("user_id", unique=True)
+        self.notebooks.create_index("notebook_id", unique=True)
+        self.notebooks.create_index([("user_id", ASCENDING), ("notebook_name", ASCENDING)], unique=True)
+        self.notebooks.create_index([("user_id", ASCENDING), ("updated_at", DESCENDING), ("notebook_id", DESCENDING)])
+        self.cells.create_index([("notebook_id", ASCENDING), ("ordinal", ASCENDING)], unique=True)
+        self.cells.create_index([("notebook_id", ASCENDING), ("cell_id", ASCENDING)], unique=True)
+        self.variables.create_index([("notebook_id", ASCENDING), ("name", ASCENDING)], unique=True)
+
+    # Notebooks
+
+    def list_notebooks(self, user_id, limit=50, cursor=None):
+        """Returns one page of notebook summaries, most recently modified first, and the cursor of the next page.
+
+        The query walks the (user_id, updated_at, notebook_id) index and never
+        reads cells or variables, so it costs the same for small and huge
+        notebooks.
+        """
+        query = {"user_id": user_id}
+        if cursor:
+            updated_at, notebook_id = decode_cursor(cursor)
+            query["$or"] = [
+                {"updated_at": {"$lt": updated_at}},
+                {"updated_at": updated_at, "notebook_id": {"$lt": notebook_id}}
+            ]
+        notebooks = list(self.notebooks.find(
+            query,
+            {"_id": 0, "notebook_id": 1, "notebook_name": 1, "updated_at": 1, "cell_count": 1}
+        ).sort([("updated_at", DESCENDING), ("notebook_id", DESCENDING)]).limit(limit + 1))
+
+        next_cursor = None
+        if len(notebooks) > limit:
+            notebooks = notebooks[:limit]
+            next_cursor = encode_cursor(notebooks[-1]["updated_at"], notebooks[-1]["notebook_id"])
+        return notebooks, next_cursor
+
+    def get_notebook(self, user_id, notebook_id):
+        """Returns the notebook's metadata, or None if the user has no such notebook."""
+        return self.notebooks.find_one(
+            {"notebook_id": notebook_id, "user_id": user_id},
+            {"_id": 0, "globals_serialized": 0}
+        )
+
+    def notebook_name_exists(self, user_id, notebook_name):
+        return self.notebooks.count_documents({"user_id": user_id, "notebook_name": notebook_name}, limit=1) > 0
+
+    def create_notebook(self, user_id, notebook_id, notebook_name):
+        now = time.time()
+        self.users.update_one(
+            {"user_id": user_id},
+            {"$setOnInsert": {"user_id": user_id, "created_at": now}},
+            upsert=True
+        )
+        self.notebooks.insert_one({
+            "notebook_id": notebook_id,
+            "user_id": user_id,
+            "notebook_name": notebook_name,
+            "created_at": now,
+            "updated_at": now,
+            "cell_count": 0,
+            "next_ordinal": 0
+        })
+
+    def import_notebook(self, user_id, notebook_id, notebook_name, cells):
+        """Creates a notebook with all its cells in one bulk insert, cells given in order without ordinals."""
+        now = time.time()
+        self.users.update_one(
+            {"user_id": user_id},
+            {"$setOnInsert": {"user_id": user_id, "created_at": now}},
+            upsert=True
+        )
+        if cells:
+            self.cells.insert_many(
+                [dict(cell, notebook_id=notebook_id, ordinal=ordinal) for ordinal, cell in enumerate(cells)],
+                ordered=False
+            )
+        # Insert the notebook last so it never shows up without its cells
+        try:
+            self.notebooks.insert_one({
+                "notebook_id": notebook_id,
+                "user_id": user_id,
+                "notebook_name": notebook_name,
+                "created_at": now,
+                "updated_at": now,
+                "cell_count": len(cells),
+                "next_ordinal": len(cells)
+            })
+        except DuplicateKeyError:
+            self.cells.delete_many({"notebook_id": notebook_id})
+            raise
+
+    def duplicate_notebook(self, user_id, notebook_id, new_notebook_id, new_name):
+        """Copies a notebook with its cells and stored variables under a new id and name.
+
+        Cells and variables are copied inside the database with $merge, so
+        large variables never pass through the web worker.
+        """
+        notebook = self.notebooks.find_one({"notebook_id": notebook_id, "user_id": user_id}, {"_id": 0})
+        for collection in (self.cells, self.variables):
+            collection.aggregate([
+                {"$match": {"notebook_id": notebook_id}},
+                {"$project": {"_id": 0}},
+                {"$addFields": {"notebook_id": new_notebook_id}},
+                {"$merge": {"into": collection.name, "whenMatched": "fail"}}
+            ])
+        now = time.time()
+        # Insert the notebook last so it never shows up without its cells
+        try:
+            self.notebooks.insert_one(dict(notebook, notebook_id=new_notebook_id, notebook_name=new_name,
+                                           created_at=now, updated_at=now))
+        except DuplicateKeyError:
+            self.cells.delete_many({"notebook_id": new_notebook_id})
+            self.variables.delete_many({"notebook_id": new_notebook_id})
+            raise
+
+    def delete_notebook(self, user_id, notebook_id):
+        """Deletes a notebook with its cells and variables, returns False if it did not exist."""
+        result = self.notebooks.delete_one({"notebook_id": notebook_id, "user_id": user_id})
+        if result.deleted_count == 0:
+            return False
+        self.cells.delete_many({"notebook_id": notebook_id})
+        self.variables.delete_many({"notebook_id": notebook_id})
+        # Remove the user once their last notebook is gone
+        if self.notebooks.count_documents({"user_id": user_id}, limit=1) == 0:
+            self.users.delete_one({"user_id": user_id})
+        return True
+
+    # Cells
+
+    def load_cells(self, notebook_id):
+        return list(self.cells.find(
+            {"notebook_id": notebook_id},
+            {"_id": 0, "notebook_id": 0}
+        ).sort("ordinal", ASCENDING))
+
+    def iter_cells(self, notebook_id, batch_size=100):
+        """Like load_cells, but returns the cursor so a large notebook is read a batch at a time."""
+        return self.cells.find(
+            {"notebook_id": notebook_id},
+            {"_id": 0, "notebook_id": 0}
+        ).sort("ordinal", ASCENDING).batch_size(batch_size)
+
+    def get_cell(self, notebook_id, cell_id):
+        return self.cells.find_one({"notebook_id": notebook_id, "cell_id": cell_id}, {"_id": 0})
+
+    def load_code_cells(self, notebook_id, cell_ids=None, start=None, end=None):
+        """Returns the notebook's code cells to run, in the order of cell_ids or by ordinal within [start, end)."""
+        query = {"notebook_id": notebook_id, "cell_type": "code"}
+        if cell_ids is not None:
+            query["cell_id"] = {"$in": cell_ids}
+        elif start is not None or end is not None:
+            query["ordinal"] = {}
+            if start is not None:
+                query["ordinal"]["$gte"] = start
+            if end is not None:
+                query["ordinal"]["$lt"] = end
+        cells = list(self.cells.find(query, {"_id": 0, "cell_id": 1, "code": 1}).sort("ordinal", ASCENDING))
+        if cell_ids is not None:
+            by_id = {cell["cell_id"]: cell for cell in cells}
+            cells = [by_id[cell_id] for cell_id in cell_ids if cell_id in by_id]
+        return cells
+
+    def load_dependency_cells(self, notebook_id):
+        """Returns the notebook's code cells in order with the names they define and read."""
+        return list(self.cells.find(
+            {"notebook_id": notebook_id, "cell_type": "code"},
+            {"_id": 0, "cell_id": 1, "code": 1, "defines": 1, "reads": 1}
+        ).sort("ordinal", ASCENDING))
+
+    def set_cell_names(self, notebook_id, names):
+        """Stores {cell_id: {"defines": [...], "reads": [...]}} for cells saved before names were tracked."""
+        if names:
+            self.cells.bulk_write([
+                UpdateOne({"notebook_id": notebook_id, "cell_id": cell_id}, {"$set": cell_names})
+                for cell_id, cell_names in names.items()
+            ], ordered=False)
+
+    def update_cell(self, notebook_id, cell_id, fields):
+        """Sets fields of one cell, returns False if the cell does not exist."""
+        result = self.cells.update_one({"notebook_id": notebook_id, "cell_id": cell_id}, {"$set": fields})
+        if result.matched_count:
+            self.notebooks.update_one({"notebook_id": notebook_id}, {"$set": {"updated_at": time.time()}})
+        return result.matched_count > 0
+
+    def append_cell(self, notebook_id, cell):
+        """Appends a cell after the notebook's last one, returns the cell with its ordinal."""
+        notebook = self.notebooks.find_one_and_update(
+            {"notebook_id": notebook_id},
+            {"$inc": {"next_ordinal": 1, "cell_count": 1}, "$set": {"updated_at": time.time()}},
+            projection={"next_ordinal": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        cell = dict(cell, notebook_id=notebook_id, ordinal=notebook["next_ordinal"] - 1)
+        self.cells.insert_one(cell)
+        cell.pop("_id", None)
+        return cell
+
+    def update_outputs(self, notebook_id, outputs):
+        """Replaces the outputs of several cells, {cell_id: output}, in one bulk write."""
+        if not outputs:
+            return
+        self.cells.bulk_write([
+            UpdateOne({"notebook_id": notebook_id, "cell_id": cell_id}, {"$set": {"output": output}})
+            for cell_id, output in outputs.items()
+        ], ordered=False)
+        self.notebooks.update_one({"notebook_id": notebook_id}, {"$set": {"updated_at": time.time()}})
+
+    def delete_cell(self, notebook_id, cell_id):
+        result = self.cells.delete_one({"notebook_id": notebook_id, "cell_id": cell_id})
+        if result.deleted_count:
+            self.notebooks.update_one(
+                {"notebook_id": notebook_id},
+                {"$inc": {"cell_count": -1}, "$set": {"updated_at": time.time()}}
+            )
+        return result.deleted_count > 0
+
+    # Namespace variables
+
+    def load_namespace(self, notebook_id):
+        """Returns the notebook's stored variables in the form the kernels load."""
+        namespace = {
+            variable["name"]: {"hash": variable["hash"], "data": variable["data"]}
+            for variable in self.variables.find({"notebook_id": notebook_id}, {"_id": 0, "notebook_id": 0})
+        }
+        # Notebooks migrated from the old layout may still carry one blob for the whole namespace
+        notebook = self.notebooks.find_one({"notebook_id": notebook_id}, {"_id": 0, "globals_serialized": 1})
+        return {
+            "namespace": namespace,
+            "globals_serialized": notebook.get("globals_serialized") if notebook else None
+        }
+
+    def load_variable_hashes(self, notebook_id):
+        """Returns {name: hash} of the notebook's stored variables, without their data."""
+        return {
+            variable["name"]: variable["hash"]
+            for variable in self.variables.find({"notebook_id": notebook_id}, {"_id": 0, "name": 1, "hash": 1})
+        }
+
+    def save_namespace(self, notebook_id, changes):
+        """Writes only the changed and deleted variables of a notebook."""
+        operations = [
+            UpdateOne(
+                {"notebook_id": notebook_id, "name": name},
+                {"$set": {"hash": variable["hash"], "data": variable["data"]}},
+                upsert=True
+            )
+            for name, variable in changes["changed"].items()
+        ]
+        if changes["deleted"]:
+            operations.append(DeleteMany({"notebook_id": notebook_id, "name": {"$in": changes["deleted"]}}))
+        if operations:
+            self.variables.bulk_write(operations, ordered=False)
+        self.notebooks.update_one(
+            {"notebook_id": notebook_id, "globals_serialized": {"$exists": True}},
+            {"$unset": {"globals_serialized": ""}}
+        )
+
+
+def encode_cursor(updated_at, notebook_id):
+    return base64.urlsafe_b64encode(json.dumps([updated_at, notebook_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Raises ValueError for cursors that were not produced by encode_cursor."""
+    try:
+        updated_at, notebook_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception as e:
+        raise ValueError("Invalid cursor.") from e
+    if not isinstance(updated_at, (int, float)) or not isinstance(notebook_id, str):
+        raise ValueError("Invalid cursor.")
+    return updated_at, notebook_id
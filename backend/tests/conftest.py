@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Backend modules are flat files imported by name, as app3.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
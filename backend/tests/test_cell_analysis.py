@@ -0,0 +1,54 @@
+import pytest
+
+from cell_analysis import CellAnalysis
+
+DENYLIST = frozenset(["input", "os.system"])
+
+
+@pytest.mark.parametrize("code", [
+    "input()",
+    "i = input\ni()",
+    "import builtins\nbuiltins.input()",
+    "import builtins as b\nb.input()",
+    "from builtins import input as ask\nask()",
+    "__builtins__.input()",
+    "__builtins__['input']()",
+    "import builtins\ngetattr(builtins, 'input')()",
+    "x = [input][0]",
+    "import os\nos.system('ls')",
+    "import os as o\nrun = o.system",
+    "from os import system\nsystem('ls')",
+])
+def test_denied_through_aliases(code):
+    assert CellAnalysis.parse(code).denied(DENYLIST)
+
+
+@pytest.mark.parametrize("code", [
+    "print('input')",
+    "import os\nos.getcwd()",
+    "data = {'input': 1}\ndata['input']",
+    "obj.input = 1",
+    "def forward(self, input):\n    return input",
+    "for input in range(2):\n    print(input)",
+    "input = 5\nprint(input)",
+    "f = lambda input: input",
+    "values = [input for input in range(3)]",
+    "def outer(input):\n    def inner():\n        return input\n    return inner",
+    "try:\n    pass\nexcept Exception as input:\n    print(input)",
+    "def run(os):\n    os.system('ls')",
+])
+def test_other_names_allowed(code):
+    assert CellAnalysis.parse(code).denied(DENYLIST) == []
+
+
+@pytest.mark.parametrize("code", [
+    "class Form:\n    input = None\n    def ask(self):\n        return input()",
+    "def ask():\n    global input\n    return input()",
+    "def ask(prompt):\n    return input(prompt)",
+])
+def test_builtin_denied_where_not_shadowed(code):
+    assert CellAnalysis.parse(code).denied(DENYLIST)
+
+
+def test_denied_reports_first_line():
+    assert CellAnalysis.parse("x = 1\ni = input\ni()").denied(DENYLIST) == [("input", 2)]
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+import code_cache as code_cache_module
+from code_cache import CodeCache
+from cell_analysis import CellAnalysis
+
+
+def run(analysis):
+    namespace = {}
+    exec(analysis.code, namespace)
+    return namespace
+
+
+def test_key_depends_on_source_filename_and_analysis_version(monkeypatch):
+    cache = CodeCache(path="")
+    key = cache.key("x = 1", "<string>")
+
+    assert cache.key("x = 1", "<string>") == key
+    assert cache.key("x = 2", "<string>") != key
+    assert cache.key("x = 1", "<cell>") != key
+    monkeypatch.setattr(code_cache_module, "ANALYSIS_VERSION", code_cache_module.ANALYSIS_VERSION + 1)
+    assert cache.key("x = 1", "<string>") != key
+
+
+def test_unchanged_cell_is_a_hit_and_a_changed_one_a_miss():
+    cache = CodeCache(path="")
+    first = cache.analyze("x = 1")
+
+    assert cache.analyze("x = 1") is first
+    assert run(cache.analyze("x = 2"))["x"] == 2
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_least_recently_used_cell_is_evicted():
+    cache = CodeCache(size=2, path="")
+    first = cache.analyze("a = 1")
+    cache.analyze("b = 1")
+    cache.analyze("a = 1")
+    cache.analyze("c = 1")
+
+    assert cache.analyze("a = 1") is first
+    assert cache.misses == 3
+    cache.analyze("b = 1")
+    assert cache.misses == 4
+
+
+def test_cells_are_shared_through_marshal_files(tmp_path, monkeypatch):
+    CodeCache(path=str(tmp_path)).analyze("x = [1, 2]\nx")
+
+    def parse(*args):
+        raise AssertionError("parsed again")
+
+    monkeypatch.setattr(CellAnalysis, "parse", parse)
+    other = CodeCache(path=str(tmp_path))
+    analysis = other.analyze("x = [1, 2]\nx")
+    assert analysis.split_code is not None
+    assert run(analysis)["x"] == [1, 2]
+
+    warmed = CodeCache(path=str(tmp_path))
+    warmed.warm()
+    warmed.analyze("x = [1, 2]\nx")
+    assert warmed.hits == 1
+
+
+def test_unreadable_file_is_parsed_again(tmp_path):
+    cache = CodeCache(path=str(tmp_path))
+    key = cache.key("x = 1", "<string>")
+    os.makedirs(cache.path)
+    with open(os.path.join(cache.path, f"{key}.bin"), "wb") as f:
+        f.write(b"not marshal")
+
+    assert run(cache.analyze("x = 1"))["x"] == 1
+    assert run(CodeCache(path=str(tmp_path)).analyze("x = 1"))["x"] == 1
+
+
+def test_syntax_error_is_raised_and_not_cached():
+    cache = CodeCache(path="")
+    for _ in range(2):
+        with pytest.raises(SyntaxError):
+            cache.analyze("x = ")
+    assert cache.misses == 2
@@ -0,0 +1,21 @@
+from dependency_graph import DependencyGraph, cell_names
+
+
+def graph(*codes):
+    return DependencyGraph([dict(cell_id=f"c{i}", **cell_names(code)) for i, code in enumerate(codes)])
+
+
+def test_augmented_assignment_reads_and_binds():
+    assert cell_names("x += 1") == {"defines": ["x"], "reads": ["x"]}
+
+
+def test_augmented_assignment_is_downstream():
+    assert graph("x = 1", "x += 1", "print(x)").downstream("c0", ["x"]) == ["c1", "c2"]
+
+
+def test_augmented_assignment_of_global_in_function():
+    assert cell_names("def f():\n    global n\n    n += 1") == {"defines": ["f", "n"], "reads": ["n"]}
+
+
+def test_redefinition_hides_change():
+    assert graph("x = 1", "x = 2", "print(x)").downstream("c0", ["x"]) == []
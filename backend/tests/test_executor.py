@@ -0,0 +1,110 @@
+import signal
+import threading
+
+from executor import CodeExecutor, PendingInterrupt
+
+executor = CodeExecutor(timeout=0)
+
+PLOTS = """
+import time
+import matplotlib.pyplot as plt
+for i in range({count}):
+    plt.figure()
+    plt.plot([i, {count}])
+    print("{tag}", i)
+    time.sleep(0.01)
+print(len(plt.get_fignums()))
+"""
+
+
+def test_output_of_threads_started_by_a_cell_is_captured():
+    code = "import threading\nt = threading.Thread(target=print, args=('from thread',))\nt.start()\nt.join()"
+    assert executor.capture_output(code, {})["text"] == "from thread\n"
+
+
+def test_figures_of_threads_started_by_a_cell_are_captured():
+    code = ("import threading, matplotlib.pyplot as plt\n"
+            "t = threading.Thread(target=lambda: plt.plot([1, 2]))\nt.start()\nt.join()")
+    assert len(executor.capture_output(code, {})["images"]) == 1
+
+
+def test_concurrent_executions_keep_their_own_output_and_figures():
+    counts = {"a": 3, "b": 5, "c": 1}
+    results = {}
+
+    def run(tag):
+        results[tag] = executor.capture_output(PLOTS.format(tag=tag, count=counts[tag]), {})
+
+    threads = [threading.Thread(target=run, args=(tag,)) for tag in counts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for tag, count in counts.items():
+        result = results[tag]
+        assert result["error"] is None
+        lines = result["text"].splitlines()
+        assert lines == [f"{tag} {i}" for i in range(count)] + [str(count)]
+        assert len(result["images"]) == count
+
+
+def test_threads_of_a_cell_do_not_write_into_a_later_cell():
+    b_started, a_done = threading.Event(), threading.Event()
+    cell_a = ("import threading, matplotlib.pyplot as plt\n"
+              "def work():\n"
+              "    b_started.wait(10)\n"
+              "    print('secret from A')\n"
+              "    plt.plot([1, 2])\n"
+              "t = threading.Thread(target=work)\nt.start()\nt.join()\na_done.set()")
+    cell_b = "b_started.set()\na_done.wait(10)"
+    results = {}
+
+    def run(tag, code):
+        results[tag] = executor.capture_output(code, {"b_started": b_started, "a_done": a_done})
+
+    first = threading.Thread(target=run, args=("a", cell_a))
+    first.start()
+    second = threading.Thread(target=run, args=("b", cell_b))
+    second.start()
+    first.join()
+    second.join()
+
+    assert results["a"]["text"] == "secret from A\n"
+    assert len(results["a"]["images"]) == 1
+    assert results["b"]["text"] == ""
+    assert results["b"]["images"] is None
+
+
+def test_thread_outliving_its_cell_does_not_write_into_the_next():
+    release = threading.Event()
+    code = ("import threading\n"
+            "def late():\n    release.wait(10)\n    print('late output')\n"
+            "t = threading.Thread(target=late)\nt.start()")
+    first = executor.capture_output(code, {"release": release, "t": None})
+    second = executor.capture_output("release.set()\nimport time\ntime.sleep(0.2)", {"release": release})
+    assert first["text"] == ""
+    assert second["text"] == ""
+
+
+def test_interrupt_caught_before_the_cell_started_stops_it():
+    pending = PendingInterrupt()
+    pending.pending = True
+    previous = signal.signal(signal.SIGINT, pending)
+    try:
+        session = {}
+        result = CodeExecutor(timeout=0).capture_output("x = 1", session)
+    finally:
+        signal.signal(signal.SIGINT, previous)
+
+    assert result["error_type"] == "interrupted"
+    assert "x" not in session
+
+
+def test_output_budget_is_shared_by_stdout_stderr_and_displays():
+    code = "import sys\nprint('o' * 600)\nsys.stderr.write('e' * 600)\nfor i in range(5):\n    display('d' * 300)"
+    result = CodeExecutor(timeout=0, output_limit=1000).capture_output(code, {})
+
+    assert result["text"] == "o" * 600 + "\n"
+    assert result["stderr"] == "e" * 399 + "\n[Output truncated, a cell keeps at most 1000 characters of output]\n"
+    assert result["displays"] == [{"data": {"text/plain": "[5 more displays not shown]"}}]
@@ -0,0 +1,19 @@
+from image_store import LocalImageStore
+
+
+def test_local_store_put_exists_delete(tmp_path):
+    images = LocalImageStore(root=str(tmp_path))
+    name = images.put(b"\x89PNG data", "image/png")
+    assert images.exists(name)
+    assert images.get(name) == b"\x89PNG data"
+
+    images.delete(name)
+    assert not images.exists(name)
+    assert images.get(name) is None
+    images.delete(name)  # Already gone
+
+
+def test_local_store_ignores_invalid_names(tmp_path):
+    images = LocalImageStore(root=str(tmp_path))
+    assert not images.exists("../secret.png")
+    images.delete("../secret.png")
@@ -0,0 +1,104 @@
+import io
+import gzip
+import json
+
+import pytest
+
+import ipynb
+from ipynb import export_chunks, gzip_chunks, read_ipynb
+
+PNG = b"\x89PNG\r\n\x1a\n fake"
+CELLS = [
+    {"cell_id": "cell_1", "cell_type": "markdown", "code": "# Title\nSome text"},
+    {"cell_id": "cell_2", "cell_type": "code", "code": "print('a')\nprint('b')", "output": {
+        "text": "a\nb\n", "error": None, "images": ["plot.png", "gone.png"], "stderr": "warning\n",
+        "displays": [{"data": {"text/html": "<b>x</b>", "text/plain": "x"}}]
+    }},
+    {"cell_id": "not a valid id", "cell_type": "code", "code": "x = 1", "output": None},
+]
+
+
+def load_image(name):
+    return PNG if name == "plot.png" else None
+
+
+def export(cells):
+    return json.loads("".join(export_chunks(iter(cells), load_image)))
+
+
+def test_export_is_an_nbformat_4_notebook():
+    notebook = export(CELLS)
+
+    assert notebook["nbformat"] == 4
+    assert notebook["metadata"]["kernelspec"]["name"] == "python3"
+    assert [cell["id"] for cell in notebook["cells"]] == ["cell_1", "cell_2", "cell-2"]
+    assert notebook["cells"][0] == {"id": "cell_1", "cell_type": "markdown", "metadata": {},
+                                    "source": ["# Title\n", "Some text"]}
+
+
+def test_export_turns_stored_output_into_outputs():
+    outputs = export(CELLS)["cells"][1]["outputs"]
+
+    assert outputs[0] == {"name": "stdout", "output_type": "stream", "text": ["a\n", "b\n"]}
+    assert outputs[1] == {"name": "stderr", "output_type": "stream", "text": ["warning\n"]}
+    assert outputs[2]["data"] == {"text/html": ["<b>x</b>"], "text/plain": ["x"]}
+    # An image missing from the store is left out
+    assert len(outputs) == 4
+    assert outputs[3]["data"] == {"image/png": "iVBORw0KGgogZmFrZQ=="}
+
+
+def test_export_of_an_empty_notebook():
+    assert export([])["cells"] == []
+
+
+def test_gzip_export_decompresses_to_the_same_notebook():
+    data = b"".join(gzip_chunks(export_chunks(iter(CELLS), load_image)))
+    assert json.loads(gzip.decompress(data)) == export(CELLS)
+
+
+def import_notebook(data):
+    stored = {}
+
+    def put_image(content, mime):
+        name = f"image_{len(stored)}.png"
+        stored[name] = content
+        return name
+
+    return read_ipynb(io.BytesIO(data), put_image), stored
+
+
+@pytest.fixture(params=["ijson", "json"])
+def parser(request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setattr(ipynb, "ijson", None)
+
+
+def test_export_then_import_keeps_cells_and_outputs(parser):
+    data = "".join(export_chunks(iter(CELLS), load_image)).encode()
+    cells, stored = import_notebook(data)
+
+    assert [(cell["cell_type"], cell["code"]) for cell in cells] == [
+        (cell["cell_type"], cell["code"]) for cell in CELLS]
+    output = cells[1]["output"]
+    assert output["text"] == "a\nb\n"
+    assert output["stderr"] == "warning\n"
+    assert output["displays"] == CELLS[1]["output"]["displays"]
+    assert [stored[name] for name in output["images"]] == [PNG]
+    assert cells[2]["output"] is None
+
+
+@pytest.mark.parametrize("notebook, message", [
+    ({"nbformat": 3, "cells": []}, "Only nbformat 4"),
+    ({"nbformat": 4}, "cells are missing"),
+    ({"nbformat": 4, "cells": [{"cell_type": "heading", "source": ""}]}, "Cell 0: Unknown cell type"),
+    ({"nbformat": 4, "cells": [{"cell_type": "code", "source": 1}]}, "Cell 0: source must be"),
+])
+def test_invalid_notebooks_are_rejected(parser, notebook, message):
+    with pytest.raises(ValueError, match=message):
+        import_notebook(json.dumps(notebook).encode())
+
+
+def test_truncated_file_is_rejected(parser):
+    data = "".join(export_chunks(iter(CELLS), load_image)).encode()
+    with pytest.raises(ValueError, match="Invalid notebook file"):
+        import_notebook(data[:len(data) // 2])
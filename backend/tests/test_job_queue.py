@@ -0,0 +1,156 @@
+import time
+import threading
+
+import pytest
+
+from job_queue import JobQueue, QueueFull, RUNNING, CANCELLED, DONE
+
+
+def wait_until_finished(queue, job, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if queue.get(job["user_id"], job["job_id"])["finished_at"] is not None:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job still {job['status']}")
+
+
+def blocked_queue(ran, workers=1, **options):
+    """A queue whose workers wait on the returned event, running jobs record their code in ran."""
+    release = threading.Event()
+
+    def run(job):
+        release.wait(10)
+        ran.append(job["code"])
+
+    queue = JobQueue(run, lambda job: None, workers=workers, **options)
+    return queue, release
+
+
+def test_users_take_turns():
+    ran = []
+    queue, release = blocked_queue(ran)
+    blocker = queue.submit("user_z", "notebook_z", "z")
+    while blocker["status"] != RUNNING:
+        time.sleep(0.01)
+    jobs = [queue.submit("user_a", f"notebook_a{i}", f"a{i}") for i in range(3)]
+    jobs.append(queue.submit("user_b", "notebook_b", "b0"))
+    release.set()
+    for job in jobs:
+        wait_until_finished(queue, job)
+
+    assert ran == ["z", "a0", "b0", "a1", "a2"]
+
+
+def test_jobs_of_one_notebook_run_one_at_a_time_in_order():
+    running, overlapped, ran = [], [], []
+
+    def run(job):
+        running.append(job)
+        overlapped.append(len(running) > 1)
+        time.sleep(0.05)
+        ran.append(job["code"])
+        running.remove(job)
+
+    queue = JobQueue(run, lambda job: None, workers=3)
+    jobs = [queue.submit("user", "notebook", f"x{i}") for i in range(4)]
+    for job in jobs:
+        wait_until_finished(queue, job)
+
+    assert ran == ["x0", "x1", "x2", "x3"]
+    assert not any(overlapped)
+
+
+def test_queued_job_is_cancelled_without_running():
+    ran = []
+    queue, release = blocked_queue(ran)
+    first = queue.submit("user", "notebook", "first")
+    second = queue.submit("user", "notebook", "second")
+    queue.cancel("user", second["job_id"])
+    release.set()
+    wait_until_finished(queue, first)
+
+    assert second["status"] == CANCELLED
+    assert first["status"] == DONE
+    assert ran == ["first"]
+    assert queue.stats()["queued"] == 0
+
+
+def test_user_queue_is_bounded():
+    queue, release = blocked_queue([], max_queued_per_user=2)
+    running = queue.submit("user", "notebook_0", "x")
+    while running["status"] != RUNNING:
+        time.sleep(0.01)
+    for i in range(1, 3):
+        queue.submit("user", f"notebook_{i}", "x")
+    with pytest.raises(QueueFull):
+        queue.submit("user", "notebook_3", "x")
+    queue.submit("other_user", "notebook_4", "x")
+    release.set()
+
+
+def test_job_cancelled_before_its_cell_starts_is_not_interrupted_nor_run():
+    waiting, release = threading.Event(), threading.Event()
+    interrupted, ran = [], []
+
+    def run(job):
+        # Stands in for the wait on the notebook's lock
+        waiting.set()
+        release.wait(10)
+        with queue.executing(job):
+            ran.append(job["code"])
+
+    queue = JobQueue(run, interrupted.append, workers=1)
+    job = queue.submit("user", "notebook", "x = 1")
+    assert waiting.wait(10)
+    queue.cancel("user", job["job_id"])
+    release.set()
+    wait_until_finished(queue, job)
+
+    assert job["status"] == CANCELLED
+    assert ran == []
+    assert interrupted == []
+
+
+def test_cancel_interrupts_the_cell_the_job_is_running():
+    executing, stopped = threading.Event(), threading.Event()
+    interrupted = []
+
+    def run(job):
+        with queue.executing(job):
+            executing.set()
+            stopped.wait(10)
+
+    def interrupt(job):
+        interrupted.append(job["job_id"])
+        stopped.set()
+
+    queue = JobQueue(run, interrupt, workers=1)
+    job = queue.submit("user", "notebook", "while True: pass")
+    assert executing.wait(10)
+    queue.cancel("user", job["job_id"])
+    wait_until_finished(queue, job)
+
+    assert job["status"] == CANCELLED
+    assert interrupted == [job["job_id"]]
+
+
+def test_cancel_after_the_cell_ran_does_not_interrupt():
+    ran, release = threading.Event(), threading.Event()
+    interrupted = []
+
+    def run(job):
+        with queue.executing(job):
+            pass
+        # Still holding the notebook, the kernel may run another request now
+        ran.set()
+        release.wait(10)
+
+    queue = JobQueue(run, interrupted.append, workers=1)
+    job = queue.submit("user", "notebook", "x = 1")
+    assert ran.wait(10)
+    queue.cancel("user", job["job_id"])
+    release.set()
+    wait_until_finished(queue, job)
+
+    assert interrupted == []
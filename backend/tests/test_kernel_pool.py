@@ -0,0 +1,108 @@
+import time
+import threading
+
+import pytest
+
+from kernel_pool import KernelPool
+
+# stdout lines larger than the pipe buffer block the cell's thread mid-send, while
+# the stderr written before them is left for the flusher thread to send
+INTERLEAVED = """
+import sys
+for i in range(4):
+    sys.stderr.write(f"err {i}\\n")
+    print(str(i) * 200000)
+"""
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = KernelPool(size=2, spares=0)
+    yield pool
+    pool.shutdown()
+
+
+def test_stream_interleaving_stdout_and_stderr(pool):
+    kernel, _ = pool.acquire("notebook_stream")
+    runs = []
+
+    def consume():
+        for _ in range(10):
+            events, results = [], []
+            for kind, value in kernel.stream("execute", INTERLEAVED, stream=True, kill_after=30):
+                (results if kind == "result" else events).append(value)
+                # A slow client keeps the kernel blocked in its large sends
+                time.sleep(0.05)
+            runs.append((events, results[0]))
+
+    # A corrupted pipe blocks recv() for good, so the streams run on a thread the test can give up on
+    reader = threading.Thread(target=consume, daemon=True)
+    reader.start()
+    reader.join(120)
+    assert not reader.is_alive(), "the kernel stream hung"
+
+    assert len(runs) == 10
+    for events, result in runs:
+        assert result["error"] is None
+        assert "".join(text for name, text in events if name == "stdout") == result["text"]
+        assert "".join(text for name, text in events if name == "stderr") == result["stderr"]
+        assert result["stderr"] == "".join(f"err {i}\n" for i in range(4))
+    # The kernel still answers after the streams
+    assert kernel.call("execute", "1 + 1")["displays"] == [{"data": {"text/plain": "2"}}]
+
+
+def test_interrupt_stops_the_batch(pool):
+    kernel, _ = pool.acquire("notebook_batch")
+    codes = ["import time\ntime.sleep(0.5)\nran = 1"] + ["time.sleep(0.5)\nran += 1"] * 5
+    timer = threading.Timer(0.2, kernel.interrupt)
+    timer.start()
+    events = [value for kind, value in kernel.stream("execute_batch", codes) if kind == "stream"]
+    timer.join()
+
+    assert [name for name, _ in events] == ["cell_result"]
+    assert events[0][1][1]["error_type"] == "interrupted"
+    assert kernel.call("execute", "print('still here')")["text"].strip() == "still here"
+
+
+@pytest.fixture
+def slow_fork(pool, monkeypatch):
+    """Makes forking a kernel take a second, sets the returned event once a fork started."""
+    fork = pool._template.fork
+    forking = threading.Event()
+
+    def slow(*args, **kwargs):
+        forking.set()
+        time.sleep(1)
+        return fork(*args, **kwargs)
+
+    monkeypatch.setattr(pool._template, "fork", slow)
+    return forking
+
+
+def test_fork_does_not_hold_up_other_notebooks(pool, slow_fork):
+    bound, _ = pool.acquire("notebook_bound")
+    new = threading.Thread(target=pool.acquire, args=("notebook_new",))
+    new.start()
+    assert slow_fork.wait(10)
+
+    start = time.monotonic()
+    assert pool.acquire("notebook_bound") == (bound, False)
+    assert time.monotonic() - start < 0.5
+    new.join(30)
+    assert pool.get("notebook_new") is not None
+
+
+def test_notebook_acquired_during_its_fork_gets_the_forked_kernel(pool, slow_fork):
+    acquired = []
+
+    def acquire():
+        acquired.append(pool.acquire("notebook_twice"))
+
+    threads = [threading.Thread(target=acquire) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    assert acquired[0][0] is acquired[1][0]
+    assert sorted(is_new for _, is_new in acquired) == [False, True]
@@ -0,0 +1,59 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import migrate_storage
+from storage import NotebookStore
+
+
+def notebook(notebook_id, name, code):
+    return {"notebook_id": notebook_id, "notebook_name": name,
+            "cells": [{"cell_id": "cell_1", "code": code, "output": ""}],
+            "namespace": {"x": {"hash": "h", "data": b"data"}}}
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = mongomock.MongoClient()["NotebookDB"]
+    monkeypatch.setenv("MONGO_URI", "mongodb://test")
+    monkeypatch.setattr(migrate_storage, "MongoClient", lambda uri: {"NotebookDB": db})
+    monkeypatch.setattr(migrate_storage, "load_dotenv", lambda: None)
+    return db
+
+
+def run(monkeypatch, *args):
+    monkeypatch.setattr("sys.argv", ["migrate_storage.py", *args])
+    migrate_storage.main()
+
+
+def test_notebooks_with_the_same_id_are_both_kept(db, monkeypatch):
+    db["user_sessions"].insert_one({"user_id": "u1", "notebooks": [
+        notebook("notebook_u1_100", "A", "a = 1"),
+        notebook("notebook_u1_100", "B", "important = 42"),
+    ]})
+    run(monkeypatch, "--delete-source")
+
+    store = NotebookStore(db)
+    migrated = {doc["notebook_name"]: doc["notebook_id"] for doc in store.notebooks.find()}
+    assert sorted(migrated) == ["A", "B"]
+    assert migrated["A"] != migrated["B"]
+    assert store.cells.find_one({"notebook_id": migrated["B"]})["code"] == "important = 42"
+    assert db["user_sessions"].count_documents({}) == 0
+
+
+def test_rerun_does_not_copy_again(db, monkeypatch):
+    db["user_sessions"].insert_one({"user_id": "u1", "notebooks": [
+        notebook("notebook_u1_100", "A", "a = 1"),
+        notebook("notebook_u1_100", "B", "b = 2"),
+    ]})
+    run(monkeypatch)
+    run(monkeypatch)
+    assert NotebookStore(db).notebooks.count_documents({}) == 2
+
+
+def test_source_is_kept_when_the_copy_is_incomplete(db, monkeypatch):
+    db["user_sessions"].insert_one({"user_id": "u1", "notebooks": [notebook("notebook_u1_100", "A", "a = 1")]})
+    run(monkeypatch)
+    NotebookStore(db).cells.delete_many({})
+    run(monkeypatch, "--delete-source")
+    assert db["user_sessions"].count_documents({}) == 1
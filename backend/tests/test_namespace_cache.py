@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+
+from kernel_pool import KernelPool
+from namespace_cache import NamespaceCache
+
+
+@pytest.fixture
+def saved():
+    return {}
+
+
+@pytest.fixture
+def cache(saved):
+    pool = KernelPool(size=2, spares=0)
+    cache = NamespaceCache(pool, load=lambda notebook_id: None,
+                           save=lambda notebook_id, changes: saved.setdefault(notebook_id, []).append(changes))
+    yield cache
+    cache.stop()
+    pool.shutdown()
+
+
+def test_adopt_waits_for_the_notebook_it_evicts(cache):
+    with cache.use("notebook_b") as kernel:
+        kernel.call("execute", "x = 1")
+        forked = kernel.fork(reseed=False)
+    adopted = threading.Thread(target=cache.adopt, args=("notebook_c", forked))
+
+    # Both are busy, notebook_a is the least recently used and the one adopting notebook_c evicts
+    with cache.use("notebook_a"), cache.use("notebook_b") as busy:
+        adopted.start()
+        adopted.join(0.5)
+        assert adopted.is_alive()
+        assert busy.call("execute", "y = 2")["error"] is None
+    adopted.join(30)
+
+    assert not adopted.is_alive()
+    assert cache.pool.get("notebook_c") is forked
+    assert cache.pool.get("notebook_a") is None
+    assert forked.call("execute", "print(x)")["text"].strip() == "1"
+
+
+def test_concurrent_notebooks_never_outnumber_the_pool(cache):
+    results, sizes = [], []
+
+    def run(notebook_id):
+        with cache.use(notebook_id) as kernel:
+            sizes.append((len(cache._entries), cache.pool.stats()["bound"]))
+            results.append(kernel.call("execute", "import time\ntime.sleep(0.1)\nx = 1"))
+            cache.mark_dirty(notebook_id)
+
+    threads = [threading.Thread(target=run, args=(f"notebook_{i}",)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+
+    assert len(results) == 6
+    assert all(result["error"] is None for result in results)
+    assert all(entries <= 2 and bound <= 2 for entries, bound in sizes)
+
+
+def test_pool_eviction_waits_for_the_running_cell_and_saves_it(cache, saved):
+    with cache.use("notebook_b"):
+        pass
+    started = threading.Event()
+    results = []
+
+    def run():
+        with cache.use("notebook_a") as kernel:
+            started.set()
+            results.append(kernel.call("execute", "import time\ntime.sleep(0.5)\nx = 1"))
+            cache.mark_dirty("notebook_a")
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert started.wait(30)
+    # A kernel bound behind the cache's back makes the pool evict notebook_b, then notebook_a
+    cache.pool.acquire("notebook_c")
+    cache.pool.acquire("notebook_d")
+    thread.join(30)
+
+    assert results[0]["error"] is None
+    assert "notebook_a" in saved
@@ -0,0 +1,86 @@
+import os
+
+import namespace_tracker
+from namespace_tracker import NamespaceTracker
+
+
+def test_oversized_variable_is_reported_and_others_saved(monkeypatch):
+    monkeypatch.setattr(namespace_tracker, "NAMESPACE_MAX_VARIABLE_SIZE", 1024)
+    changes = NamespaceTracker().changes({"small": list(range(10)), "big": os.urandom(4096)})
+    assert list(changes["changed"]) == ["small"]
+    assert "over the" in changes["errors"]["big"]
+
+
+def test_variable_over_the_document_limit_is_not_written():
+    # Random bytes, so compression cannot bring it under the limit
+    changes = NamespaceTracker().changes({"big": os.urandom(17 * 1024 * 1024)})
+    assert changes["changed"] == {}
+    assert "MB a variable can take" in changes["errors"]["big"]
+
+
+def reload(code):
+    namespace = {"__builtins__": __builtins__}
+    exec(code, namespace)
+    changes = NamespaceTracker().changes(namespace)
+    assert changes["errors"] == {}
+    loaded = {"__builtins__": __builtins__}
+    NamespaceTracker().load({"namespace": changes["changed"]}, loaded)
+    return loaded
+
+
+def test_reload_keeps_instances_of_notebook_classes():
+    loaded = reload("class Point:\n    def norm(self):\n        return abs(self.x)\np = Point()\np.x = -3")
+    assert isinstance(loaded["p"], loaded["Point"])
+    assert loaded["p"].norm() == 3
+
+
+def test_reload_keeps_aliases():
+    loaded = reload("a = b = []\nframe = {'rows': a}")
+    assert loaded["a"] is loaded["b"]
+    assert loaded["frame"]["rows"] is loaded["a"]
+
+
+def test_reload_keeps_objects_shared_between_variables():
+    loaded = reload("config = {'k': 1}\nruns = [config, config]\ndef get():\n    return config")
+    assert loaded["runs"][0] is loaded["config"]
+    assert loaded["runs"][1] is loaded["config"]
+    assert loaded["get"]() is loaded["config"]
+
+
+def test_reload_of_variables_referring_to_each_other():
+    loaded = reload("x = []\ny = [x]\nx.append(y)\nz = []\nz.append(z)")
+    assert loaded["x"][0] is loaded["y"]
+    assert loaded["z"][0] is loaded["z"]
+
+
+def test_alias_of_an_array_is_stored_as_a_reference():
+    np = __import__("numpy")
+    namespace = {"data": np.arange(100000), "np": np}
+    namespace["same"] = namespace["data"]
+    changes = NamespaceTracker().changes(namespace)
+    assert len(changes["changed"]["same"]["data"]) < 1000
+    loaded = {}
+    NamespaceTracker().load({"namespace": changes["changed"]}, loaded)
+    assert loaded["same"] is loaded["data"]
+
+
+def test_unchanged_aliases_are_not_saved_again():
+    namespace = {"a": [1, 2]}
+    namespace["b"] = namespace["a"]
+    tracker = NamespaceTracker()
+    changes = tracker.changes(namespace)
+    tracker.confirm()
+    loaded = {}
+    reloaded = NamespaceTracker()
+    reloaded.load({"namespace": changes["changed"]}, loaded)
+    assert reloaded.changes(loaded)["changed"] == {}
+
+
+def test_variable_that_is_not_saved_is_copied_into_those_holding_it():
+    import io
+    buffer = io.StringIO("text")  # Open files are skipped, but a StringIO inside a list pickles
+    changes = NamespaceTracker().changes({"buffer": buffer, "holder": [buffer]})
+    assert list(changes["errors"]) == ["buffer"]
+    loaded = {}
+    NamespaceTracker().load({"namespace": changes["changed"]}, loaded)
+    assert loaded["holder"][0].getvalue() == "text"
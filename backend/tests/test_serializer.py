@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from serializer import NamespaceSerializer
+
+serializer = NamespaceSerializer()
+
+FRAMES = {
+    "numeric": lambda: pd.DataFrame({"i": np.arange(5), "f": np.linspace(0, 1, 5), "b": [True, False] * 2 + [True]}),
+    "strings": lambda: pd.DataFrame({"s": ["a", "b", "c"], "n": [1, 2, 3]}),
+    "nullable": lambda: pd.DataFrame({"i": pd.array([1, None, 3], dtype="Int64")}),
+    "datetimes": lambda: pd.DataFrame({"t": pd.date_range("2024-01-01", periods=3, tz="UTC")}),
+    "categorical": lambda: pd.DataFrame({"c": pd.Categorical(["x", "y", "x"])}),
+    "string_index": lambda: pd.DataFrame({"v": [1, 2]}, index=["r1", "r2"]),
+    "object_none": lambda: pd.DataFrame({"o": pd.Series([1, None], dtype=object)}),
+    "object_lists": lambda: pd.DataFrame({"o": pd.Series([[1, 2], [3]], dtype=object)}),
+    "object_tuples": lambda: pd.DataFrame({"o": pd.Series([(1, "a"), (2, "b")], dtype=object)}),
+    "object_mixed_numbers": lambda: pd.DataFrame({"o": pd.Series([1, 2.5, 3], dtype=object)}),
+    "object_strings_with_nan": lambda: pd.DataFrame({"o": pd.Series(["a", np.nan], dtype=object)}),
+    "object_strings_with_none": lambda: pd.DataFrame({"o": pd.Series(["a", None], dtype=object)}),
+    "object_dicts": lambda: pd.DataFrame({"o": pd.Series([{"a": 1}, {"b": [2]}], dtype=object)}),
+    "multi_index": lambda: pd.DataFrame({"v": [1, 2]}, index=pd.MultiIndex.from_tuples([("a", 1), ("b", 2)])),
+    "integer_column_labels": lambda: pd.DataFrame({1: [1.0], 2: [2.0]}),
+    "mixed_column_labels": lambda: pd.DataFrame({1: [1.0], "a": [2.0]}),
+    "object_index": lambda: pd.DataFrame({"v": [1, 2]}, index=pd.Index([1, "a"], dtype=object)),
+}
+
+
+@pytest.mark.parametrize("name", FRAMES)
+def test_dataframe_round_trip(name):
+    frame = FRAMES[name]()
+    loaded = serializer.loads(serializer.dumps(frame))
+    pd.testing.assert_frame_equal(loaded, frame)
+    for column in frame:
+        assert [type(value) for value in loaded[column]] == [type(value) for value in frame[column]]
+
+
+@pytest.mark.parametrize("name", ["object_none", "object_lists", "object_tuples", "object_mixed_numbers",
+                                  "object_strings_with_nan", "object_dicts", "object_index",
+                                  "mixed_column_labels"])
+def test_ambiguous_object_columns_are_not_stored_with_arrow(name):
+    assert serializer.codec_name(serializer.dumps(FRAMES[name]())) != "arrow"
+
+
+@pytest.mark.parametrize("name", ["numeric", "strings", "nullable", "datetimes", "categorical", "string_index",
+                                  "multi_index", "integer_column_labels"])
+def test_typed_frames_are_stored_with_arrow(name):
+    assert serializer.codec_name(serializer.dumps(FRAMES[name]())) == "arrow"
@@ -0,0 +1,58 @@
+import time
+
+from session_store import SessionStore
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_idle_session_expires():
+    store = SessionStore(timeout=0.2)
+    store.add("user", "notebook", store.new_session())
+
+    assert store.get("user", "notebook") is not None
+    assert wait_until(lambda: store.get("user", "notebook") is None)
+    assert store.stats() == {"active": 0, "expired": 1, "pending_expiry": 0}
+
+
+def test_used_session_lives_past_its_first_deadline():
+    store = SessionStore(timeout=0.5)
+    store.add("user", "notebook", store.new_session())
+    time.sleep(0.3)
+    with store.use("user", "notebook") as session:
+        assert session is not None
+    time.sleep(0.35)
+
+    assert store.get("user", "notebook") is session
+    assert wait_until(lambda: store.get("user", "notebook") is None)
+
+
+def test_session_running_a_cell_is_not_expired():
+    store = SessionStore(timeout=0.1)
+    store.add("user", "notebook", store.new_session())
+    with store.use("user", "notebook") as session:
+        session["lastActive"] = 0  # As if the cell had been running for a long time
+        time.sleep(0.3)
+        assert store.get("user", "notebook") is session
+    assert wait_until(lambda: store.get("user", "notebook") is None)
+
+
+def test_deleted_session_does_not_expire_its_replacement():
+    store = SessionStore(timeout=0.6)
+    store.add("user", "notebook", store.new_session())
+    time.sleep(0.3)
+    store.delete("user", "notebook")
+    replacement = store.new_session()
+    store.add("user", "notebook", replacement)
+    time.sleep(0.45)
+
+    # The first session's heap entry came due, the replacement still has time left
+    assert store.get("user", "notebook") is replacement
+    assert wait_until(lambda: store.get("user", "notebook") is None)
+    assert store.stats()["expired"] == 1
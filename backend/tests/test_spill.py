@@ -0,0 +1,31 @@
+import numpy as np
+
+from serializer import serializer
+from spill import NamespaceSpiller
+
+
+def spill(tmp_path, namespace):
+    return NamespaceSpiller(path=str(tmp_path), min_size=1000).spill(namespace)["spilled"]
+
+
+def test_restored_array_is_spilled(tmp_path):
+    namespace = {"restored": serializer.loads(serializer.dumps(np.arange(100000)))}
+    assert spill(tmp_path, namespace) == ["restored"]
+    assert isinstance(namespace["restored"], np.memmap)
+    assert namespace["restored"][12345] == 12345
+
+
+def test_reshaped_and_sliced_arrays_are_spilled(tmp_path):
+    namespace = {"grid": np.arange(100000).reshape(100, 1000), "evens": np.arange(200000)[::2]}
+    assert sorted(spill(tmp_path, namespace)) == ["evens", "grid"]
+    assert namespace["grid"].shape == (100, 1000)
+    assert namespace["evens"][3] == 6
+
+
+def test_views_of_memory_held_elsewhere_are_not_spilled(tmp_path):
+    data = np.arange(100000)
+    buffer = bytearray(800000)
+    namespace = {"data": data, "tail": data[10:], "wrapped": np.frombuffer(buffer, dtype=np.int64)}
+    assert spill(tmp_path, namespace) == []
+    namespace["tail"][0] = -1
+    assert data[10] == -1
@@ -0,0 +1,19 @@
+import threading
+import contextvars
+
+
+def _start_in_context(thread, start=threading.Thread.start):
+    context = contextvars.copy_context()
+    run = thread.run
+    thread.run = lambda: context.run(run)
+    start(thread)
+
+
+_start_in_context.inherits_context = True
+
+# Threads normally start with an empty context. Running them in a copy of the
+# starting thread's context keeps a thread a cell started writing to that
+# cell's output and drawing into its figures, see executor.redirect and
+# plots.figure_scope.
+if not getattr(threading.Thread.start, "inherits_context", False):
+    threading.Thread.start = _start_in_context